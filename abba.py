@@ -0,0 +1,146 @@
+import numpy as np
+import pandas as pd
+from lavi import matlab_round
+from instrumentation import traced
+
+'''This script is a NumPy implementation of ABBA: it finds the bands, borders and significance of
+LAVI profiles. All profiles (e.g. every channel x epoch x state x area) are processed at once as one
+profiles x freq array:
+1. Band borders are the crossings of the median of every profile, found with one comparison of
+   neighbouring signs over the whole array
+2. The peak (or trough) of every band is found with segment reductions over the flattened bands
+3. The bands of all profiles are returned as one flat columnar table (one row per band), instead of
+   a cell array of per-channel matrices
+Indices (BegI, EndI, PeakI) are 0-based.'''
+
+VAR_NAMES = ['BegI', 'EndI', 'PeakI', 'BegF', 'EndF', 'PeakF', 'PeakLAVI', 'PeakRel', 'Dir', 'Rel_alpha', 'Sig']
+
+def deal_with_zeros(reref):
+    """
+    Replace points exactly equal to the reference (0) by the previous point divided by 10 (the next one for the
+    first point), keeping the sign of the previous point but getting closer to 0, as dealWithZeros.
+    """
+    output = reref.copy()
+    zeros = reref == 0
+    if not zeros.any():
+        return output
+    first = zeros[:, 0]
+    output[first, 0] = reref[first, 1] / 10
+    # every other zero takes the last non-zero point before it, divided by 10 per step
+    positions = np.arange(reref.shape[1])
+    base = np.where(zeros & (positions > 0), 0, positions)
+    base = np.maximum.accumulate(base, axis=1)
+    rows = np.arange(reref.shape[0])[:, None]
+    replaced = output[rows, base] / 10.0 ** (positions - base)
+    return np.where(zeros & (positions > 0), replaced, output)
+
+def significance_limits(LAVI, SIGLIM=None, per_freq=False):
+    """
+    Return the profiles x freq lower and upper significance limits.
+    SIGLIM can be None (the median of every profile), a (min, max) pair, an N_freq x 2 array shared by all profiles
+    or an N_profiles x N_freq x 2 array. Unless per_freq, the limits are the minimum/maximum over all frequencies.
+    """
+    n_profiles, n_freq = LAVI.shape
+    if SIGLIM is None:
+        median = np.nanmedian(LAVI, axis=1, keepdims=True)
+        limits = np.repeat(median[:, :, None], 2, axis=2)
+    else:
+        SIGLIM = np.asarray(SIGLIM, dtype=float)
+        if SIGLIM.shape[-1] != 2:
+            raise ValueError('Wrong definition of SIGLIM')
+        limits = SIGLIM.reshape((1,) * (3 - SIGLIM.ndim) + SIGLIM.shape)
+    limits = np.broadcast_to(limits, (n_profiles, n_freq, 2))
+    lower, upper = limits[..., 0], limits[..., 1]
+    if not per_freq:
+        lower = np.repeat(lower.min(axis=1, keepdims=True), n_freq, axis=1)
+        upper = np.repeat(upper.max(axis=1, keepdims=True), n_freq, axis=1)
+    return lower, upper
+
+@traced('abba')
+def abba(LAVI, foi, alpha_range=(6, 14), SIGLIM=None, per_freq=False):
+    """
+    Find the bands, borders and significance of every LAVI profile, as ABBA.
+
+    Parameters:
+    - LAVI (array): N_profiles x N_freq LAVI profiles, e.g. the stacked outputs of prepare_lavi.
+    - foi (array): The frequencies of LAVI.
+    - alpha_range (array): The frequency range in which alpha is expected, as (low, high) or N_profiles x 2.
+      The band of the highest peak in this range gets the index 0, lower bands negative and higher bands
+      positive indices. Default: (6, 14).
+    - SIGLIM (array): Lower and upper significance levels, e.g. from pink noise (see significance_limits).
+      Default: the median of the LAVI profile.
+    - per_freq (bool): Whether to use the significance level per frequency (True) or the min/max over all
+      frequencies (False). Default: False.
+    Returns:
+    - bands (DataFrame): One row per band, with the profile index and the columns of VAR_NAMES.
+    - SIGVECT (array): N_profiles x N_freq, 0.5 where LAVI is significantly high, -0.5 where significantly low,
+      0 elsewhere (and in bands whose peak is not significant).
+    """
+    LAVI = np.atleast_2d(np.asarray(LAVI, dtype=float))
+    foi = np.asarray(foi, dtype=float)
+    n_profiles, n_freq = LAVI.shape
+    alpha_range = np.broadcast_to(np.asarray(alpha_range, dtype=float), (n_profiles, 2))
+
+    with np.errstate(invalid='ignore'):
+        # significance vector
+        lower, upper = significance_limits(LAVI, SIGLIM, per_freq)
+        SIGVECT = np.zeros((n_profiles, n_freq))
+        SIGVECT[LAVI > upper] = 0.5
+        SIGVECT[LAVI < lower] = -0.5
+
+        # find band limits as crossings of the reference
+        reref = deal_with_zeros(LAVI - np.nanmedian(LAVI, axis=1, keepdims=True))
+        siman = np.sign(reref)
+        flipp = np.diff(siman, axis=1)
+        starts = np.ones((n_profiles, n_freq), dtype=bool)
+        starts[:, 1:] = (flipp != 0) & ~np.isnan(flipp)
+
+    # flatten the bands of all profiles: band k covers flat samples [band_start[k], band_start[k + 1])
+    band_start = np.flatnonzero(starts)
+    band_stop = np.append(band_start[1:], starts.size)
+    band_of_sample = np.cumsum(starts.ravel()) - 1
+    profile = band_start // n_freq
+    first_band = np.flatnonzero(band_start % n_freq == 0)  # first band of every profile
+
+    # peak/trough of every band: the first maximum of |reref| (ignoring NaNs)
+    magnitude = np.abs(reref.ravel())
+    magnitude[np.isnan(magnitude)] = -np.inf
+    band_max = np.maximum.reduceat(magnitude, band_start)
+    samples = np.arange(magnitude.size)
+    peak = np.minimum.reduceat(np.where(magnitude == band_max[band_of_sample], samples, magnitude.size), band_start)
+
+    bands = pd.DataFrame({'Profile': profile})
+    bands['BegI'] = band_start - profile * n_freq
+    bands['EndI'] = band_stop - 1 - profile * n_freq
+    bands['PeakI'] = peak - profile * n_freq
+    rounded_foi = matlab_round(foi * 10) / 10
+    bands['BegF'] = rounded_foi[bands['BegI']]
+    bands['EndF'] = rounded_foi[bands['EndI']]
+    bands['PeakF'] = rounded_foi[bands['PeakI']]
+    bands['PeakLAVI'] = LAVI.ravel()[peak]
+    bands['PeakRel'] = reref.ravel()[peak]
+    direction = siman.ravel()[band_stop - 1]
+    bands['Dir'] = direction
+
+    # defining alpha as band 0: the highest peak falling within the alpha range
+    local_band = np.arange(band_start.size) - first_band[profile]
+    peak_f = bands['PeakF'].to_numpy()
+    with np.errstate(invalid='ignore'):
+        in_alpha = (peak_f <= alpha_range[profile, 1]) & (peak_f >= alpha_range[profile, 0]) & (direction > 0)
+    score = np.where(in_alpha, bands['PeakLAVI'].to_numpy(), -np.inf)
+    best = np.maximum.reduceat(score, first_band)
+    alpha_band = np.minimum.reduceat(np.where(in_alpha & (score == best[profile]), local_band, n_freq), first_band)
+    has_alpha = alpha_band[profile] < n_freq
+    bands['Rel_alpha'] = np.where(has_alpha, local_band - alpha_band[profile], np.nan)
+    bands.loc[~has_alpha, ['BegF', 'EndF', 'PeakF']] = np.nan
+
+    # determines if the peak of the band is significant, and clears the bands that are not
+    with np.errstate(invalid='ignore'):
+        significant = SIGVECT.ravel()[peak] * direction == 0.5
+    bands['Sig'] = significant
+    SIGVECT = np.where(significant[band_of_sample].reshape(n_profiles, n_freq), SIGVECT, 0)
+    return bands, SIGVECT
+
+def profile_borders(bands, profile):
+    '''Return the N_bands x 11 BORDERS matrix of one profile (columns of VAR_NAMES), as one cell of ABBA's output.'''
+    return bands.loc[bands['Profile'] == profile, VAR_NAMES].to_numpy(dtype=float)
@@ -1,7 +1,7 @@
 import os
 import pickle
-import re
 import pandas as pd
+from recording_store import list_channel_files
 
 '''This script creates a dataframe by assigning the tetrode to the channel maps. 
 It includes the following components:
@@ -12,25 +12,21 @@ It includes the following components:
 This dataframe is saved in the file named assigned_dataframe '''
 
 
-def load_channel_map(animal):
-    file_path = os.path.join("/Users/claudiagoh/Desktop/Course directory/RP1/channel_maps/ChMaps", f"{animal}.pickle")
+def load_channel_map(animal, channel_map_folder="/Users/claudiagoh/Desktop/Course directory/RP1/channel_maps/ChMaps"):
+    file_path = os.path.join(channel_map_folder, f"{animal}.pickle")
     with open(file_path, 'rb') as file:
         return pickle.load(file)
 
 def load_condition_data(base_path, animal, condition):
+    """
+    List the channel files of a condition without unpickling them.
+    Returns a dictionary mapping (animal, index) to the path of the channel's pickle file.
+    """
     folder_path = os.path.join(base_path, f"dataset/{animal}/{condition}")
     condition_data = {}
-    
-    files = sorted(
-        [f for f in os.listdir(folder_path) if f.endswith('.pickle')],
-        key=lambda x: int(re.match(r'(\d+)\.pickle', x).group(1))
-    )
 
-    for file_name in files:
-        index = int(re.match(r'(\d+)\.pickle', file_name).group(1))
-        file_path = os.path.join(folder_path, file_name)
-        with open(file_path, 'rb') as file:
-            condition_data[(animal, index)] = pickle.load(file)
+    for index in list_channel_files(folder_path):
+        condition_data[(animal, index)] = os.path.join(folder_path, f"{index}.pickle")
     
     return condition_data
 
@@ -48,8 +44,8 @@ def transform_dataframe(assigned_df):
     assigned_df['Leads'] = (assigned_df.index % 4) + 1
     return assigned_df[['File', 'Area', 'Tetrode', 'Leads']]
 
-def save_assigned_data(animal, condition, transformed_data):
-    save_folder = '/Users/claudiagoh/Desktop/Course directory/RP1/assigned_dataframe'
+def save_assigned_data(animal, condition, transformed_data,
+                       save_folder='/Users/claudiagoh/Desktop/Course directory/RP1/assigned_dataframe'):
     os.makedirs(save_folder, exist_ok=True)
     save_path = os.path.join(save_folder, f"{animal}_{condition}_assigned.pickle")
     with open(save_path, 'wb') as file:
@@ -71,7 +67,6 @@ def main():
 
             # Transform the DataFrame
             transformed_data = transform_dataframe(assigned_data)
-            print(transformed_data)      
             save_assigned_data(animal, condition, transformed_data)
 
 if __name__ == "__main__":
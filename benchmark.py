@@ -0,0 +1,220 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+from segmentation import load_sleep_scores, load_and_process_audio_timestamps, state_masks
+from epoch_index import build_epoch_index
+from recording_store import RecordingStore, METADATA_FILE
+from lavi import prepare_lavi
+from pink_surrogates import compute_pink_lavi
+from abba import abba
+from epoch_accumulator import EpochAccumulator
+from pipeline import LAVI_FOI
+from synthetic_lfp import write_synthetic_session
+from instrumentation import resident_peak, reset_resident_peak
+
+'''This script benchmarks every stage of the pipeline on a deterministic synthetic recording (synthetic_lfp),
+so a change to segmentation, LAVI, the pink surrogates or ABBA can be checked for speed and memory.
+1. segment: brain-state masks of the whole recording, without stimulus windows
+2. epoch: epoch index of one state and the stacked epochs of all channels
+3. lavi: LAVI of every channel, per epoch
+4. pink: pink-noise surrogates of a few channels of one epoch
+5. abba: band detection on the LAVI profiles of all channels and epochs
+6. average: running LAVI and PINK averages across epochs
+Every stage records its wall and CPU time, its throughput and its peak memory (numpy/Python allocations
+traced with tracemalloc, and on Linux how far the resident size rose above its level at the start of
+the stage) in a JSON file. The
+times come from runs without tracing (the best of several runs for the stages taking milliseconds), and
+the traced memory from a separate run, so tracing does not slow the timed runs. Given a baseline file
+from an earlier run with the same settings, stages slower or using more memory than the baseline by more
+than the tolerance are reported as regressions and the script exits with status 1:
+    python benchmark.py --hours 2 --output before.json
+    python benchmark.py --hours 2 --output after.json --baseline before.json'''
+
+RSS_SLACK = 4 * 2 ** 20  # resident-size rises smaller than this are not regressions
+
+def measure(func, items, unit, repeats=1):
+    """
+    Run func() and return its result and a dictionary of timings, throughput and peak memory. func() is timed
+    without tracing, as the best of repeats runs. The peak resident size (VmHWM) is reset before the first run
+    and read after it; peak_rss_bytes is its rise above the resident size at the start (None where it cannot
+    be reset). func() is then run once more under tracemalloc for the peak traced memory.
+    """
+    start_rss = resident_peak() if reset_resident_peak() else None  # right after a reset, the current size
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    rss = None if start_rss is None else resident_peak() - start_rss
+    for _ in range(repeats - 1):
+        tic, cpu_tic = time.perf_counter(), time.process_time()
+        func()
+        if time.perf_counter() - tic < wall:
+            wall, cpu = time.perf_counter() - tic, time.process_time() - cpu_tic
+    tracemalloc.start()
+    func()
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    items = items(result) if callable(items) else items
+    return result, {'seconds': wall, 'cpu_seconds': cpu, 'items': items, 'unit': unit,
+                    'throughput': items / wall if wall > 0 else float('inf'),
+                    'peak_traced_bytes': traced_peak, 'peak_rss_bytes': rss}
+
+def prepare_session(folder, n_channels, hours, fs, seed):
+    '''Write the synthetic session to folder, unless a session with the same settings is already there.'''
+    metadata_path = os.path.join(folder, METADATA_FILE)
+    if os.path.exists(metadata_path):
+        with open(metadata_path) as file:
+            metadata = json.load(file)
+        if (len(metadata['channels']) == n_channels and metadata['fs'] == fs
+                and metadata.get('synthetic') == {'seed': seed, 'duration': hours * 3600}):
+            return
+    print(f'Writing a synthetic session of {n_channels} channels x {hours} h to {folder}')
+    write_synthetic_session(folder, n_channels=n_channels, duration=hours * 3600, fs=fs, seed=seed)
+
+def run_benchmark(folder, state='REM', epoch_length=240000, max_epochs=2, foi=LAVI_FOI, lag=1.5, width=5,
+                  pink_channels=4, pink_reps=10, abba_profiles=2000, repeats=5):
+    """
+    Time every stage on the synthetic session in folder and return a dictionary of results per stage.
+
+    Parameters:
+    - folder (str): Folder of the synthetic session.
+    - state (str): Brain state the epochs are taken from. Default: 'REM'.
+    - epoch_length (int): Number of data points in every epoch. Default: 240000.
+    - max_epochs (int): Number of epochs the LAVI is computed for. Default: 2.
+    - foi, lag, width: As in prepare_lavi.
+    - pink_channels (int): Number of channels the pink surrogates are computed for. Default: 4.
+    - pink_reps (int): Number of surrogates per channel. Default: 10.
+    - abba_profiles (int): Number of LAVI profiles given to abba (the computed profiles, repeated). Default: 2000.
+    - repeats (int): Number of runs the short stages (abba, average) are timed over, keeping the best. Default: 5.
+    """
+    store = RecordingStore(folder)
+    sleep_scores = load_sleep_scores(os.path.join(folder, 'sleep_score.pickle'))
+    audio_timestamps = load_and_process_audio_timestamps(os.path.join(folder, 'audio_timestamps.pickle'))
+    n_channels, n_samples, fs = len(store.channels), store.common_length(), store.fs
+    stages = {}
+
+    _, stages['segment'] = measure(lambda: state_masks(n_samples, sleep_scores, audio_timestamps),
+                                   n_samples, 'samples')
+
+    def epoch():
+        index = build_epoch_index(n_samples, sleep_scores, audio_timestamps, state, epoch_length)
+        return index, [np.array(index.epoch(store.data, i), dtype=float) for i in range(min(len(index), max_epochs))]
+    (index, epochs), stages['epoch'] = measure(epoch, lambda result: n_channels * len(result[1]), 'channel-epochs')
+    if not epochs:
+        raise ValueError(f'No {state} epoch of {epoch_length} samples in {folder}')
+    print(f'{len(index)} {state} epochs, {len(epochs)} benchmarked')
+
+    LAVIs, stages['lavi'] = measure(lambda: [prepare_lavi(data, foi, fs, lag, width, verbose=False) for data in epochs],
+                                    n_channels * len(epochs), 'channel-epochs')
+
+    PINK, stages['pink'] = measure(lambda: compute_pink_lavi(epochs[0][:pink_channels], foi, fs, lag, width, pink_reps,
+                                                             session='benchmark', n_workers=1, verbose=False),
+                                   pink_channels * pink_reps, 'surrogates')
+
+    profiles = np.concatenate(LAVIs)
+    profiles = profiles[np.arange(abba_profiles) % len(profiles)]
+    _, stages['abba'] = measure(lambda: abba(profiles, foi), abba_profiles, 'profiles', repeats)
+
+    def average():
+        accumulator = EpochAccumulator()
+        for epoch_number, LAVI in enumerate(LAVIs):
+            accumulator.add_epoch(LAVI, np.repeat(PINK[..., :1], n_channels, axis=-1), epoch_number)
+        return accumulator.lavi_envelope()
+    _, stages['average'] = measure(average, len(LAVIs), 'epochs', repeats)
+    return stages
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Return the regressions of results against a baseline, as (stage, metric, value, baseline value) tuples:
+    stages whose time per item, peak traced memory or peak resident size exceeds the baseline by more than
+    tolerance (a fraction). The resident size is only compared when both runs could measure it, and only rises
+    of more than RSS_SLACK bytes count, as it moves by whole pages and allocator arenas.
+    """
+    regressions = []
+    for stage, result in results['stages'].items():
+        reference = baseline['stages'].get(stage)
+        if reference is None:
+            continue
+        for metric, value, reference_value in [
+                ('seconds_per_item', result['seconds'] / result['items'], reference['seconds'] / reference['items']),
+                ('peak_traced_bytes', result['peak_traced_bytes'], reference['peak_traced_bytes']),
+                ('peak_rss_bytes', result.get('peak_rss_bytes'), reference.get('peak_rss_bytes'))]:
+            if value is None or reference_value is None \
+                    or (metric == 'peak_rss_bytes' and value - reference_value <= RSS_SLACK):
+                continue
+            if value > reference_value * (1 + tolerance):
+                regressions.append((stage, metric, value, reference_value))
+    return regressions
+
+def print_table(results, baseline=None):
+    '''Print the time, throughput and memory of every stage, with the change against the baseline.'''
+    print(f'{"stage":<10}{"seconds":>10}{"throughput":>26}{"peak MB":>10}{"RSS +MB":>10}{"vs baseline":>14}')
+    for stage, result in results['stages'].items():
+        change = ''
+        if baseline is not None and stage in baseline['stages']:
+            reference = baseline['stages'][stage]
+            ratio = (result['seconds'] / result['items']) / (reference['seconds'] / reference['items'])
+            change = f'{(ratio - 1) * 100:+.1f}%'
+        throughput = f'{result["throughput"]:.1f} {result["unit"]}/s'
+        rss = '' if result.get('peak_rss_bytes') is None else f'{result["peak_rss_bytes"] / 2 ** 20:.1f}'
+        print(f'{stage:<10}{result["seconds"]:>10.3f}{throughput:>26}'
+              f'{result["peak_traced_bytes"] / 2 ** 20:>10.1f}{rss:>10}{change:>14}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on a synthetic recording.')
+    parser.add_argument('--channels', type=int, default=128, help='number of channels (default: 128)')
+    parser.add_argument('--hours', type=float, default=2, help='duration of the recording in hours (default: 2)')
+    parser.add_argument('--fs', type=int, default=1000, help='sampling frequency (default: 1000)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic recording (default: 0)')
+    parser.add_argument('--state', default='REM', help='brain state of the epochs (default: REM)')
+    parser.add_argument('--epoch-length', type=int, default=240000, help='samples per epoch (default: 240000)')
+    parser.add_argument('--max-epochs', type=int, default=2, help='epochs the LAVI is computed for (default: 2)')
+    parser.add_argument('--pink-channels', type=int, default=4, help='channels with pink surrogates (default: 4)')
+    parser.add_argument('--pink-reps', type=int, default=10, help='pink surrogates per channel (default: 10)')
+    parser.add_argument('--abba-profiles', type=int, default=2000, help='LAVI profiles given to abba (default: 2000)')
+    parser.add_argument('--repeats', type=int, default=5, help='runs of the short stages, best kept (default: 5)')
+    parser.add_argument('--work-dir', default='benchmark_data', help='folder of the synthetic recordings')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown or memory growth against the baseline, as a fraction (default: 0.2)')
+    args = parser.parse_args(argv)
+
+    config = {'channels': args.channels, 'hours': args.hours, 'fs': args.fs, 'seed': args.seed, 'state': args.state,
+              'epoch_length': args.epoch_length, 'max_epochs': args.max_epochs, 'pink_channels': args.pink_channels,
+              'pink_reps': args.pink_reps, 'abba_profiles': args.abba_profiles, 'repeats': args.repeats}
+    folder = os.path.join(args.work_dir, f'synthetic_{args.channels}ch_{args.hours:g}h_{args.fs}Hz_seed{args.seed}')
+    prepare_session(folder, args.channels, args.hours, args.fs, args.seed)
+
+    stages = run_benchmark(folder, args.state, args.epoch_length, args.max_epochs, pink_channels=args.pink_channels,
+                           pink_reps=args.pink_reps, abba_profiles=args.abba_profiles, repeats=args.repeats)
+    results = {'config': config, 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                               'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+               'stages': stages}
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline['config'] != config:
+            print('Warning: the baseline was run with different settings, the comparison may not be meaningful')
+    print_table(results, baseline)
+    print(f'Results written to {args.output}')
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for stage, metric, value, reference_value in regressions:
+            print(f'Regression in {stage}: {metric} {value:.4g} vs {reference_value:.4g} in the baseline')
+        if regressions:
+            sys.exit(1)
+        print('No regression')
+
+if __name__ == '__main__':
+    main()
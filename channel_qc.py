@@ -0,0 +1,262 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy.signal import welch
+from recording_store import RecordingStore
+from psd import matlab_hanning, pwelch_nfft, fit_aperiodic
+from kernel_bank import pin_fft_workers
+from session_catalog import set_quality
+from label_tetrode_quality import load_assigned_data, save_quality_data
+from instrumentation import span
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:  # optional: without it the BLAS threads of the covariance are not limited
+    threadpool_limits = None
+
+'''This script screens every channel of a packed session and proposes its Quality label, instead of
+typing the good channels by hand after looking at the traces and spectra of every tetrode.
+1. The channels are streamed from the RecordingStore in blocks of whole Welch segments, one tetrode
+   (the channels of assign_tetrode's Tetrode column) per task, and the tasks run in a process pool
+2. In one pass over every block, each channel gets its variance, the fraction of samples equal to the
+   previous one (flatline), the fraction of samples at its minimum or maximum (clipping), its Welch PSD
+   (2-sec Hann window, as pwelch), and the covariance with its tetrode mates
+3. From the PSD come the line-noise ratio (power at the line frequency over the power around it) and the
+   1/f slope (fit_aperiodic from 5 to 40 Hz); from the covariance, the median correlation with the mates
+4. A channel is proposed as Good unless a metric crosses its threshold in QC_THRESHOLDS; the failing
+   metrics are listed in QCFlags
+The metrics and the proposal are written into the assigned dataframe, whose Quality is only filled where
+no label exists yet, so labels checked by hand are kept.'''
+
+QC_THRESHOLDS = {
+    'variance': 1.0,  # largest |log10(variance / median variance of the session)|
+    'flat': 0.01,  # largest fraction of samples equal to the previous one
+    'clip': 0.001,  # largest fraction of samples at the minimum or maximum of the channel
+    'line_noise': 10.0,  # largest ratio of the power at the line frequency to the power around it
+    'slope': (-4.0, -0.5),  # range of the 1/f exponent of the PSD
+    'mate_correlation': 0.3,  # smallest median correlation with the other channels of the tetrode
+}
+QC_COLUMNS = ['Variance', 'FlatFraction', 'ClipFraction', 'LineNoiseRatio', 'AperiodicSlope', 'MateCorrelation']
+
+def scan_channels(data, fs, window_length=None, block_size=2 ** 20):
+    """
+    Stream a chan x time array (e.g. the rows of one tetrode in a RecordingStore memmap) in blocks of whole
+    Welch segments and return its per-channel sample statistics, its covariance matrix and its Welch PSD.
+    Returns a dictionary with 'n', 'covariance' (chan x chan), 'flat', 'clip' (counts per channel), 'pxx'
+    (chan x freq) and 'pff'.
+    """
+    n_chan, n_time = data.shape
+    window = matlab_hanning(int(window_length or 2 * fs))
+    nperseg = window.size
+    step = nperseg - nperseg // 2
+    nfft = pwelch_nfft(nperseg)
+    if n_time < nperseg:
+        raise ValueError(f'The window ({nperseg} samples) is longer than the data ({n_time} samples)')
+    n_segments = (n_time - nperseg) // step + 1
+    segments_per_block = max(1, (block_size - nperseg) // step + 1)
+
+    offset = np.asarray(data[:, 0], dtype=float)[:, None]  # shifted sums keep the covariance accurate
+    sums = np.zeros(n_chan)
+    products = np.zeros((n_chan, n_chan))
+    flat = np.zeros(n_chan, dtype=np.int64)
+    minimum, maximum = np.full(n_chan, np.inf), np.full(n_chan, -np.inf)
+    at_minimum, at_maximum = np.zeros(n_chan, dtype=np.int64), np.zeros(n_chan, dtype=np.int64)
+    previous = None
+    pxx = 0
+    for first in range(0, n_segments, segments_per_block):
+        last = min(first + segments_per_block, n_segments)
+        # the samples [start, stop) are counted by this block, the Welch segments overlap the next block
+        start, stop = first * step, n_time if last == n_segments else last * step
+        end = (last - 1) * step + nperseg
+        with span('load', bytes_read=n_chan * (max(stop, end) - start) * data.dtype.itemsize):
+            block = np.asarray(data[:, start:max(stop, end)], dtype=float)
+        _, block_pxx = welch(block[:, :end - start] - offset, fs, window=window,
+                             nperseg=nperseg, noverlap=nperseg - step, nfft=nfft, detrend=False, axis=-1)
+        pxx = pxx + block_pxx * (last - first)  # welch averages the segments of the block
+
+        samples = block[:, :stop - start]
+        shifted = samples - offset
+        sums += shifted.sum(axis=1)
+        products += shifted @ shifted.T
+        flat += np.count_nonzero(np.diff(samples, axis=1) == 0, axis=1)
+        if previous is not None:
+            flat += samples[:, 0] == previous
+        previous = samples[:, -1]
+
+        # counts at the running extremes, restarted whenever a new extreme appears
+        block_minimum, block_maximum = samples.min(axis=1), samples.max(axis=1)
+        for extreme, counts, block_extreme, beyond in [(minimum, at_minimum, block_minimum, block_minimum < minimum),
+                                                       (maximum, at_maximum, block_maximum, block_maximum > maximum)]:
+            block_counts = np.count_nonzero(samples == block_extreme[:, None], axis=1)
+            same = block_extreme == extreme
+            counts[same] += block_counts[same]
+            counts[beyond] = block_counts[beyond]
+            extreme[beyond] = block_extreme[beyond]
+
+    mean = sums / n_time
+    covariance = (products - n_time * np.outer(mean, mean)) / (n_time - 1)
+    # a constant channel has every sample at both extremes, and is counted once
+    clip = np.where(minimum == maximum, at_minimum, at_minimum + at_maximum)
+    return {'n': n_time, 'covariance': covariance, 'flat': flat, 'clip': clip,
+            'pxx': pxx / n_segments, 'pff': np.arange(nfft // 2 + 1) * fs / nfft}
+
+def line_noise_ratio(pxx, pff, line_freq=50, width=1, flank=(5, 10)):
+    '''Return the mean power within width Hz of the line frequency over the median power 5-10 Hz away from it.'''
+    distance = np.abs(pff - line_freq)
+    around = (distance >= flank[0]) & (distance <= flank[1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return pxx[:, distance <= width].mean(axis=1) / np.median(pxx[:, around], axis=1)
+
+def channel_metrics(scan, line_freq=50, flim=(5, 40)):
+    '''Return the QC_COLUMNS of the channels of one scan (the rows of one tetrode) as a DataFrame.'''
+    variance = np.diag(scan['covariance'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = scan['covariance'] / np.sqrt(np.outer(variance, variance))
+    np.fill_diagonal(correlation, np.nan)
+    n_chan = variance.size
+    with np.errstate(all='ignore'):
+        _, slope = fit_aperiodic(scan['pff'], scan['pxx'], flim, refine=True)
+    return pd.DataFrame({
+        'Variance': variance,
+        'FlatFraction': scan['flat'] / max(scan['n'] - 1, 1),
+        'ClipFraction': scan['clip'] / scan['n'],
+        'LineNoiseRatio': line_noise_ratio(scan['pxx'], scan['pff'], line_freq),
+        'AperiodicSlope': slope,
+        'MateCorrelation': np.nanmedian(correlation, axis=1) if n_chan > 1 else np.full(n_chan, np.nan),
+    })
+
+def propose_quality(metrics, thresholds=None):
+    """
+    Return the proposed Quality ('Good' or 'Bad') of every channel and the metrics failing their threshold
+    (comma-separated, empty when none). Channels without tetrode mates are not judged on their correlation.
+    """
+    thresholds = dict(QC_THRESHOLDS, **(thresholds or {}))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative_variance = np.abs(np.log10(metrics['Variance'] / np.nanmedian(metrics['Variance'])))
+    failing = pd.DataFrame({
+        'variance': ~(relative_variance <= thresholds['variance']),
+        'flat': metrics['FlatFraction'] > thresholds['flat'],
+        'clip': metrics['ClipFraction'] > thresholds['clip'],
+        'line_noise': metrics['LineNoiseRatio'] > thresholds['line_noise'],
+        'slope': ~metrics['AperiodicSlope'].between(*thresholds['slope']),
+        'mate_correlation': metrics['MateCorrelation'] < thresholds['mate_correlation'],
+    }, index=metrics.index)
+    flags = failing.apply(lambda row: ','.join(failing.columns[row.to_numpy()]), axis=1)
+    return np.where(failing.any(axis=1), 'Bad', 'Good'), flags
+
+def tetrode_groups(store, assigned_df=None):
+    """
+    Return the store rows of every tetrode, from the Tetrode column of assigned_df or, without it, from the tetrode
+    labels of the store. Channels without a tetrode are scanned on their own.
+    """
+    if assigned_df is not None and 'Tetrode' in assigned_df.columns:
+        tetrodes = {int(str(file).split('.')[0]): tetrode
+                    for file, tetrode in zip(assigned_df['File'], assigned_df['Tetrode']) if pd.notna(tetrode)}
+    else:
+        # the store keeps the labels as strings, a missing tetrode as 'nan' or 'None'
+        tetrodes = {channel: store.labels(channel)['tetrode'] for channel in store.channels
+                    if store.labels(channel).get('tetrode', 'nan') not in ('nan', 'None', '')}
+    groups = {}
+    for row, channel in enumerate(store.channels):
+        groups.setdefault(tetrodes.get(channel, f'channel {channel}'), []).append(row)
+    return list(groups.values())
+
+_WORKER = {}
+
+def _init_worker(folder, settings):
+    '''Open the packed session once per worker process.'''
+    _WORKER['store'] = RecordingStore(folder)
+    _WORKER.update(settings)
+
+def _init_pool_worker(folder, settings):
+    '''Initialise a pool worker, with one FFT (and, with threadpoolctl, one BLAS) thread per worker.'''
+    pin_fft_workers(1)
+    if threadpool_limits is not None:
+        threadpool_limits(1)
+    _init_worker(folder, settings)
+
+def _scan_task(rows):
+    '''Scan the rows of one tetrode, up to their common length (without NaN padding), and return their metrics.'''
+    store = _WORKER['store']
+    data = store.read([store.channels[row] for row in rows])
+    scan = scan_channels(data, store.fs, block_size=_WORKER['block_size'])
+    return rows, channel_metrics(scan, _WORKER['line_freq'])
+
+def scan_session(folder, assigned_df=None, n_workers=None, line_freq=50, thresholds=None, block_size=2 ** 20,
+                 verbose=True):
+    """
+    Compute the QC metrics and the proposed Quality of every channel of a packed session.
+
+    Parameters:
+    - folder (str): Folder of the packed session (session.dat and session.json).
+    - assigned_df (DataFrame): Optional assigned dataframe (File, Tetrode columns), used to group the tetrode mates.
+    - n_workers (int): Number of worker processes. Default: all cores. 1 runs in this process.
+    - line_freq (float): Frequency of the mains. Default: 50 Hz.
+    - thresholds (dict): Thresholds replacing those of QC_THRESHOLDS.
+    - block_size (int): Approximate number of samples read at once per channel. Default: 2^20.
+    Returns a DataFrame indexed by channel with the QC_COLUMNS, ProposedQuality and QCFlags.
+    """
+    tic = time.time()
+    store = RecordingStore(folder)
+    groups = tetrode_groups(store, assigned_df)
+    n_workers = n_workers or os.cpu_count()
+    settings = {'line_freq': line_freq, 'block_size': block_size}
+    results = []
+    with span('qc', channels=len(store.channels), samples=store.n_samples):
+        if n_workers == 1:
+            _init_worker(folder, settings)
+            results = [_scan_task(rows) for rows in groups]
+            _WORKER.clear()
+        else:
+            with ProcessPoolExecutor(n_workers, initializer=_init_pool_worker, initargs=(folder, settings)) as pool:
+                futures = [pool.submit(_scan_task, rows) for rows in groups]
+                results = [future.result() for future in as_completed(futures)]
+
+    metrics = pd.concat([table.set_axis([store.channels[row] for row in rows]) for rows, table in results])
+    metrics = metrics.sort_index().rename_axis('Channel')
+    metrics['ProposedQuality'], metrics['QCFlags'] = propose_quality(metrics, thresholds)
+    if verbose:
+        print(f'Screened {len(metrics)} channels of {store.n_samples / store.fs / 3600:.2f} h in '
+              f'{time.time() - tic:.1f} s: {np.count_nonzero(metrics["ProposedQuality"] == "Good")} proposed as Good')
+    return metrics
+
+def add_qc_to_dataframe(assigned_df, metrics):
+    """
+    Add the QC metrics, ProposedQuality and QCFlags to the assigned dataframe (matched on File), and fill
+    Quality with the proposal where it is missing. Returns the updated DataFrame.
+    """
+    channels = assigned_df['File'].map(lambda filename: int(str(filename).split('.')[0]))
+    for column in QC_COLUMNS + ['ProposedQuality', 'QCFlags']:
+        assigned_df[column] = channels.map(metrics[column]).to_numpy()
+    if 'Quality' not in assigned_df.columns:
+        assigned_df['Quality'] = assigned_df['ProposedQuality']
+    else:
+        assigned_df['Quality'] = assigned_df['Quality'].fillna(assigned_df['ProposedQuality'])
+    return assigned_df
+
+def main():
+    base_path = '/Users/claudiagoh/Desktop/Course directory/RP1'
+    animal = 'r14'
+    condition = 'habituation'
+
+    assigned_df = load_assigned_data(animal, condition)
+    if assigned_df is None:
+        return
+    metrics = scan_session(os.path.join(base_path, 'dataset', animal, condition), assigned_df)
+    labelled = add_qc_to_dataframe(assigned_df, metrics)
+    save_quality_data(animal, condition, labelled)
+
+    # Channels whose label disagrees with the proposal are worth a look in visualise_tetrode_con/power_spectrum
+    disagree = labelled[labelled['Quality'] != labelled['ProposedQuality']]
+    if len(disagree):
+        print(disagree[['File', 'Area', 'Tetrode', 'Quality', 'ProposedQuality', 'QCFlags']])
+
+    catalog_path = os.path.join(base_path, 'session_catalog.sqlite')
+    if os.path.exists(catalog_path):
+        good = labelled.loc[labelled['Quality'] == 'Good', 'File']
+        set_quality(catalog_path, animal, condition, [int(str(filename).split('.')[0]) for filename in good])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import numpy as np
+from scipy.io import loadmat, savemat
+from lavi import prepare_lavi
+from pink_surrogates import PINK_FOI, compute_pink_lavi
+from instrumentation import span
+
+'''This script averages LAVI and PINK across epochs as they are computed, instead of saving every
+epoch (combine_matrices) and averaging the combined file afterwards (avg_lavi_and_pink).
+Each epoch's LAVI (chan x freq) and PINK (rep x freq x chan) is folded into a running mean and
+variance (Welford's algorithm), so the memory used does not grow with the number of epochs.
+The running sums, the epoch count and the names of the epochs already folded in are saved together in
+one file (STATE_FILE, replaced atomically) after every epoch, so an interrupted run resumes without
+counting an epoch twice.'''
+
+STATE_FILE = 'accumulator.npz'
+
+class RunningStats:
+    def __init__(self, shape=None):
+        """
+        Running mean and variance of equally shaped arrays (Welford's algorithm).
+
+        Parameters:
+        - shape (tuple): Shape of the arrays. Default: the shape of the first array added.
+        """
+        self.count = 0
+        self.mean = None if shape is None else np.zeros(shape)
+        self.m2 = None if shape is None else np.zeros(shape)
+
+    def add(self, x):
+        """Fold one array into the running mean and variance."""
+        x = np.asarray(x, dtype=float)
+        if self.mean is None:
+            self.mean = np.zeros(x.shape)
+            self.m2 = np.zeros(x.shape)
+        if x.shape != self.mean.shape:
+            raise ValueError(f'Expected an array of shape {self.mean.shape}, got {x.shape}')
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        """Fold the running statistics of another accumulator into this one (Chan et al. parallel update)."""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+
+    def variance(self, ddof=1):
+        """Return the variance across the arrays added (NaN with fewer than ddof + 1 arrays)."""
+        if self.count <= ddof:
+            return np.full(self.mean.shape, np.nan)
+        return self.m2 / (self.count - ddof)
+
+    def std(self, ddof=1):
+        """Return the standard deviation across the arrays added."""
+        return np.sqrt(self.variance(ddof))
+
+class EpochAccumulator:
+    def __init__(self, folder=None):
+        """
+        Running LAVI and PINK statistics of one animal/condition/area/state across epochs.
+
+        Parameters:
+        - folder (str): Optional folder where the statistics are saved after every epoch and read back on start.
+        """
+        self.folder = folder
+        self.stats = {'LAVI': RunningStats(), 'PINK': RunningStats()}
+        self.epochs = []
+        if folder and os.path.exists(os.path.join(folder, STATE_FILE)):
+            self.load()
+
+    @property
+    def count(self):
+        '''Number of epochs folded in.'''
+        return self.stats['LAVI'].count
+
+    def __contains__(self, epoch):
+        return str(epoch) in self.epochs
+
+    def add_epoch(self, LAVI, PINK=None, epoch=None):
+        """
+        Fold the LAVI (chan x freq) and PINK (rep x freq x chan) of one epoch into the running statistics.
+        An epoch whose name was already folded in is skipped. Returns whether the epoch was added.
+        """
+        if epoch is not None and epoch in self:
+            return False
+        self.stats['LAVI'].add(LAVI)
+        if PINK is not None:
+            self.stats['PINK'].add(PINK)
+        self.epochs.append(str(epoch if epoch is not None else self.count - 1))
+        if self.folder:
+            self.save()
+        return True
+
+    def lavi_mean(self):
+        '''Return the chan x freq LAVI averaged across epochs.'''
+        return self.stats['LAVI'].mean
+
+    def lavi_envelope(self, k=1):
+        '''Return the chan x freq x 2 envelope mean -/+ k standard deviations of the LAVI across epochs.'''
+        stats = self.stats['LAVI']
+        return np.stack((stats.mean - k * stats.std(), stats.mean + k * stats.std()), axis=-1)
+
+    def pink_mean(self):
+        '''Return the rep x freq x chan PINK averaged across epochs.'''
+        return self.stats['PINK'].mean
+
+    def siglim(self):
+        """
+        Return the chan x freq x 2 significance limits (min/max over repetitions) of the averaged PINK, for abba
+        (chan x freq x lag x 2 for a multi-lag PINK).
+        """
+        pink = self.pink_mean()
+        return np.stack((pink.min(axis=0).swapaxes(0, 1), pink.max(axis=0).swapaxes(0, 1)), axis=-1)
+
+    def save(self):
+        """
+        Save the running statistics, the counts and the epoch names to one file of the folder, written next to it
+        and then renamed over it, so the statistics and the epochs they hold are never out of step.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, STATE_FILE)
+        state = {'state': json.dumps({'counts': {name: stats.count for name, stats in self.stats.items()},
+                                      'epochs': self.epochs})}
+        for name, stats in self.stats.items():
+            if stats.mean is not None:
+                state[f'{name}_mean'], state[f'{name}_m2'] = stats.mean, stats.m2
+        with span('save', epochs=self.count) as s:
+            with open(path + '.tmp', 'wb') as file:
+                np.savez(file, **state)
+            os.replace(path + '.tmp', path)
+            s.bytes_written += os.path.getsize(path)
+
+    def load(self):
+        """Read the running statistics back from the folder."""
+        with np.load(os.path.join(self.folder, STATE_FILE)) as saved:
+            state = json.loads(str(saved['state']))
+            self.epochs = state['epochs']
+            for name, stats in self.stats.items():
+                stats.count = state['counts'][name]
+                if stats.count:
+                    stats.mean, stats.m2 = saved[f'{name}_mean'], saved[f'{name}_m2']
+
+    def save_averages_mat(self, output_path):
+        """Save LAVI_avg and PINK_avg to a .mat file, as avg_lavi_and_pink."""
+        savemat(output_path, {'LAVI_avg': self.lavi_mean(), 'PINK_avg': self.pink_mean(), 'n_epochs': self.count})
+
+def main():
+    base_path = '/Users/claudiagoh/Desktop/Course directory/RP1'
+    animal_id = 'r14'
+    condition = 'habituation'
+    area = 'HPC'
+    brain_state = 'REM'
+    fs = 1000
+    foi = PINK_FOI
+
+    matrices_folder = os.path.join(base_path, 'saved_matrices', area, brain_state)
+    accumulator = EpochAccumulator(os.path.join(base_path, 'LAVI_results', area, brain_state, 'accumulator'))
+
+    pattern = re.compile(rf'{animal_id}_{condition}_matrix_(\d+)\.mat')
+    epoch_files = []
+    for name in os.listdir(matrices_folder):
+        match = pattern.fullmatch(name)
+        if match:
+            epoch_files.append((int(match.group(1)), name))
+    epoch_files.sort()
+    for epoch_number, name in epoch_files:
+        epoch = f'{animal_id}_{condition}_{epoch_number}'
+        if epoch in accumulator:
+            print(f'Epoch {epoch} already averaged')
+            continue
+        data = loadmat(os.path.join(matrices_folder, name))['matrix']
+        LAVI = prepare_lavi(data, foi, fs)
+        PINK = compute_pink_lavi(data, foi, fs, session=f'{epoch}_{area}_{brain_state}')
+        accumulator.add_epoch(LAVI, PINK, epoch)
+        print(f'Averaged {accumulator.count} epochs')
+
+    accumulator.save_averages_mat(os.path.join(base_path, 'LAVI_results', area, f'{brain_state}_avg.mat'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from segmentation import state_masks, mask_to_intervals
+from instrumentation import span
+
+'''This script builds a multi-channel epoch index for one brain state.
+The valid samples (in the brain state and outside stimulus windows) depend only on
+the sleep-score timeline and the audio timestamps, so the contiguous valid runs are
+found once and cut into epochs of a fixed length and stride. The same epoch starts
+are then used to slice every channel of a channel x time array with views, so all
+channels are aligned by construction.'''
+
+def find_epoch_starts(valid_intervals, epoch_length, stride=None):
+    '''Return the start sample of every epoch of epoch_length that fits inside one of the [start, stop) intervals.'''
+    if stride is None:
+        stride = epoch_length
+    if stride <= 0:
+        raise ValueError(f'The epoch stride must be a positive number of samples, got {stride}')
+    valid_intervals = np.asarray(valid_intervals, dtype=np.int64).reshape(-1, 2)
+    lengths = valid_intervals[:, 1] - valid_intervals[:, 0]
+    epochs_per_run = np.where(lengths >= epoch_length, (lengths - epoch_length) // stride + 1, 0)
+
+    run_ids = np.repeat(np.arange(len(valid_intervals)), epochs_per_run)
+    first_epoch = np.repeat(np.cumsum(epochs_per_run) - epochs_per_run, epochs_per_run)
+    offsets = (np.arange(run_ids.size) - first_epoch) * stride
+    return valid_intervals[run_ids, 0] + offsets
+
+class EpochIndex:
+    def __init__(self, starts, epoch_length, state=None, valid_intervals=None):
+        """
+        Epoch start samples shared by all channels of a recording.
+
+        Parameters:
+        - starts (array): Start sample of every epoch.
+        - epoch_length (int): Number of data points in every epoch.
+        - state (str): Brain state the epochs were taken from.
+        - valid_intervals (array): The [start, stop) runs the epochs were cut from.
+        """
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.epoch_length = int(epoch_length)
+        self.state = state
+        self.valid_intervals = valid_intervals
+
+    def __len__(self):
+        return self.starts.size
+
+    def epoch(self, data, epoch_index):
+        """Return one epoch of a (channel x) time array as a view."""
+        start = self.starts[epoch_index]
+        return data[..., start:start + self.epoch_length]
+
+    def iter_epochs(self, data):
+        """Yield every epoch of a (channel x) time array as a view."""
+        for epoch_index in range(len(self)):
+            yield self.epoch(data, epoch_index)
+
+    def stack(self, data):
+        """
+        Return all epochs of a (channel x) time array as a (channel x) epoch x time array.
+        This is a view when the epochs are evenly spaced, and a copy otherwise.
+        """
+        data = np.asarray(data)
+        if len(self) == 0:
+            return np.empty(data.shape[:-1] + (0, self.epoch_length), dtype=data.dtype)
+
+        steps = np.diff(self.starts)
+        if steps.size == 0 or np.all(steps == steps[0]):
+            step = int(steps[0]) if steps.size else self.epoch_length
+            first = data[..., self.starts[0]:]
+            shape = data.shape[:-1] + (len(self), self.epoch_length)
+            strides = data.strides[:-1] + (step * data.strides[-1], data.strides[-1])
+            return as_strided(first, shape=shape, strides=strides, writeable=False)
+        return np.stack(list(self.iter_epochs(data)), axis=-2)
+
+def build_epoch_index(n_samples, sleep_scores, audio_timestamps, state, epoch_length, stride=None):
+    '''Compute the valid runs of a brain state once and cut them into epochs of epoch_length, every stride samples.'''
+    with span('epoch', state=state) as s:
+        masks, _ = state_masks(n_samples, sleep_scores, audio_timestamps, states=[state])
+        valid_intervals = mask_to_intervals(masks[state])
+        starts = find_epoch_starts(valid_intervals, epoch_length, stride)
+        s.args['epochs'] = starts.size
+    return EpochIndex(starts, epoch_length, state, valid_intervals)
@@ -0,0 +1,123 @@
+import numpy as np
+import scipy.fft
+from instrumentation import traced
+
+'''This script generates IAAFT (Iterative Amplitude Adjusted Fourier Transform) surrogates,
+a NumPy implementation of iaaft_loop_1d. A surrogate takes its Fourier amplitudes from
+fourier_coeff and its value distribution from sorted_values; the two are imposed in turn
+until both adaptations change the signal by less than error_threshold (relative to the
+standard deviation of the values), or until the total error stops improving.
+iaaft_batch iterates a whole stack of surrogates as one 2-D array with rfft/irfft, so
+generating many surrogates of a channel costs a few batched passes, in double or single precision.
+When using this script, please credit the original contribution:
+V. Venema (2023). Surrogate time series and fields
+(https://www.mathworks.com/matlabcentral/fileexchange/4783-surrogate-time-series-and-fields),
+MATLAB Central File Exchange. Retrieved January 17, 2023.
+Venema, V., Ament, F. & Simmer, C. A Stochastic Iterative Amplitude Adjusted Fourier Transform
+algorithm with improved accuracy. Nonlinear Processes in Geophysics 13, 321-328 (2006).'''
+
+ERROR_THRESHOLD = 2e-4
+SPEED_THRESHOLD = 1e-6  # minimal convergence speed in the total error
+
+def iaaft_loop_1d(fourier_coeff, sorted_values, rng=None, error_threshold=ERROR_THRESHOLD,
+                  speed_threshold=SPEED_THRESHOLD):
+    """
+    Generate one 1-D IAAFT surrogate, as iaaft_loop_1d.
+    Returns the surrogate, the relative amount of the last amplitude adaptation and the
+    relative amount of the last Fourier coefficient adaptation.
+    """
+    rng = np.random.default_rng(rng)
+    fourier_coeff = np.asarray(fourier_coeff, dtype=float)
+    sorted_values = np.asarray(sorted_values, dtype=float)
+    n = sorted_values.size
+    standard_deviation = np.std(sorted_values, ddof=1)
+
+    # Start from a randomly shuffled series with the wanted value distribution
+    y = np.empty(n)
+    y[rng.permutation(n)] = sorted_values
+
+    error_amplitude = 1.0
+    error_spec = 1.0
+    old_total_error = 100.0
+    speed = 1.0
+    while (error_amplitude > error_threshold or error_spec > error_threshold) and speed > speed_threshold:
+        # adapt the power spectrum
+        old_surrogate = y
+        x = np.fft.ifft(y)
+        x = fourier_coeff * np.exp(1j * np.angle(x))
+        y = np.fft.fft(x)
+        error_spec = np.mean(np.abs(y.real - old_surrogate.real)) / standard_deviation
+
+        # adapt the amplitude distribution
+        old_surrogate = y
+        y = np.empty(n)
+        y[np.argsort(old_surrogate.real, kind='stable')] = sorted_values
+        error_amplitude = np.mean(np.abs(y - old_surrogate.real)) / standard_deviation
+
+        total_error = error_spec + error_amplitude
+        speed = abs((old_total_error - total_error) / total_error)
+        old_total_error = total_error
+
+    return y, error_amplitude, error_spec
+
+@traced('iaaft')
+def iaaft_batch(fourier_coeff, sorted_values, initial=None, rng=None, error_threshold=ERROR_THRESHOLD,
+                speed_threshold=SPEED_THRESHOLD, max_iterations=1000, dtype=np.float64):
+    """
+    Generate a stack of IAAFT surrogates at once, iterating them as one 2-D array.
+
+    Parameters:
+    - fourier_coeff (array): The full-length Fourier amplitudes (as in iaaft_loop_1d), shared by all surrogates.
+    - sorted_values (array): N_surr x N_time wanted values of every surrogate, sorted in ascending order.
+    - initial (array): Optional N_surr x N_time starting series (default: a random shuffle of sorted_values).
+    - rng: Random generator or seed used for the default starting series.
+    - max_iterations (int): Safety limit on the number of iterations of any surrogate.
+    - dtype: Float type of the surrogates and their FFTs (np.float32 halves the memory of a batch). Default: np.float64.
+
+    The spectrum is adapted with rfft/irfft and the values are remapped by rank with one argsort over the batch.
+    Every surrogate stops on its own convergence criterion; finished rows are frozen while the others go on.
+    Returns the surrogates, the number of iterations of each surrogate, and the final amplitude and
+    spectral errors of each surrogate.
+    """
+    sorted_values = np.atleast_2d(np.asarray(sorted_values, dtype=dtype))
+    n_surr, n = sorted_values.shape
+    half_coeff = np.asarray(fourier_coeff, dtype=dtype)[:n // 2 + 1]
+    standard_deviation = np.std(sorted_values, axis=1, ddof=1)
+
+    if initial is None:
+        rng = np.random.default_rng(rng)
+        initial = np.empty((n_surr, n), dtype=dtype)
+        for row in range(n_surr):
+            initial[row, rng.permutation(n)] = sorted_values[row]
+    y = np.array(initial, dtype=dtype).reshape(n_surr, n)
+
+    iterations = np.zeros(n_surr, dtype=int)
+    error_amplitude = np.ones(n_surr)
+    error_spec = np.ones(n_surr)
+    old_total_error = np.full(n_surr, 100.0)
+    active = np.arange(n_surr)
+    while active.size and iterations.max() < max_iterations:
+        old_surrogate = y[active]
+
+        # adapt the power spectrum: keep the phases, impose the wanted amplitudes
+        phases = scipy.fft.rfft(old_surrogate, axis=1)
+        phases /= np.where(phases == 0, 1, np.abs(phases))
+        phases[phases == 0] = 1
+        spectral = scipy.fft.irfft(half_coeff * phases, n=n, axis=1) * n
+        error_spec[active] = np.mean(np.abs(spectral - old_surrogate), axis=1) / standard_deviation[active]
+
+        # adapt the amplitude distribution by rank
+        adapted = np.empty_like(spectral)
+        np.put_along_axis(adapted, np.argsort(spectral, axis=1, kind='stable'), sorted_values[active], axis=1)
+        error_amplitude[active] = np.mean(np.abs(adapted - spectral), axis=1) / standard_deviation[active]
+        y[active] = adapted
+        iterations[active] += 1
+
+        total_error = error_spec[active] + error_amplitude[active]
+        speed = np.abs((old_total_error[active] - total_error) / total_error)
+        old_total_error[active] = total_error
+        running = ((error_amplitude[active] > error_threshold) | (error_spec[active] > error_threshold)) \
+            & (speed > speed_threshold)
+        active = active[running]
+
+    return y, iterations, error_amplitude, error_spec
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+'''This script records where the pipeline spends its time, instead of progress strings.
+The stages (load, segment, epoch, wavelet, lavi, iaaft, abba, save) are wrapped in spans:
+    with span('save', path=path) as s:
+        savemat(path, content)
+        s.bytes_written = os.path.getsize(path)
+Every span records its wall time, CPU time, the time spent outside its nested spans (self time),
+the bytes it read and wrote, and its peak resident size: on Linux the peak of the process is reset
+(/proc/self/clear_refs) when the span starts, so peak_rss_bytes is the peak while the span was open
+(including its nested spans). Where the peak cannot be reset, peak_rss_bytes is None and the span records
+process_peak_rss_bytes instead, the peak of the whole process so far (in a long-lived pool worker, of every
+task it ran). Tracing is off by default, and a span then only checks the flag and yields a shared
+placeholder span, whose values are discarded. Once enable() is called, the spans are kept in memory and
+can be written as a Chrome trace-event file (open it in chrome://tracing or https://ui.perfetto.dev) or
+summarised per span name:
+    enable()
+    ...
+    write_chrome_trace('trace.json')
+    print_summary()
+Spans recorded in worker processes are returned by collect() and added to the main process with extend().'''
+
+_STATE = {'enabled': False, 'events': [], 'lock': threading.Lock()}
+_LOCAL = threading.local()
+_CLOCK_OFFSET = time.time() - time.perf_counter()  # perf_counter -> Unix time, so processes share one timeline
+
+def peak_rss():
+    '''Return the peak resident size of the process in bytes (since the last span started, on Linux while tracing).'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # bytes on macOS, kB on Linux
+
+def resident_peak():
+    '''Return the peak resident size since the last reset (VmHWM), or None where it cannot be read.'''
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def reset_resident_peak():
+    '''Reset the peak resident size to the current resident size. Returns whether it could be reset.'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+def enable(enabled=True):
+    '''Turn the recording of spans on (or off).'''
+    _STATE['enabled'] = enabled
+
+def is_enabled():
+    return _STATE['enabled']
+
+class Span:
+    def __init__(self, name, args):
+        """
+        One timed region. bytes_read and bytes_written can be set while the span is open,
+        and args holds any other value to show with the span (e.g. the channel or the file).
+        """
+        self.name = name
+        self.args = args
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.child_seconds = 0.0
+        self.peak_rss = None
+
+_DISABLED = Span('disabled', {})  # yielded by every span while tracing is off; what is set on it is ignored
+
+@contextmanager
+def span(name, bytes_read=0, bytes_written=0, **args):
+    """Time the enclosed block as one span called name (a no-op when tracing is off)."""
+    if not _STATE['enabled']:
+        yield _DISABLED
+        return
+
+    current = Span(name, args)
+    current.bytes_read, current.bytes_written = bytes_read, bytes_written
+    stack = getattr(_LOCAL, 'stack', None)
+    if stack is None:
+        stack = _LOCAL.stack = []
+    # the reset erases the peak of the enclosing span so far, so it is kept in that span first
+    if stack and stack[-1].peak_rss is not None:
+        stack[-1].peak_rss = max(stack[-1].peak_rss, resident_peak() or 0)
+    if reset_resident_peak():
+        current.peak_rss = resident_peak()
+    stack.append(current)
+    start, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield current
+    finally:
+        seconds, cpu = time.perf_counter() - start, time.process_time() - cpu
+        stack.pop()
+        if current.peak_rss is not None:
+            current.peak_rss = max(current.peak_rss, resident_peak() or 0)
+        if stack:
+            stack[-1].child_seconds += seconds
+            if stack[-1].peak_rss is not None and current.peak_rss is not None:
+                stack[-1].peak_rss = max(stack[-1].peak_rss, current.peak_rss)
+        args = {key: value if isinstance(value, (int, float, str, bool)) or value is None else str(value)
+                for key, value in current.args.items()}
+        args.update({'cpu_ms': cpu * 1e3, 'self_ms': (seconds - current.child_seconds) * 1e3,
+                     'bytes_read': int(current.bytes_read), 'bytes_written': int(current.bytes_written),
+                     'peak_rss_bytes': current.peak_rss})
+        if current.peak_rss is None:
+            args['process_peak_rss_bytes'] = peak_rss()
+        event = {'name': name, 'cat': 'pipeline', 'ph': 'X', 'ts': (_CLOCK_OFFSET + start) * 1e6,
+                 'dur': seconds * 1e6, 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+        with _STATE['lock']:
+            _STATE['events'].append(event)
+
+def traced(name=None):
+    '''Decorator running every call of a function in a span (named after the function by default).'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _STATE['enabled']:
+                return func(*args, **kwargs)
+            with span(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def counter(name, **values):
+    '''Record the current value of one or more counters (shown as a graph in the trace viewer).'''
+    if _STATE['enabled']:
+        event = {'name': name, 'cat': 'pipeline', 'ph': 'C', 'ts': time.time() * 1e6, 'pid': os.getpid(),
+                 'tid': threading.get_ident(), 'args': values}
+        with _STATE['lock']:
+            _STATE['events'].append(event)
+
+def events():
+    '''Return a copy of the events recorded so far.'''
+    with _STATE['lock']:
+        return list(_STATE['events'])
+
+def collect():
+    '''Return and forget the events recorded so far (e.g. to send them from a worker to the main process).'''
+    with _STATE['lock']:
+        recorded, _STATE['events'] = _STATE['events'], []
+    return recorded
+
+def extend(recorded):
+    '''Add events recorded elsewhere (e.g. in a worker process).'''
+    with _STATE['lock']:
+        _STATE['events'].extend(recorded)
+
+def reset():
+    '''Forget every recorded event.'''
+    collect()
+
+def write_chrome_trace(path, recorded=None):
+    '''Write the events (default: all recorded) as a Chrome trace-event JSON file.'''
+    recorded = events() if recorded is None else recorded
+    names = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': f'pid {pid}'}}
+             for pid in sorted({event['pid'] for event in recorded})]
+    with open(path, 'w') as file:
+        json.dump({'traceEvents': names + recorded, 'displayTimeUnit': 'ms'}, file)
+
+def summary(recorded=None):
+    """
+    Return one row per span name: number of calls, total and self wall time, CPU time (in seconds),
+    bytes read and written, and the largest peak resident size, sorted by self time.
+    """
+    recorded = events() if recorded is None else recorded
+    rows = [{'span': event['name'], 'wall_s': event['dur'] / 1e6, 'self_s': event['args']['self_ms'] / 1e3,
+             'cpu_s': event['args']['cpu_ms'] / 1e3, 'bytes_read': event['args']['bytes_read'],
+             'bytes_written': event['args']['bytes_written'], 'peak_rss_bytes': event['args']['peak_rss_bytes']}
+            for event in recorded if event['ph'] == 'X']
+    if not rows:
+        return pd.DataFrame(columns=['calls', 'wall_s', 'self_s', 'cpu_s', 'bytes_read', 'bytes_written',
+                                     'peak_rss_bytes'])
+    table = pd.DataFrame(rows).groupby('span').agg(
+        calls=('wall_s', 'size'), wall_s=('wall_s', 'sum'), self_s=('self_s', 'sum'), cpu_s=('cpu_s', 'sum'),
+        bytes_read=('bytes_read', 'sum'), bytes_written=('bytes_written', 'sum'),
+        peak_rss_bytes=('peak_rss_bytes', 'max'))
+    return table.sort_values('self_s', ascending=False)
+
+def print_summary(recorded=None):
+    '''Print the summary table, with the share of the total self time of every span.'''
+    table = summary(recorded)
+    if table.empty:
+        print('No spans recorded')
+        return
+    table = table.assign(share=(table['self_s'] / table['self_s'].sum() * 100).round(1),
+                         read_MB=(table['bytes_read'] / 2 ** 20).round(1),
+                         written_MB=(table['bytes_written'] / 2 ** 20).round(1),
+                         peak_rss_MB=(table['peak_rss_bytes'] / 2 ** 20).round(1))
+    print(table[['calls', 'wall_s', 'self_s', 'share', 'cpu_s', 'read_MB', 'written_MB', 'peak_rss_MB']]
+          .round(3).to_string())
@@ -0,0 +1,154 @@
+import os
+import hashlib
+import tempfile
+from collections import OrderedDict
+import numpy as np
+import scipy.fft
+
+'''This script builds the Morlet wavelets of waveletLight and their frequency-domain kernels,
+and keeps the kernels in a size-bounded LRU cache (KernelBank). Kernels depend only on
+(FFT length, fs, frequency, width, shift), so the same kernels are reused for every channel,
+every epoch and every pink-noise repetition instead of rebuilding the Gaussian taper, the
+carrier, the zero-padding and the FFT each time. A bank can also persist its kernels to a
+folder, so later runs start warm. Kernels can be kept in single precision (complex64) for the
+single-precision mode of lavi; they are built in double precision and rounded once.'''
+
+GWIDTH = 3  # wavelet length in standard deviations, the default used in fieldtrip
+
+def morlet_wavelet(fs, f, width, gwidth=GWIDTH):
+    '''Return the complex Morlet wavelet of waveletLight (Gaussian taper times cos + i*sin carrier).'''
+    dt = 1 / fs
+    st = 1 / (2 * np.pi * (f / width))
+    n = wavelet_length(fs, f, width, gwidth)
+    toi = -gwidth * st + np.arange(n) * dt
+    A = 1 / np.sqrt(st * np.sqrt(np.pi))
+    tap = A * np.exp(-toi ** 2 / (2 * st ** 2))
+    ind = (np.arange(n) - (n - 1) / 2) * (2 * np.pi / fs * f)
+    return tap * np.exp(1j * ind)
+
+def wavelet_length(fs, f, width, gwidth=GWIDTH):
+    '''Return the number of samples of the Morlet wavelet, without building it.'''
+    dt = 1 / fs
+    st = 1 / (2 * np.pi * (f / width))
+    return int(np.floor(2 * gwidth * st / dt + 1e-10)) + 1  # number of samples in -gwidth*st:dt:gwidth*st
+
+def wavelet_offset(n_time, wavelet_length):
+    '''Return the shift of the circular correlation computed by waveletLight for data of n_time samples.'''
+    return n_time % 2 - wavelet_length // 2
+
+# Threads of the FFTs of this module, lavi and lavi_monitor (-1: all cores); pool workers pin it to 1
+_FFT = {'workers': -1}
+
+def fft_workers():
+    '''Return the number of threads the FFTs use.'''
+    return _FFT['workers']
+
+def pin_fft_workers(workers=1):
+    '''Set the number of FFT threads, e.g. to 1 in pool workers, so n workers do not start n x cores threads.'''
+    _FFT['workers'] = workers
+
+def correlation_kernel(n_fft, wavelet, shift, fs):
+    """
+    Return the frequency-domain kernel K of length n_fft such that ifft(fft(x) * K)[i] is
+    sqrt(2 / fs) * sum_j x[(i + shift + j) mod n_fft] * conj(wavelet[j]).
+    """
+    placed = np.zeros(n_fft, dtype=complex)
+    placed[(np.arange(wavelet.size) + shift) % n_fft] = np.conj(wavelet)
+    return scipy.fft.ifft(placed, workers=fft_workers()) * n_fft * np.sqrt(2 / fs)
+
+class KernelBank:
+    def __init__(self, max_bytes=512 * 2 ** 20, cache_dir=None):
+        """
+        LRU cache of frequency-domain Morlet kernels.
+
+        Parameters:
+        - max_bytes (int): Maximum total size of the kernels kept in memory. Default: 512 MB.
+        - cache_dir (str): Optional folder where kernels are persisted and looked up on a memory miss.
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.kernels = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self.kernels)
+
+    def _path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'{name}.npy')
+
+    def _insert(self, key, kernel):
+        kernel.setflags(write=False)
+        self.kernels[key] = kernel
+        self.nbytes += kernel.nbytes
+        while self.nbytes > self.max_bytes and len(self.kernels) > 1:
+            _, evicted = self.kernels.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+
+    def kernel(self, n_fft, fs, f, width, shift, convolution=False, dtype=np.complex128):
+        """
+        Return the kernel of correlation_kernel for the Morlet wavelet of (fs, f, width), building it on a miss.
+        With convolution, the kernel correlates with the reversed conjugate wavelet, i.e. convolves with the
+        wavelet as tfrLight does. dtype is the complex type of the kernel (np.complex64 for single precision).
+        """
+        dtype = np.dtype(dtype)
+        key = (int(n_fft), float(fs), float(f), float(width), int(shift)) + (('convolution',) if convolution else ()) \
+            + ((dtype.name,) if dtype != np.complex128 else ())
+        if key in self.kernels:
+            self.hits += 1
+            self.kernels.move_to_end(key)
+            return self.kernels[key]
+
+        if self.cache_dir and os.path.exists(self._path(key)):
+            self.disk_hits += 1
+            kernel = np.load(self._path(key))
+        else:
+            self.misses += 1
+            wavelet = morlet_wavelet(fs, f, width)
+            kernel = correlation_kernel(n_fft, np.conj(wavelet[::-1]) if convolution else wavelet, shift, fs)
+            kernel = kernel.astype(dtype, copy=False)
+            if self.cache_dir:
+                # written to a file of this writer and renamed, so other processes never load a partial kernel
+                descriptor, temporary_path = tempfile.mkstemp(suffix='.tmp.npy', dir=self.cache_dir)
+                with os.fdopen(descriptor, 'wb') as file:
+                    np.save(file, kernel)
+                os.replace(temporary_path, self._path(key))
+        self._insert(key, kernel)
+        return kernel
+
+    def wavelet_kernel(self, n_time, fs, f, width, dtype=np.complex128):
+        """
+        Return the waveletLight kernel for data of n_time samples and the wavelet length,
+        or None as the kernel when the wavelet is longer than the data.
+        """
+        length = wavelet_length(fs, f, width)
+        if length >= n_time:
+            return None, length
+        return self.kernel(n_time, fs, f, width, wavelet_offset(n_time, length), dtype=dtype), length
+
+    def stats(self):
+        """Return the hit/miss counters and the memory used by the bank."""
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            'kernels': len(self.kernels),
+            'bytes': self.nbytes,
+        }
+
+    def clear(self):
+        """Drop all kernels kept in memory (persisted kernels are kept)."""
+        self.kernels.clear()
+        self.nbytes = 0
+
+DEFAULT_BANK = KernelBank()
@@ -1,6 +1,7 @@
 import os
 import pickle
 import pandas as pd
+from session_catalog import set_quality, query_channels
 
 '''This script labels the quality of tetrode data and update the dataframe with a new column named Quality.'''
 
@@ -46,6 +47,13 @@ def main():
                             48, 52, 56, 60, 66, 68, 72, 77, 80, 84, 
                             90, 92, 96, 101, 105, 111, 112, 118, 122, 125]
 
+    # Update the session catalog in place when it exists; the dataframe below is still updated, as the
+    # downstream scripts read its Quality column
+    catalog_path = "/Users/claudiagoh/Desktop/Course directory/RP1/session_catalog.sqlite"
+    if os.path.exists(catalog_path):
+        set_quality(catalog_path, animal, condition, good_quality_indices)
+        print(query_channels(catalog_path, animal=animal, condition=condition))
+
     # Load the assigned data
     assigned_data = load_assigned_data(animal, condition)
 
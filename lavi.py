@@ -0,0 +1,361 @@
+import time
+import numpy as np
+import scipy.fft
+from kernel_bank import DEFAULT_BANK, wavelet_length, wavelet_offset, fft_workers
+from instrumentation import span
+
+'''This script is a NumPy implementation of Prepare_LAVI, waveletLight, tfrLight and compute_lavi.
+The LAVI (Lagged Angle Vector Index) of a channel at frequency f is
+
+    |sum(sig0 * conj(sig1))| / sqrt(sum(|sig0|^2) * sum(|sig1|^2))
+
+where sig0 is the Morlet wavelet spectrum at f and sig1 the same spectrum lag cycles later.
+waveletLight computes every spectrum as a circular cross-correlation of the data with the
+wavelet through the FFT. Here the FFT of the data is computed once per channel block and
+multiplied by the frequency-domain wavelet kernel of every frequency, so no FFT of the data
+is repeated across frequencies and the lagged inner products are computed for all channels
+at once. Channels containing NaNs (e.g. data kept on the recording timeline with the excised
+stimulus windows and other states as NaN) get the spectrum of tfrLight, as in Prepare_LAVI, but
+through the FFT as well: the gaps are zeroed, the data is convolved with every wavelet through
+one FFT, and the samples whose wavelet touches a gap are dropped from the LAVI sums.
+Given a vector of lags, the lagged sums of every lag are taken from the same spectrum, so a lag
+sweep costs one wavelet transform per frequency.
+Given dtype=np.float32, the data, the kernels and the spectra are single precision (complex64), which
+halves the memory and bandwidth of the transforms; precision_report compares the two modes.'''
+
+DEFAULT_FOI = 10 ** (0.5 + 0.025 * np.arange(47))  # 10.^(0.5:0.025:1.65)
+
+def matlab_round(x):
+    '''Round half away from zero, as MATLAB's round does.'''
+    x = np.asarray(x, dtype=float)
+    return np.sign(x) * np.floor(np.abs(x) + 0.5)
+
+def complex_dtype(dtype):
+    '''Return the complex type of the spectra of data of the given float type (complex64 for float32).'''
+    return np.result_type(dtype, np.complex64)
+
+def valid_range(n_time, wavelet_length):
+    """
+    Return the [start, stop) samples where the wavelet is fully immersed in the data,
+    i.e. the samples waveletLight and tfrLight do not set to NaN.
+    """
+    start = max(int(np.ceil(wavelet_length / 2 - 1)), 0)
+    stop = int(np.ceil(n_time - wavelet_length / 2 - 1))
+    return start, max(stop, start)
+
+def wavelet_kernel(n_time, fs, f, width, kernel_bank=None, dtype=np.complex128):
+    """
+    Return the frequency-domain kernel K of waveletLight at one frequency, such that
+    ifft(fft(data) * K) is the wavelet spectrum of the data (with fftshift and scaling applied).
+    waveletLight zero-pads the wavelet to the centre of the data, multiplies by the conjugate of its
+    FFT and applies fftshift, which is a circular correlation with the wavelet shifted by wavelet_offset.
+    Kernels come from kernel_bank (default: the shared DEFAULT_BANK), in the complex type dtype.
+    Returns the kernel and the wavelet length in samples.
+    """
+    return (DEFAULT_BANK if kernel_bank is None else kernel_bank).wavelet_kernel(n_time, fs, f, width, dtype)
+
+def full_spectrum(data):
+    '''Return the full FFT of real data along the last axis, computed with rfft and Hermitian symmetry.'''
+    n_time = data.shape[-1]
+    half = scipy.fft.rfft(data, axis=-1, workers=fft_workers())
+    return np.concatenate((half, np.conj(half[..., 1:(n_time + 1) // 2][..., ::-1])), axis=-1)
+
+def wavelet_light(data, fs, foi, width=5, kernel_bank=None, dtype=np.float64):
+    '''Return the chan x freq x time wavelet spectrum of waveletLight, with NaN where the wavelet is not fully immersed.'''
+    data = np.atleast_2d(np.asarray(data, dtype=dtype))
+    foi = np.atleast_1d(foi)
+    n_chan, n_time = data.shape
+    spectrum = np.full((n_chan, foi.size, n_time), np.nan, dtype=complex_dtype(dtype))
+    signal_freq = full_spectrum(data)
+    for fi, f in enumerate(foi):
+        kernel, length = wavelet_kernel(n_time, fs, f, width, kernel_bank, complex_dtype(dtype))
+        start, stop = valid_range(n_time, length)
+        if kernel is not None and stop > start:
+            spectrum[:, fi, start:stop] = scipy.fft.ifft(signal_freq * kernel, axis=-1,
+                                                         workers=fft_workers())[:, start:stop]
+    return spectrum
+
+def tfr_frequencies(n_time, fs, foi):
+    '''Round the frequencies to the resolution of the data padded to a power of two seconds, as tfrLight does.'''
+    pad = 2 ** np.ceil(np.log2(n_time / fs))
+    return matlab_round(np.atleast_1d(foi) * pad) / pad
+
+def _gap_runs(gaps):
+    '''Return the channel, first sample and end sample of every run of True in a chan x time mask.'''
+    edges = np.diff(np.pad(gaps, ((0, 0), (1, 1))).view(np.int8), axis=-1)
+    rows, starts = np.nonzero(edges == 1)
+    _, stops = np.nonzero(edges == -1)
+    return rows, starts, stops
+
+def gap_transform(data, fs, foi, width, kernel_bank=None, dtype=np.float64):
+    """
+    Yield, for every frequency of foi (already rounded, see tfr_frequencies), its index, the first sample of
+    the valid range, the chan x valid-range tfrLight spectrum with 0 wherever the wavelet touches a gap, and
+    the channels and samples (relative to the valid range) where it touches a gap.
+    The gaps are set to 0 and the data is zero-padded, so the convolution is one FFT of the data and one
+    kernel multiplication per frequency, as for clean data. The samples touching a gap are found from the
+    gap runs widened by the wavelet support, so the cost of the gaps grows with the gaps, not the data.
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=dtype))
+    n_chan, n_time = data.shape
+    gaps = np.isnan(data)
+    data = np.where(gaps, 0, data - np.nanmean(data, axis=-1, keepdims=True))
+    run_rows, run_starts, run_stops = _gap_runs(gaps)
+    kernel_bank = DEFAULT_BANK if kernel_bank is None else kernel_bank
+
+    lengths = [wavelet_length(fs, f, width) for f in foi if f > 0]
+    n_fft = scipy.fft.next_fast_len(n_time + max(lengths, default=0))
+    signal_freq = scipy.fft.fft(data, n=n_fft, axis=-1, workers=fft_workers())
+    signal_freq /= np.sqrt(2 / fs)  # correlation_kernel is scaled as waveletLight
+    for fi, f in enumerate(foi):
+        if f <= 0:
+            continue
+        length = wavelet_length(fs, f, width)
+        start, stop = valid_range(n_time, length)
+        if stop <= start:
+            continue
+        # conv(x, w, 'same')[t] = sum_j x[t + shift + j] * w[length - 1 - j]
+        shift = length // 2 - length + 1
+        kernel = kernel_bank.kernel(n_fft, fs, f, width, shift, convolution=True, dtype=complex_dtype(dtype))
+        with span('wavelet', f=f):
+            spectrum = scipy.fft.ifft(signal_freq * kernel, axis=-1, workers=fft_workers())[:, start:stop]
+
+        # the support [t + shift, t + shift + length) of sample t overlaps the gap [a, b) for a - shift - length < t < b - shift
+        first = np.clip(run_starts - shift - length + 1, start, stop) - start
+        last = np.clip(run_stops - shift, start, stop) - start
+        counts = last - first
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        touched = np.unique(np.repeat(run_rows * (stop - start) + first, counts) + offsets)
+        rows, cols = np.divmod(touched, stop - start)
+        spectrum[rows, cols] = 0
+        yield fi, start, spectrum, (rows, cols)
+
+def gap_spectra(data, fs, foi, width=5, kernel_bank=None, dtype=np.float64):
+    """
+    Yield the index and the chan x time tfrLight spectrum of every frequency of foi (already rounded, see
+    tfr_frequencies): conv(data, wavelet, 'same') of the demeaned data computed through the FFT, NaN wherever
+    the wavelet touches a NaN or is not fully immersed.
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=dtype))
+    for fi, start, spectrum_fi, (rows, cols) in gap_transform(data, fs, foi, width, kernel_bank, dtype):
+        spectrum = np.full(data.shape, np.nan, dtype=complex_dtype(dtype))
+        spectrum[:, start:start + spectrum_fi.shape[1]] = spectrum_fi
+        spectrum[rows, start + cols] = np.nan
+        yield fi, spectrum
+
+def tfr_light(data, fs, foi, width=5, kernel_bank=None, dtype=np.float64):
+    """
+    Return the chan x freq x time wavelet spectrum of tfrLight: convolution of the demeaned data with the
+    wavelet, keeping NaNs wherever the wavelet touches a NaN or is not fully immersed (see gap_spectra).
+    As in tfrLight, the frequencies are rounded to the resolution of the data padded to a power of two
+    seconds. Returns the spectrum and the rounded frequencies.
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=dtype))
+    n_chan, n_time = data.shape
+    foi = tfr_frequencies(n_time, fs, foi)
+    foi = foi[foi > 0]
+
+    spectrum = np.full((n_chan, foi.size, n_time), np.nan, dtype=complex_dtype(dtype))
+    for fi, spectrum_fi in gap_spectra(data, fs, foi, width, kernel_bank, dtype):
+        spectrum[:, fi] = spectrum_fi
+    return spectrum, foi
+
+def lag_samples(fs, f, lag):
+    '''Return the lag, given in cycles of f, in samples.'''
+    return int(matlab_round(lag / f * fs))
+
+def lagged_sums(spectrum, lag):
+    """
+    Return the three LAVI sums of a (chan x) time spectrum at a lag in samples:
+    sum(sig0 * conj(sig1)), sum(|sig0|^2) and sum(|sig1|^2), over the time points where
+    both sig0 and sig1 are defined (NaNs are removed based on the first channel, as in compute_lavi).
+    """
+    spectrum = np.atleast_2d(spectrum)
+    n_pairs = max(spectrum.shape[-1] - lag, 0)
+    if np.isnan(spectrum[0]).any():
+        keep = ~(np.isnan(spectrum[0, :n_pairs]) | np.isnan(spectrum[0, lag:lag + n_pairs]))
+        sig0 = spectrum[:, :n_pairs][:, keep]
+        sig1 = spectrum[:, lag:lag + n_pairs][:, keep]
+    else:
+        sig0 = spectrum[:, :n_pairs]
+        sig1 = spectrum[:, lag:lag + n_pairs]
+
+    cross = np.array([np.vdot(sig1[ch], sig0[ch]) for ch in range(sig0.shape[0])], dtype=complex)
+    energy0 = _energy(sig0)
+    energy1 = _energy(sig1)
+    return cross, energy0, energy1
+
+def _energy(spectrum):
+    '''Return sum(|spectrum|^2) over the last axis without allocating a magnitude array.'''
+    if spectrum.dtype == np.complex128:
+        interleaved = spectrum.view(np.float64)
+        return np.einsum('ct,ct->c', interleaved, interleaved)
+    # einsum accumulates single precision in one running sum, the BLAS dot of every channel keeps it accurate
+    return np.array([np.dot(row, row) for row in spectrum.view(np.float32)], dtype=float)
+
+def lavi_from_sums(cross, energy0, energy1):
+    '''Combine the three LAVI sums into the LAVI value (NaN when there are no lagged pairs).'''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.abs(cross) / np.sqrt(energy0 * energy1)
+
+def compute_lavi(spectrum, fs, f, lags=1.5):
+    """
+    Generate the LAVI of one frequency over all channels.
+    spectrum is the complex chan x time wavelet spectrum at frequency f (e.g. one frequency of wavelet_light),
+    fs the sampling frequency of the spectrum and lags the lag in cycles: one lag (returns N_chan values)
+    or a vector of lags (returns N_chan x N_lag values, all from the same spectrum).
+    """
+    if np.ndim(lags) == 0:
+        return lavi_from_sums(*lagged_sums(spectrum, lag_samples(fs, f, lags)))
+    return np.stack([lavi_from_sums(*lagged_sums(spectrum, lag_samples(fs, f, lag))) for lag in lags], axis=-1)
+
+def _lavi_fft(data, fs, foi, lags, width, kernel_bank=None):
+    '''LAVI (chan x freq x lag) of NaN-free channels: one FFT per channel block, one kernel per frequency.'''
+    n_chan, n_time = data.shape
+    LAVI = np.full((n_chan, foi.size, lags.size), np.nan)
+    signal_freq = full_spectrum(data)
+    for fi, f in enumerate(foi):
+        kernel, length = wavelet_kernel(n_time, fs, f, width, kernel_bank, signal_freq.dtype)
+        start, stop = valid_range(n_time, length)
+        if kernel is None or stop <= start:
+            continue
+        with span('wavelet', f=f):
+            spectrum = scipy.fft.ifft(signal_freq * kernel, axis=-1, workers=fft_workers())[:, start:stop]
+        for li, lag in enumerate(lags):
+            LAVI[:, fi, li] = lavi_from_sums(*lagged_sums(spectrum, lag_samples(fs, f, lag)))
+    return LAVI
+
+def prepare_lavi(data, foi=DEFAULT_FOI, fs=1000, lag=1.5, width=5, verbose=True, kernel_bank=None, dtype=np.float64):
+    """
+    Compute the N_chan x N_freq LAVI profile of raw data (N_chan x N_time), as Prepare_LAVI.
+
+    Parameters:
+    - data (array): N_chan x N_time raw data.
+    - foi (array): Frequencies of interest. Default: 10.^(0.5:0.025:1.65).
+    - fs (float): Sampling frequency. Default: 1000 Hz.
+    - lag (float or array): The time delay between the data and the copy of itself, in cycles. Default: 1.5.
+      Given a vector of lags, every wavelet transform is computed once and used for all lags, and the LAVI
+      is returned as N_chan x N_freq x N_lag.
+    - width (float): The width, in cycles, of the wavelet. Default: 5.
+    - verbose (bool): Whether to display messages on screen. Default: True.
+    - kernel_bank (KernelBank): Cache of wavelet kernels. Default: the shared DEFAULT_BANK.
+    - dtype: Float type of the computation and of the returned LAVI. np.float32 computes the spectra in
+      complex64 (e.g. straight from the float32 RecordingStore). Default: np.float64.
+    """
+    tic = time.time()
+    data = np.atleast_2d(np.asarray(data, dtype=dtype))
+    foi = np.atleast_1d(np.asarray(foi, dtype=float))
+    lags = np.atleast_1d(np.asarray(lag, dtype=float))
+    LAVI = np.full((data.shape[0], foi.size, lags.size), np.nan, dtype=dtype)
+
+    with span('lavi', channels=data.shape[0], samples=data.shape[1], frequencies=foi.size):
+        has_nan = np.isnan(data).any(axis=1)
+        if (~has_nan).any():
+            LAVI[~has_nan] = _lavi_fft(data[~has_nan], fs, foi, lags, width, kernel_bank)
+        if has_nan.any():
+            LAVI[has_nan] = _lavi_gaps(data[has_nan], fs, foi, lags, width, kernel_bank)
+
+    if verbose:
+        print(f'The call to prepare_lavi took {time.time() - tic:.3g} seconds')
+    return LAVI[..., 0] if np.ndim(lag) == 0 else LAVI
+
+def _lavi_gaps(data, fs, foi, lags, width, kernel_bank=None):
+    """
+    LAVI (chan x freq x lag) of channels containing NaNs (gaps), from the tfrLight spectra of gap_spectra. Only the lagged pairs
+    where both samples are defined enter the sums, per channel, so all channels are processed together.
+    The spectrum is 0 where it is not defined, so the cross sum needs no mask, and each energy sum is the
+    sum over all samples minus the samples whose partner is not defined.
+    """
+    n_chan, n_time = data.shape
+    LAVI = np.full((n_chan, foi.size, lags.size), np.nan)
+    for fi, _, spectrum, (rows, cols) in gap_transform(data, fs, tfr_frequencies(n_time, fs, foi), width,
+                                                        kernel_bank, data.dtype):
+        for li, lag in enumerate(lags):
+            lag_fi = lag_samples(fs, foi[fi], lag)
+            n_pairs = max(spectrum.shape[1] - lag_fi, 0)
+            sig0, sig1 = spectrum[:, :n_pairs], spectrum[:, lag_fi:lag_fi + n_pairs]
+            cross = np.array([np.vdot(sig1[ch], sig0[ch]) for ch in range(n_chan)], dtype=complex)
+            # sig0[t] loses its partner when t + lag is not defined, sig1[t] when t is not defined
+            energies, lost = [], []
+            for sig, partner in [(sig0, cols - lag_fi), (sig1, cols)]:
+                keep = (partner >= 0) & (partner < n_pairs)
+                unpaired = np.bincount(rows[keep], np.abs(sig[rows[keep], partner[keep]]) ** 2, minlength=n_chan)
+                energies.append(_energy(sig) - unpaired)
+                lost.append(rows[keep] * n_pairs + partner[keep])
+            n_lost = np.bincount(np.unique(np.concatenate(lost)) // max(n_pairs, 1), minlength=n_chan)
+            LAVI[:, fi, li] = np.where(n_lost < n_pairs, lavi_from_sums(cross, *energies), np.nan)
+    return LAVI
+
+def _read_circular(data, start, stop, dtype=np.float64):
+    '''Read samples [start, stop) of a chan x time array as dtype, wrapping around its ends like a circular signal.'''
+    n_time = data.shape[-1]
+    if start >= 0 and stop <= n_time:
+        return np.asarray(data[:, start:stop], dtype=dtype)
+    return np.asarray(data[:, np.arange(start, stop) % n_time], dtype=dtype)
+
+def prepare_lavi_blockwise(data, foi=DEFAULT_FOI, fs=1000, lag=1.5, width=5, block_size=2 ** 16, verbose=True,
+                           kernel_bank=None, dtype=np.float64):
+    """
+    Compute the same N_chan x N_freq LAVI as prepare_lavi, reading the recording in blocks of block_size samples.
+    Every block is transformed with overlap-save (one FFT per block, one kernel per frequency) and only the three
+    LAVI sums are accumulated per channel and frequency, so peak memory depends on block_size and the number of
+    frequencies, not on the recording length. data can be a np.memmap (e.g. RecordingStore.read()).
+    Channels containing NaNs are returned as NaN. A vector of lags gives an N_chan x N_freq x N_lag LAVI, as in
+    prepare_lavi. dtype is as in prepare_lavi; the sums of the blocks are accumulated in double precision.
+    """
+    tic = time.time()
+    foi = np.atleast_1d(np.asarray(foi, dtype=float))
+    n_chan, n_time = data.shape
+    kernel_bank = DEFAULT_BANK if kernel_bank is None else kernel_bank
+    lengths = np.array([wavelet_length(fs, f, width) for f in foi])
+    lags = np.array([[lag_samples(fs, f, lag_li) for lag_li in np.atleast_1d(lag)] for f in foi])  # freq x lag
+
+    # Every block computes the spectrum of block_size + max(lags) samples, from a segment extended by
+    # half the longest wavelet on both sides
+    margin = int(lengths.max() // 2 + 1)
+    n_out = block_size + int(lags.max())
+    n_fft = scipy.fft.next_fast_len(n_out + 2 * margin)
+
+    cross = np.zeros((n_chan,) + lags.shape, dtype=complex)
+    energy0 = np.zeros((n_chan,) + lags.shape)
+    energy1 = np.zeros((n_chan,) + lags.shape)
+    has_nan = np.zeros(n_chan, dtype=bool)
+
+    with span('lavi', channels=n_chan, samples=n_time, frequencies=foi.size, block_size=block_size):
+        for block_start in range(0, n_time, block_size):
+            block_stop = min(block_start + block_size, n_time)
+            with span('load', bytes_read=n_chan * (n_out + 2 * margin) * data.dtype.itemsize):
+                segment = _read_circular(data, block_start - margin, block_start + n_out + margin, dtype)
+            has_nan |= np.isnan(segment[:, margin:margin + block_stop - block_start]).any(axis=1)
+            with span('wavelet', block=block_start):
+                signal_freq = scipy.fft.fft(segment, n=n_fft, axis=-1, workers=fft_workers())
+
+            for fi in range(foi.size):
+                length = lengths[fi]
+                start, stop = valid_range(n_time, length)
+                if length >= n_time or min(block_stop, stop - lags[fi].min()) <= max(block_start, start):
+                    continue
+                kernel = kernel_bank.kernel(n_fft, fs, foi[fi], width, margin + wavelet_offset(n_time, length),
+                                            dtype=complex_dtype(dtype))
+                with span('wavelet', f=foi[fi], block=block_start):
+                    spectrum = scipy.fft.ifft(signal_freq * kernel, axis=-1, workers=fft_workers())
+                for li, lag_fi in enumerate(lags[fi]):
+                    t0, t1 = max(block_start, start), min(block_stop, stop - lag_fi)
+                    if t1 <= t0:
+                        continue
+                    sig0 = spectrum[:, t0 - block_start:t1 - block_start]
+                    sig1 = spectrum[:, t0 - block_start + lag_fi:t1 - block_start + lag_fi]
+                    cross[:, fi, li] += [np.vdot(sig1[ch], sig0[ch]) for ch in range(n_chan)]
+                    energy0[:, fi, li] += _energy(sig0)
+                    energy1[:, fi, li] += _energy(sig1)
+
+    LAVI = lavi_from_sums(cross, energy0, energy1).astype(dtype)
+    if np.ndim(lag) == 0:
+        LAVI = LAVI[..., 0]
+    if has_nan.any():
+        print(f'Warning: channels {np.flatnonzero(has_nan).tolist()} contain NaNs, their LAVI is set to NaN.')
+        LAVI[has_nan] = np.nan
+
+    if verbose:
+        print(f'The call to prepare_lavi_blockwise took {time.time() - tic:.3g} seconds')
+    return LAVI
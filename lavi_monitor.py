@@ -0,0 +1,256 @@
+import os
+import time
+import argparse
+import numpy as np
+import scipy.fft
+from kernel_bank import DEFAULT_BANK, wavelet_length, fft_workers
+from lavi import DEFAULT_FOI, lag_samples, lavi_from_sums
+from recording_store import RecordingStore
+from instrumentation import span
+
+'''This script follows the LAVI of a recording while it is being acquired, instead of after the session.
+1. LaviMonitor.push() appends every incoming block of LFP (chan x samples) to a per-channel ring buffer
+2. Every hop (1 s by default) of new data, the spectra of the hop are computed with overlap-save: one FFT
+   of the hop extended by half the longest wavelet on both sides, one kernel per frequency (the tfrLight
+   convolution, as gap_transform)
+3. The three LAVI sums (lagged cross product and the two energies) of the hop are added to exponentially
+   weighted sums per channel and frequency, so older hops fade with the given half-life
+4. Every publish_every seconds of data, the LAVI profile (chan x freq) is published to a callback
+The wavelets need half their length of data after a sample, and the lagged pairs need the lag, so the
+published profile ends margin + max(lag) samples (about 4 s at 1 Hz with width 5 and a lag of 1.5 cycles)
+before the newest sample received, plus at most one hop: the latency is bounded and does not grow with the
+recording. The data is not demeaned (the Morlet wavelet has almost no response at 0 Hz) and NaNs are set to 0.
+ReplaySource feeds a stored session block by block at 1x or faster than real time, to test the monitor:
+    python lavi_monitor.py path/to/session --speed 10'''
+
+class RingBuffer:
+    def __init__(self, n_chan, capacity):
+        """
+        Fixed-size chan x capacity buffer of the newest samples of a stream.
+
+        Parameters:
+        - n_chan (int): Number of channels.
+        - capacity (int): Number of samples kept per channel.
+        """
+        self.data = np.zeros((n_chan, capacity))
+        self.capacity = capacity
+        self.total = 0  # samples written since the start of the stream
+
+    def write(self, block):
+        '''Append a chan x samples block, overwriting the oldest samples.'''
+        block = np.asarray(block, dtype=float)[:, -self.capacity:]
+        n = block.shape[1]
+        first = self.total % self.capacity
+        head = min(n, self.capacity - first)
+        self.data[:, first:first + head] = block[:, :head]
+        self.data[:, :n - head] = block[:, head:]
+        self.total += n
+
+    def read(self, start, stop):
+        '''Return samples [start, stop) of the stream (counted from its start), which must still be in the buffer.'''
+        if start < self.total - self.capacity or stop > self.total:
+            raise ValueError(f'Samples {start}-{stop} are not in the buffer '
+                             f'({max(self.total - self.capacity, 0)}-{self.total})')
+        return self.data[:, np.arange(start, stop) % self.capacity]
+
+class LaviMonitor:
+    def __init__(self, n_chan, foi=DEFAULT_FOI, fs=1000, lag=1.5, width=5, half_life=60.0, hop=1.0,
+                 publish_every=5.0, on_publish=None, kernel_bank=None):
+        """
+        Streaming LAVI of every channel and frequency, exponentially weighted over time.
+
+        Parameters:
+        - n_chan (int): Number of channels of the stream.
+        - foi, fs, lag, width, kernel_bank: As in prepare_lavi (a single lag).
+        - half_life (float): Seconds after which the weight of a hop is halved. None keeps every hop with the
+          same weight (the LAVI of the whole stream). Default: 60.
+        - hop (float): Seconds of data transformed together. Longer hops cost less per sample and add latency.
+          Default: 1.
+        - publish_every (float): Seconds of data between published profiles (rounded to whole hops). Default: 5.
+        - on_publish (function): Called with every publication (see publish); by default it is only kept in
+          self.published.
+        """
+        self.n_chan = n_chan
+        self.foi = np.atleast_1d(np.asarray(foi, dtype=float))
+        self.fs = fs
+        self.width = width
+        self.kernel_bank = DEFAULT_BANK if kernel_bank is None else kernel_bank
+        self.lengths = np.array([wavelet_length(fs, f, width) for f in self.foi])
+        self.lags = np.array([lag_samples(fs, f, lag) for f in self.foi])
+        self.hop = max(int(round(hop * fs)), 1)
+        self.hops_per_publication = max(int(round(publish_every * fs / self.hop)), 1)
+        self.decay = 1.0 if half_life is None else 0.5 ** (self.hop / fs / half_life)
+        self.on_publish = on_publish
+
+        # Every hop computes the spectrum of hop + max(lags) samples, from a segment extended by half the
+        # longest wavelet on both sides, as prepare_lavi_blockwise
+        self.margin = int(self.lengths.max() // 2 + 1)
+        self.n_segment = self.hop + int(self.lags.max()) + 2 * self.margin
+        self.n_fft = scipy.fft.next_fast_len(self.n_segment)
+        self.buffer = RingBuffer(n_chan, 2 * self.n_segment)
+
+        self.cross = np.zeros((n_chan, self.foi.size), dtype=complex)
+        self.energy0 = np.zeros((n_chan, self.foi.size))
+        self.energy1 = np.zeros((n_chan, self.foi.size))
+        self.position = self.margin  # first sample of the next hop
+        self.hops = 0
+        self.published = []
+
+    @property
+    def delay(self):
+        '''Largest number of seconds between the newest sample received and the end of a published profile.'''
+        return (self.n_segment - self.margin) / self.fs
+
+    def push(self, block, received=None):
+        """
+        Add a chan x samples block to the stream, process every hop it completes and return the publications
+        it triggered. received is the time.perf_counter() the block arrived at (default: now), from which the
+        latency of the publications is measured.
+        """
+        received = time.perf_counter() if received is None else received
+        block = np.asarray(block, dtype=float)
+        if block.shape[0] != self.n_chan:
+            raise ValueError(f'Expected {self.n_chan} channels, got {block.shape[0]}')
+        if np.isnan(block).any():
+            block = np.nan_to_num(block)
+        published = []
+        # blocks longer than the buffer are written in pieces, processing the hops in between
+        for first in range(0, block.shape[1], self.hop):
+            self.buffer.write(block[:, first:first + self.hop])
+            while self.buffer.total >= self.position - self.margin + self.n_segment:
+                self._process_hop()
+                if self.hops % self.hops_per_publication == 0:
+                    published.append(self.publish(received))
+        return published
+
+    def _process_hop(self):
+        '''Add the weighted LAVI sums of the lagged pairs starting in [position, position + hop).'''
+        with span('lavi_monitor', hop=self.hops):
+            segment = self.buffer.read(self.position - self.margin, self.position - self.margin + self.n_segment)
+            signal_freq = scipy.fft.fft(segment, n=self.n_fft, axis=-1, workers=fft_workers())
+            self.cross *= self.decay
+            self.energy0 *= self.decay
+            self.energy1 *= self.decay
+            for fi, f in enumerate(self.foi):
+                length, lag_fi = self.lengths[fi], self.lags[fi]
+                # conv(x, w, 'same')[t] = sum_j x[t + shift + j] * w[length - 1 - j], from the start of the hop
+                shift = self.margin + length // 2 - length + 1
+                kernel = self.kernel_bank.kernel(self.n_fft, self.fs, f, self.width, shift, convolution=True)
+                with span('wavelet', f=f):
+                    spectrum = scipy.fft.ifft(signal_freq * kernel, axis=-1, workers=fft_workers())
+                sig0, sig1 = spectrum[:, :self.hop], spectrum[:, lag_fi:lag_fi + self.hop]
+                self.cross[:, fi] += np.einsum('ct,ct->c', sig0, np.conj(sig1))
+                self.energy0[:, fi] += np.einsum('ct,ct->c', sig0.real, sig0.real) + \
+                    np.einsum('ct,ct->c', sig0.imag, sig0.imag)
+                self.energy1[:, fi] += np.einsum('ct,ct->c', sig1.real, sig1.real) + \
+                    np.einsum('ct,ct->c', sig1.imag, sig1.imag)
+        self.position += self.hop
+        self.hops += 1
+
+    def profile(self):
+        '''Return the current chan x freq LAVI (NaN before the first hop).'''
+        if self.hops == 0:
+            return np.full((self.n_chan, self.foi.size), np.nan)
+        return lavi_from_sums(self.cross, self.energy0, self.energy1)
+
+    def publish(self, received=None):
+        """
+        Publish the current profile as a dictionary: 'LAVI' (chan x freq), 'time' (seconds of the stream the
+        last lagged pairs start at), 'delay' (seconds of data received after them) and 'latency' (seconds
+        since the block that completed the hop arrived), pass it to on_publish and keep it in self.published.
+        """
+        publication = {'LAVI': self.profile(), 'time': self.position / self.fs,
+                       'delay': (self.buffer.total - self.position) / self.fs,
+                       'latency': time.perf_counter() - received if received is not None else 0.0}
+        self.published.append(publication)
+        if self.on_publish is not None:
+            self.on_publish(publication)
+        return publication
+
+class ReplaySource:
+    def __init__(self, data, fs=1000, block_size=100, speed=1.0, start=0, stop=None):
+        """
+        Feed a stored recording block by block, paced as if it were being acquired.
+
+        Parameters:
+        - data (array): N_chan x N_time recording, e.g. RecordingStore.read() (a memmap is read block by block).
+        - fs (int): Sampling frequency. Default: 1000.
+        - block_size (int): Number of samples per block. Default: 100 (100 ms at 1000 Hz).
+        - speed (float): Multiple of real time the blocks are delivered at. None delivers them as fast as
+          they are consumed. Default: 1.
+        - start, stop (int): Samples of the recording to replay. Default: all of it.
+        """
+        self.data = data
+        self.fs = fs
+        self.block_size = block_size
+        self.speed = speed
+        self.start = start
+        self.stop = data.shape[1] if stop is None else min(stop, data.shape[1])
+        self.late_blocks = 0  # blocks delivered after their due time, because the consumer was too slow
+
+    def __iter__(self):
+        '''Yield every chan x samples block when it is due (block k at (k + 1) * block_size / fs / speed seconds).'''
+        clock = time.perf_counter()
+        for first in range(self.start, self.stop, self.block_size):
+            last = min(first + self.block_size, self.stop)
+            if self.speed:
+                due = clock + (last - self.start) / self.fs / self.speed
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                else:
+                    self.late_blocks += 1
+            yield np.asarray(self.data[:, first:last], dtype=float)
+
+def run_replay(source, monitor):
+    '''Push every block of source into monitor and return the publications.'''
+    published = []
+    for block in source:
+        published.extend(monitor.push(block))
+    return published
+
+def print_publication(foi, channels=None):
+    '''Return an on_publish function printing the peak of the LAVI averaged across channels.'''
+    def on_publish(publication):
+        LAVI = publication['LAVI'] if channels is None else publication['LAVI'][channels]
+        mean = np.nanmean(LAVI, axis=0)
+        peak = int(np.nanargmax(mean)) if np.isfinite(mean).any() else 0
+        print(f'{publication["time"]:9.1f} s  peak LAVI {mean[peak]:.3f} at {foi[peak]:.2f} Hz  '
+              f'(delay {publication["delay"]:.2f} s, latency {publication["latency"] * 1e3:.1f} ms)')
+    return on_publish
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a packed session through the streaming LAVI monitor.')
+    parser.add_argument('session', help='folder of the packed session (session.dat and session.json)')
+    parser.add_argument('--area', help='only replay the channels of this area')
+    parser.add_argument('--quality', help='only replay the channels of this quality label, e.g. Good')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='multiple of real time, 0 for as fast as possible (default: 1)')
+    parser.add_argument('--duration', type=float, help='seconds of the session to replay (default: all)')
+    parser.add_argument('--block', type=float, default=0.1, help='seconds per incoming block (default: 0.1)')
+    parser.add_argument('--half-life', type=float, default=60.0, help='half-life of the LAVI sums in s (default: 60)')
+    parser.add_argument('--publish-every', type=float, default=5.0, help='seconds between profiles (default: 5)')
+    args = parser.parse_args(argv)
+
+    store = RecordingStore(args.session)
+    channels = store.select(area=args.area, quality=args.quality)
+    if not channels:
+        print(f'No channel of {os.path.basename(args.session)} matches the selection.')
+        return
+    fs = store.fs
+    foi = 10 ** (0.025 * np.arange(65))  # 10.^(log10(1):0.025:log10(40))
+    monitor = LaviMonitor(len(channels), foi, fs, half_life=args.half_life, publish_every=args.publish_every)
+    monitor.on_publish = print_publication(monitor.foi)
+    stop = None if args.duration is None else int(args.duration * fs)
+    source = ReplaySource(store.read(channels), fs, int(args.block * fs), args.speed or None, stop=stop)
+    print(f'Replaying {len(channels)} channels at {args.speed or "full"} speed, '
+          f'profiles end at most {monitor.delay:.2f} s before the newest sample')
+
+    published = run_replay(source, monitor)
+    if published:
+        latency = np.array([publication['latency'] for publication in published]) * 1e3
+        print(f'{len(published)} profiles, latency median {np.median(latency):.1f} ms, max {latency.max():.1f} ms, '
+              f'{source.late_blocks} blocks delivered late')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import os
+import json
+import pickle
+import numpy as np
+from recording_store import open_session, list_channel_files, DATA_FILE
+
+'''This script builds min/max level-of-detail pyramids of LFP channels, so a viewer can draw any stretch
+of a session without reading every sample in it.
+1. Level 0 holds the minimum and maximum of every bucket of BASE_BUCKET samples, computed while streaming
+   the channel in blocks; every next level merges FACTOR buckets of the previous one, until a level has
+   fewer than MIN_BUCKETS buckets
+2. Every level is saved as a .npy file (buckets x 2, float32) in a pyramid folder next to the data, with a
+   JSON sidecar listing the bucket sizes, the length and the modification time of the source (the packed
+   session or the pickle) of every channel; a pyramid older than its source is rebuilt
+3. Pyramid.window() reads, as a memory map, only the level whose buckets are closest to one per pixel
+   of the window, and returns the min/max envelope as a line (min, max, min, max, ...); below one bucket
+   per pixel the raw samples are returned
+Channels of a packed session are read from the RecordingStore; channels only available as pickles are
+unpickled once, when their pyramid is built, and their samples are kept as a float32 .npy beside it.'''
+
+PYRAMID_FOLDER = 'pyramid'
+METADATA_FILE = 'pyramid.json'
+BASE_BUCKET = 16
+FACTOR = 4
+MIN_BUCKETS = 1024
+
+def bucket_sizes(n_samples, base=BASE_BUCKET, factor=FACTOR, min_buckets=MIN_BUCKETS):
+    '''Return the bucket size (in samples) of every level of the pyramid of a channel of n_samples.'''
+    sizes = [base]
+    while -(-n_samples // (sizes[-1] * factor)) >= min_buckets:
+        sizes.append(sizes[-1] * factor)
+    return sizes
+
+def minmax_buckets(data, bucket, block_size=2 ** 22):
+    '''Return the buckets x 2 minimum and maximum of every bucket of a 1-D array, read in blocks of whole buckets.'''
+    n_samples = data.shape[0]
+    block_size = max(block_size // bucket, 1) * bucket
+    minmax = np.empty((-(-n_samples // bucket), 2), dtype=np.float32)
+    for start in range(0, n_samples, block_size):
+        block = np.asarray(data[start:start + block_size], dtype=np.float32)
+        tail = -block.size % bucket
+        if tail:  # the last bucket is completed with its last sample
+            block = np.concatenate((block, np.repeat(block[-1:], tail)))
+        block = block.reshape(-1, bucket)
+        first = start // bucket
+        minmax[first:first + block.shape[0], 0] = block.min(axis=1)
+        minmax[first:first + block.shape[0], 1] = block.max(axis=1)
+    return minmax
+
+def merge_buckets(minmax, factor=FACTOR):
+    '''Return the next level of a pyramid: the minimum and maximum of every factor buckets.'''
+    tail = -minmax.shape[0] % factor
+    if tail:
+        minmax = np.concatenate((minmax, np.repeat(minmax[-1:], tail, axis=0)))
+    grouped = minmax.reshape(-1, factor, 2)
+    return np.stack((grouped[:, :, 0].min(axis=1), grouped[:, :, 1].max(axis=1)), axis=1)
+
+def level_path(folder, channel, bucket):
+    return os.path.join(folder, PYRAMID_FOLDER, f'{channel}_{bucket}.npy')
+
+def raw_path(folder, channel):
+    return os.path.join(folder, PYRAMID_FOLDER, f'{channel}_raw.npy')
+
+def build_pyramid(data, folder, channel, keep_raw=False, source=None):
+    """
+    Build and save the pyramid of one channel (a 1-D array or memmap) in folder/pyramid, and return its
+    bucket sizes. With keep_raw, the samples are also saved as float32, to be memory-mapped by the viewer.
+    source is the file the data was read from, whose modification time is kept to detect outdated pyramids.
+    """
+    os.makedirs(os.path.join(folder, PYRAMID_FOLDER), exist_ok=True)
+    n_samples = data.shape[0]
+    sizes = bucket_sizes(n_samples)
+    minmax = minmax_buckets(data, sizes[0])
+    np.save(level_path(folder, channel, sizes[0]), minmax)
+    for bucket in sizes[1:]:
+        minmax = merge_buckets(minmax)
+        np.save(level_path(folder, channel, bucket), minmax)
+    if keep_raw:
+        np.save(raw_path(folder, channel), np.asarray(data, dtype=np.float32))
+
+    metadata_path = os.path.join(folder, PYRAMID_FOLDER, METADATA_FILE)
+    metadata = {'channels': {}}
+    if os.path.exists(metadata_path):
+        with open(metadata_path) as file:
+            metadata = json.load(file)
+    metadata['channels'][str(channel)] = {'n_samples': int(n_samples), 'buckets': sizes, 'raw': keep_raw,
+                                          'source_mtime': os.path.getmtime(source) if source else None}
+    with open(metadata_path + '.tmp', 'w') as file:
+        json.dump(metadata, file, indent=2)
+    os.replace(metadata_path + '.tmp', metadata_path)
+    return sizes
+
+class Pyramid:
+    def __init__(self, folder):
+        """
+        Read-only access to the pyramids of the channels of one folder (a session folder).
+
+        Parameters:
+        - folder (str): Folder holding the pyramid folder, e.g. the folder of the packed session or the pickles.
+        """
+        self.folder = folder
+        self.channels = {}
+        self.levels = {}
+        metadata_path = os.path.join(folder, PYRAMID_FOLDER, METADATA_FILE)
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as file:
+                self.channels = json.load(file)['channels']
+
+    def __contains__(self, channel):
+        return str(channel) in self.channels
+
+    def n_samples(self, channel):
+        return self.channels[str(channel)]['n_samples']
+
+    def is_current(self, channel, source, n_samples=None):
+        '''Check whether the pyramid of a channel was built from source as it is now (and has n_samples, if given).'''
+        info = self.channels.get(str(channel))
+        if info is None or (n_samples is not None and info['n_samples'] != n_samples):
+            return False
+        return info.get('source_mtime') == os.path.getmtime(source)
+
+    def level(self, channel, bucket):
+        '''Return one level (buckets x 2) of a channel as a memory map, opened on first use.'''
+        key = (str(channel), bucket)
+        if key not in self.levels:
+            path = level_path(self.folder, channel, bucket) if bucket else raw_path(self.folder, channel)
+            self.levels[key] = np.load(path, mmap_mode='r')
+        return self.levels[key]
+
+    def window(self, channel, start, stop, pixels, raw=None):
+        """
+        Return the x (sample) and y values to draw samples [start, stop) of a channel on pixels columns:
+        the min/max envelope of the level with about one bucket per pixel, or the raw samples (from raw, e.g.
+        a RecordingStore row, or the saved float32 copy) when there are fewer than BASE_BUCKET samples per pixel.
+        Also returns the bucket size used (1 for raw samples).
+        """
+        info = self.channels[str(channel)]
+        start, stop = max(int(start), 0), min(int(stop), info['n_samples'])
+        if stop <= start:
+            return np.empty(0), np.empty(0), 1
+        per_pixel = (stop - start) / max(pixels, 1)
+        if per_pixel < info['buckets'][0] and (raw is not None or info['raw']):
+            samples = raw if raw is not None else self.level(channel, 0)
+            return np.arange(start, stop), np.asarray(samples[start:stop]), 1
+
+        bucket = max([size for size in info['buckets'] if size <= per_pixel], default=info['buckets'][0])
+        first, last = start // bucket, -(-stop // bucket)
+        minmax = np.asarray(self.level(channel, bucket)[first:last])
+        x = np.repeat(np.minimum(np.arange(first, last) * bucket + bucket // 2, info['n_samples'] - 1), 2)
+        return x, minmax.ravel(), bucket
+
+def build_session_pyramids(folder, channels=None, rebuild=False):
+    """
+    Build the pyramids of the channels (file indices, default: all) of a session folder, from the packed
+    session when there is one, otherwise from the channel pickles. Channels whose pyramid is current (same
+    length and source modification time) are skipped unless rebuild. Returns the Pyramid of the folder.
+    """
+    store = open_session(folder)
+    pyramid = Pyramid(folder)
+    if channels is None:
+        channels = store.channels if store is not None else list_channel_files(folder)
+    for channel in channels:
+        if store is not None and channel in store:
+            source = os.path.join(folder, DATA_FILE)
+            if not rebuild and pyramid.is_current(channel, source, store.length(channel)):
+                continue
+            build_pyramid(store.channel(channel), folder, channel, source=source)
+        else:
+            path = os.path.join(folder, f'{channel}.pickle')
+            if not os.path.exists(path):
+                print(f'File not found: {path}')
+                continue
+            if not rebuild and pyramid.is_current(channel, path):
+                continue
+            with open(path, 'rb') as file:
+                build_pyramid(np.asarray(pickle.load(file), dtype=np.float32).ravel(), folder, channel,
+                              keep_raw=True, source=path)
+        print(f'Built the pyramid of channel {channel}')
+    return Pyramid(folder)
+
+def main():
+    base_path = '/Users/claudiagoh/Desktop/Course directory/RP1'
+    animal_id = 'r14'
+    condition = 'habituation'
+    build_session_pyramids(os.path.join(base_path, 'dataset', animal_id, condition))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from iaaft import iaaft_batch
+from lavi import prepare_lavi
+from kernel_bank import pin_fft_workers
+from psd import matlab_hanning, pwelch, pwelch2amplitude, pwelch_frequencies, fit_aperiodic, session_psd
+
+'''This script generates pink-noise surrogates of every channel and computes their LAVI, as computePinkLAVI.
+The (channel, block of repetitions) tasks are spread over a process pool:
+1. The surrogate coefficients of every channel are computed once, from the spectra and aperiodic fits of all
+   channels at once (psd), and shared through a memory-mapped file
+2. Every repetition seeds its random generator from (session, channel, repetition), and the blocks of
+   repetitions do not depend on the pool, so the PINK array is bit-identical whatever the number of workers
+3. The surrogates of a block are iterated together by the batched IAAFT and transformed by one prepare_lavi call
+4. Every task writes its LAVI rows straight into a memory-mapped rep x freq x chan output, so no large
+   array is pickled back to the main process
+With dtype=np.float32 the coefficients, the surrogates, their spectra and the PINK output are single precision,
+from the same random draws as in double precision.'''
+
+PINK_FOI = 10 ** (np.log10(0.5) + 0.025 * np.arange(96))  # 10.^(log10(0.5):0.025:log10(120))
+
+def fft_frequencies(fs, n):
+    '''Return the frequencies of every FFT bin of n samples, negative above Nyquist (getFrequenciesOfFFT).'''
+    f = np.arange(n) * fs / n
+    f[n // 2 + 1:] -= fs
+    return f
+
+def power1_fit(x, y):
+    '''Fit y = a * x^b by nonlinear least squares (MATLAB fit 'power1'), starting from the log-log line.'''
+    a, b = fit_aperiodic(x, y, refine=True)
+    return a[0], b[0]
+
+def coefficients_from_aperiodic(n, fs, a, b):
+    '''Return the full-length Fourier amplitudes a * f^b of an n-sample surrogate (zero at DC, mirrored above Nyquist).'''
+    posf = fft_frequencies(fs, n)
+    posf = posf[posf > 0]
+    ap = a * posf ** b
+    if n % 2:
+        return np.concatenate(([0], ap, ap[::-1]))
+    return np.concatenate(([0], ap, ap[:-1][::-1]))
+
+def get_pink_iafft_coefs_pow(eeg, w, foi, fs):
+    """
+    Generate the coefficients used to simulate pink noise with IAAFT (get_pink_iafft_coefs_pow).
+    Returns the coefficients, the (a, b) of the aperiodic fit and the amplitude spectrum.
+    """
+    n = eeg.size
+    pxx, pff = pwelch(eeg, w, fs)
+    amp = pwelch2amplitude(pxx, pff, w) * n / 2  # amplitude to coefficients
+
+    fit_fs = (pff >= foi[0]) & (pff <= foi[-1])
+    a, b = power1_fit(pff[fit_fs], amp[fit_fs])
+    return coefficients_from_aperiodic(n, fs, a, b), (a, b), amp
+
+def get_pink_iafft_coefs_random_ap(n, fs, foi, a, b):
+    """
+    Generate the coefficients used to simulate n samples of pink noise whose power is a * f^b
+    (get_pink_iafft_coefs_random_ap). Returns the coefficients and the amplitude spectrum.
+    """
+    w = matlab_hanning(int(fs * 2))
+    pff = pwelch_frequencies(w.size, fs)
+    with np.errstate(divide='ignore'):
+        pow = a * pff ** b
+    amp = pwelch2amplitude(pow, pff, w) * n / 2  # amplitude to coefficients
+
+    fit_fs = (pff >= foi[0]) & (pff <= foi[-1])
+    fit_a, fit_b = power1_fit(pff[fit_fs], amp[fit_fs])
+    return coefficients_from_aperiodic(n, fs, fit_a, fit_b), amp
+
+def session_seed(session):
+    '''Return a stable integer seed for a session name.'''
+    return int.from_bytes(hashlib.sha1(str(session).encode()).digest()[:8], 'little')
+
+def task_rng(session, channel, rep):
+    '''Return the random generator of one (channel, repetition) task, derived only from the session, channel and rep.'''
+    return np.random.default_rng([session_seed(session), int(channel), int(rep)])
+
+def pink_lavi(coefs, foi, fs, lag, width, rngs, dtype=np.float64):
+    """
+    Generate one pink-noise surrogate per random generator from the coefficients and return their LAVI profiles
+    (rep x freq, or rep x freq x lag for a vector of lags, all from the same surrogates), computed in dtype.
+    """
+    n = coefs.size
+    sorted_values = np.empty((len(rngs), n))
+    initial = np.empty((len(rngs), n))
+    for row, rng in enumerate(rngs):
+        sorted_values[row] = np.sort(rng.random(n))
+        initial[row, rng.permutation(n)] = sorted_values[row]
+    pink_noise, _, _, _ = iaaft_batch(coefs, sorted_values, initial, dtype=dtype)
+    return prepare_lavi(pink_noise, foi, fs, lag, width, verbose=False, dtype=dtype)
+
+_WORKER = {}
+
+def _init_worker(coefs_path, coefs_shape, output_path, settings):
+    '''Open the shared coefficient and output files once per worker process, whose FFTs use one thread.'''
+    pin_fft_workers(1)
+    _WORKER['coefs'] = np.memmap(coefs_path, dtype=settings['dtype'], mode='r', shape=coefs_shape)
+    _WORKER['pink'] = np.load(output_path, mmap_mode='r+')
+    _WORKER.update(settings)
+
+def _run_task(row, first_rep, last_rep):
+    '''Compute the surrogate LAVIs of a block of repetitions of one channel and write them into the shared PINK output.'''
+    rngs = [task_rng(_WORKER['session'], _WORKER['channels'][row], rep) for rep in range(first_rep, last_rep)]
+    _WORKER['pink'][first_rep:last_rep, :, row] = pink_lavi(_WORKER['coefs'][row], _WORKER['foi'],
+                                                            _WORKER['fs'], _WORKER['lag'], _WORKER['width'], rngs,
+                                                            _WORKER['dtype'])
+    return row, last_rep - first_rep
+
+def compute_pink_lavi(data, foi=PINK_FOI, fs=1000, lag=1.5, width=5, pink_reps=100, durs=None, session='',
+                      n_workers=None, output_path=None, reps_per_task=10, channels=None, psd_cache=None, verbose=True,
+                      dtype=np.float64):
+    """
+    Generate pink noise matching every channel and compute its LAVI, to estimate the significance
+    level of detected bands (computePinkLAVI).
+
+    Parameters:
+    - data (array): N_chan x N_time data.
+    - foi (array): Frequencies of interest. Default: 10.^(log10(0.5):0.025:log10(120)).
+    - fs, lag, width: As in prepare_lavi. A vector of lags is computed from the same surrogates.
+    - pink_reps (int): Number of simulations created per channel. Default: 100.
+    - durs (float): Duration (in sec) of each simulation. Default: duration of the data.
+    - session (str): Session name the random seeds are derived from, e.g. 'r14_habituation_HPC_REM_0'.
+    - n_workers (int): Number of worker processes. Default: all cores. 1 runs in this process.
+    - output_path (str): Optional .npy file that keeps the PINK array (opened as a memmap).
+    - reps_per_task (int): Number of repetitions of a channel generated together as one batch. Default: 10.
+    - channels (array): Channel index of every row of data, used in the seeds and PSD cache keys. Default: row numbers.
+    - psd_cache (str): Optional folder where the spectra of the channels are kept (see session_psd).
+    - dtype: Float type of the surrogates and of PINK (np.float32 halves their memory). Default: np.float64.
+    Returns PINK, a pink_reps x N_freq x N_chan array (dimord: rep_freq_chan), or pink_reps x N_freq x N_chan x
+    N_lag (dimord: rep_freq_chan_lag) for a vector of lags.
+    """
+    if pink_reps == 0 or durs == 0:
+        return np.empty(0)
+    data = np.atleast_2d(np.asarray(data, dtype=float))
+    foi = np.atleast_1d(np.asarray(foi, dtype=float))
+    n_time = data.shape[1] if durs is None else min(int(np.floor(durs * fs)), data.shape[1])
+    data = data[:, :n_time]  # take a shorter duration than the original if requested
+    n_chan = data.shape[0]
+    channels = np.arange(n_chan) if channels is None else np.asarray(channels)
+    n_workers = n_workers or os.cpu_count()
+
+    work_dir = tempfile.mkdtemp(prefix='pink_')
+    try:
+        # Coefficients of every channel, computed once and shared through a memory-mapped file
+        w = matlab_hanning(int(fs * 2))  # 2-sec window
+        pxx, pff = session_psd(data, fs, channels, session, psd_cache, w.size)  # demeaned
+        amp = pwelch2amplitude(pxx, pff, w) * n_time / 2  # amplitude to coefficients
+        a, b = fit_aperiodic(pff, amp, (foi[0], foi[-1]), refine=True)
+        coefs_path = os.path.join(work_dir, 'coefs.dat')
+        coefs = np.memmap(coefs_path, dtype=dtype, mode='w+', shape=(n_chan, n_time))
+        for ch in range(n_chan):
+            coefs[ch] = coefficients_from_aperiodic(n_time, fs, a[ch], b[ch])
+        coefs.flush()
+        del coefs
+
+        output_path = output_path or os.path.join(work_dir, 'pink.npy')
+        pink = np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype, shape=(pink_reps, foi.size, n_chan) + np.shape(lag))
+        pink[:] = np.nan
+        pink.flush()
+        del pink
+
+        settings = {'session': session, 'channels': channels.tolist(), 'foi': foi, 'fs': fs, 'lag': lag, 'width': width,
+                    'dtype': np.dtype(dtype).name}
+        init_args = (coefs_path, (n_chan, n_time), output_path, settings)
+        tasks = [(ch, rep, min(rep + reps_per_task, pink_reps))
+                 for ch in range(n_chan) for rep in range(0, pink_reps, reps_per_task)]
+        n_surrogates = n_chan * pink_reps
+        tic = time.time()
+
+        def report(done):
+            if verbose:
+                elapsed = time.time() - tic
+                print(f'\rRunning PINK ANALYSIS: {done}/{n_surrogates} surrogates, '
+                      f'{done / max(elapsed, 1e-9):.2f} surrogates/s, {elapsed:.0f} s so far', end='')
+
+        if n_workers == 1:
+            _init_worker(*init_args)
+            done = 0
+            for task in tasks:
+                done += _run_task(*task)[1]
+                report(done)
+            _WORKER.clear()
+        else:
+            with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=init_args) as pool:
+                futures = [pool.submit(_run_task, *task) for task in tasks]
+                done = 0
+                for future in as_completed(futures):
+                    done += future.result()[1]
+                    report(done)
+        if verbose:
+            print('.')
+
+        if output_path.startswith(work_dir):
+            return np.array(np.load(output_path))
+        return np.load(output_path, mmap_mode='r')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
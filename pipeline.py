@@ -0,0 +1,390 @@
+import os
+import sys
+import glob
+import json
+import time
+import pickle
+import shutil
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from scipy.io import loadmat
+from assign_tetrode import load_channel_map, load_condition_data, assign_condition_data, transform_dataframe, \
+    save_assigned_data
+from label_tetrode_quality import label_quality
+from channel_qc import scan_session, add_qc_to_dataframe
+from recording_store import has_store
+from concatenating_data import load_good_lfp_data, create_and_save_matrices
+from making_epochs import load_specific_lfp_data, create_and_save_epochs
+from segmentation import load_sleep_scores, load_and_process_audio_timestamps
+from result_store import ResultStore
+from result_cache import ResultCache, cached_lavi_and_pink
+from epoch_accumulator import EpochAccumulator, STATE_FILE as ACCUMULATOR_FILE
+from abba import abba
+from kernel_bank import pin_fft_workers
+import instrumentation
+
+'''This script runs the whole cohort through the analysis stages in one invocation.
+The cohort (animals, conditions, areas, states), the paths and the analysis parameters are given in a
+declarative config (DEFAULT_CONFIG, or a JSON file with the same keys), and the stages and their
+dependencies are declared in STAGES:
+
+    assign_tetrodes -> label_quality -> epoch -> lavi_pink -> average -> abba -> histograms
+                                     `-> segment
+
+The epochs are cut straight from the recordings (their valid runs are lost once a state is concatenated), so
+segment, which saves the whole-state matrices of saved_matrices for inspection, only runs when selected.
+
+Every stage runs once per combination of its level (per session, per area or per state), and the
+combinations whose dependencies are done run concurrently in a process pool. As in make, a stage is
+skipped when its outputs exist, its stamp is newer than all its inputs and its parameters did not change.
+Stamps are kept in <base_path>/pipeline.'''
+
+LAVI_FOI = 10 ** (0.025 * np.arange(65))  # 10.^(log10(1):0.025:log10(40)), as in calculate_lavi_and_pink
+
+DEFAULT_CONFIG = {
+    'base_path': '/Users/claudiagoh/Desktop/Course directory/RP1',
+    'animals': ['r14', 'r16', 'r19', 'r20'],
+    'conditions': ['habituation', 'fear_conditioning', 'probe_testing', 'extinction_training', 'extinction_testing'],
+    'areas': ['PFC', 'HPC', 'BLA', 'A1'],
+    'states': ['Wakefulness', 'NREM', 'REM'],
+    'keep_timeline': False,  # segment stage: save the state matrices on the recording timeline with NaN gaps
+    'good_channels': {'r14': {'habituation': [0, 4, 9, 13, 16, 20, 24, 28, 34, 36, 42, 45, 48, 52, 56, 60, 66, 68, 72,
+                                              77, 80, 84, 90, 92, 96, 101, 105, 111, 112, 118, 122, 125]}},
+    'qc_thresholds': {},  # sessions without good_channels are labelled by channel_qc (see QC_THRESHOLDS)
+    'epoch_length': 240000,
+    'stride': None,
+    'foi': LAVI_FOI.tolist(),
+    'fs': 1000,
+    'lag': 1.5,
+    'width': 5,
+    'pink_reps': 100,
+    'pink_workers': 1,  # the pipeline already uses all cores across combinations
+    'dtype': 'float64',  # 'float32' computes LAVI and PINK in single precision (see precision_report)
+    'alpha_range': [6, 8],
+    'per_freq': False,
+}
+
+LEVELS = {
+    'session': ('animal', 'condition'),
+    'area': ('animal', 'condition', 'area'),
+    'state': ('animal', 'condition', 'area', 'state'),
+}
+
+def assigned_path(config, animal, condition):
+    return os.path.join(config['base_path'], 'assigned_dataframe', f'{animal}_{condition}_assigned.pickle')
+
+def dataset_folder(config, animal, condition):
+    return os.path.join(config['base_path'], 'dataset', animal, condition)
+
+def sleep_score_path(config, animal, condition):
+    return os.path.join(config['base_path'], 'sleep_score', f'{animal}_{condition}_sleep.pickle')
+
+def timestamps_path(config, animal, condition):
+    return os.path.join(config['base_path'], 'audio_timestamps', f'{animal}_{condition}_sleep.pickle')
+
+def epochs_folder(config, animal, condition, area, state):
+    return os.path.join(config['base_path'], 'saved_matrices', area, state, f'{animal}_{condition}')
+
+def results_folder(config, animal, condition, area):
+    return os.path.join(config['base_path'], 'LAVI_results', animal, condition, area)
+
+def good_channels(config, animal, condition, area):
+    '''Return the indices of the good channels of an area, from the labelled assigned dataframe.'''
+    with open(assigned_path(config, animal, condition), 'rb') as file:
+        assigned_df = pickle.load(file)
+    return list(assigned_df[(assigned_df['Quality'] == 'Good') & (assigned_df['Area'] == area)].index)
+
+def epoch_files(config, animal, condition, area, state):
+    '''Return the epoch matrices of a state, ordered by epoch number.'''
+    paths = glob.glob(os.path.join(epochs_folder(config, animal, condition, area, state), '*_matrix_*.mat'))
+    return sorted(paths, key=lambda path: int(path.rsplit('_', 1)[1][:-len('.mat')]))
+
+def run_assign_tetrodes(config, animal, condition):
+    channel_map = load_channel_map(animal, os.path.join(config['base_path'], 'channel_maps', 'ChMaps'))
+    condition_data = load_condition_data(config['base_path'], animal, condition)
+    transformed = transform_dataframe(assign_condition_data(channel_map, condition_data, animal))
+    save_assigned_data(animal, condition, transformed, os.path.dirname(assigned_path(config, animal, condition)))
+
+def run_label_quality(config, animal, condition):
+    with open(assigned_path(config, animal, condition), 'rb') as file:
+        assigned_df = pickle.load(file)
+    good = config['good_channels'].get(animal, {}).get(condition)
+    folder = dataset_folder(config, animal, condition)
+    if good is None and has_store(folder):
+        # no hand-checked list: propose the labels from the channel QC metrics
+        metrics = scan_session(folder, assigned_df, n_workers=1, thresholds=config['qc_thresholds'], verbose=False)
+        labelled = add_qc_to_dataframe(assigned_df.drop(columns='Quality', errors='ignore'), metrics)
+    else:
+        labelled = label_quality(assigned_df, good or [])
+    with open(assigned_path(config, animal, condition), 'wb') as file:
+        pickle.dump(labelled, file)
+
+def run_segment(config, animal, condition, area):
+    lfp_data_list, good_indices = load_good_lfp_data(assigned_path(config, animal, condition),
+                                                     dataset_folder(config, animal, condition), area)
+    if lfp_data_list is None:
+        return
+    save_folder = os.path.join(config['base_path'], 'saved_matrices', area)
+    os.makedirs(save_folder, exist_ok=True)
+    create_and_save_matrices(lfp_data_list, good_indices,
+                             load_and_process_audio_timestamps(timestamps_path(config, animal, condition)),
+                             load_sleep_scores(sleep_score_path(config, animal, condition)),
+                             save_folder, animal, condition, config['states'], config['keep_timeline'])
+
+def run_epoch(config, animal, condition, area, state):
+    save_folder = epochs_folder(config, animal, condition, area, state)
+    shutil.rmtree(save_folder, ignore_errors=True)  # the number of epochs can change
+    os.makedirs(save_folder)
+    channels = good_channels(config, animal, condition, area)
+    lfp_data_list = load_specific_lfp_data(dataset_folder(config, animal, condition), [str(ch) for ch in channels])
+    if lfp_data_list:
+        create_and_save_epochs(lfp_data_list, load_and_process_audio_timestamps(timestamps_path(config, animal, condition)),
+                               load_sleep_scores(sleep_score_path(config, animal, condition)), save_folder, animal,
+                               condition, state, config['epoch_length'], config['stride'])
+
+def run_lavi_pink(config, animal, condition, area, state):
+    store = ResultStore(os.path.join(config['base_path'], 'LAVI_results', 'store'))
+    cache = ResultCache(os.path.join(config['base_path'], 'LAVI_results', 'cache'))
+    shutil.rmtree(store.group(animal, condition, area, state), ignore_errors=True)  # rebuilt from the cache
+    channels = good_channels(config, animal, condition, area)
+    for epoch, path in enumerate(epoch_files(config, animal, condition, area, state)):
+        LAVI, PINK = cached_lavi_and_pink(loadmat(path)['matrix'], cache, config['foi'], config['fs'], config['lag'],
+                                          config['width'], config['pink_reps'],
+                                          session=f'{animal}_{condition}_{area}_{state}_{epoch}', channels=channels,
+                                          n_workers=config['pink_workers'], verbose=False, dtype=config['dtype'])
+        store.append(animal, condition, area, state, epoch, LAVI=LAVI, PINK=PINK)
+
+def run_average(config, animal, condition, area, state):
+    store = ResultStore(os.path.join(config['base_path'], 'LAVI_results', 'store'))
+    folder = os.path.join(results_folder(config, animal, condition, area), state)
+    shutil.rmtree(folder, ignore_errors=True)
+    accumulator = EpochAccumulator(folder)
+    epochs = store.epochs(animal, condition, area, state)
+    if epochs:
+        LAVI = store.read(animal, condition, area, state, 'LAVI')
+        PINK = store.read(animal, condition, area, state, 'PINK')
+        for index, epoch in enumerate(epochs):
+            accumulator.add_epoch(LAVI[..., index], PINK[..., index], epoch)
+        accumulator.save_averages_mat(os.path.join(folder, f'{state}_avg.mat'))
+
+def run_abba(config, animal, condition, area, state):
+    folder = os.path.join(results_folder(config, animal, condition, area), state)
+    accumulator = EpochAccumulator(folder)
+    if not accumulator.count:
+        return
+    bands, SIGVECT = abba(accumulator.lavi_mean(), config['foi'], config['alpha_range'], accumulator.siglim(),
+                          config['per_freq'])
+    bands.to_csv(os.path.join(folder, 'bands.csv'), index=False)
+    np.save(os.path.join(folder, 'SIGVECT.npy'), SIGVECT)
+
+def run_histograms(config, animal, condition, area):
+    '''Save the percentage of channels with sustained (>0) and transient (<0) bands per state and frequency.'''
+    folder = results_folder(config, animal, condition, area)
+    histogram = pd.DataFrame({'foi': config['foi']})
+    for state in config['states']:
+        path = os.path.join(folder, state, 'SIGVECT.npy')
+        if os.path.exists(path):
+            SIGVECT = np.load(path)
+            histogram[f'{state}_sustained'] = np.mean(SIGVECT > 0, axis=0) * 100
+            histogram[f'{state}_transient'] = np.mean(SIGVECT < 0, axis=0) * 100
+    histogram.to_csv(os.path.join(folder, 'histogram.csv'), index=False)
+
+# The stage DAG: every stage runs per combination of its level, after the stages in 'after' for the same
+# (or the enclosing) combination. inputs/outputs decide whether a stage is up to date; params are the config
+# entries whose change makes it rerun.
+STAGES = {
+    'assign_tetrodes': {
+        'level': 'session', 'after': [], 'run': run_assign_tetrodes, 'params': [],
+        'inputs': lambda c, a, co: [os.path.join(c['base_path'], 'channel_maps', 'ChMaps', f'{a}.pickle'),
+                                    dataset_folder(c, a, co)],
+        'outputs': lambda c, a, co: [assigned_path(c, a, co)],
+    },
+    'label_quality': {
+        'level': 'session', 'after': ['assign_tetrodes'], 'run': run_label_quality,
+        'params': ['good_channels', 'qc_thresholds'],
+        'inputs': lambda c, a, co: [assigned_path(c, a, co)], 'outputs': lambda c, a, co: [assigned_path(c, a, co)],
+    },
+    'segment': {
+        'level': 'area', 'after': ['label_quality'], 'run': run_segment, 'params': ['states', 'keep_timeline'],
+        'default': False,  # nothing downstream reads the state matrices
+        'inputs': lambda c, a, co, ar: [assigned_path(c, a, co), sleep_score_path(c, a, co), timestamps_path(c, a, co)],
+        'outputs': lambda c, a, co, ar: [os.path.join(c['base_path'], 'saved_matrices', ar,
+                                                      f'{a}_{co}_{state.lower()}.mat') for state in c['states']],
+    },
+    'epoch': {
+        'level': 'state', 'after': ['label_quality'], 'run': run_epoch, 'params': ['epoch_length', 'stride'],
+        'inputs': lambda c, a, co, ar, s: [assigned_path(c, a, co), sleep_score_path(c, a, co),
+                                           timestamps_path(c, a, co)],
+        'outputs': lambda c, a, co, ar, s: [epochs_folder(c, a, co, ar, s)],
+    },
+    'lavi_pink': {
+        'level': 'state', 'after': ['epoch'], 'run': run_lavi_pink,
+        'params': ['foi', 'fs', 'lag', 'width', 'pink_reps', 'dtype'],
+        'inputs': lambda c, a, co, ar, s: [epochs_folder(c, a, co, ar, s)],
+        'outputs': lambda c, a, co, ar, s: [os.path.join(c['base_path'], 'LAVI_results', 'store', a, co, ar, s)],
+    },
+    'average': {
+        'level': 'state', 'after': ['lavi_pink'], 'run': run_average, 'params': [],
+        'inputs': lambda c, a, co, ar, s: [os.path.join(c['base_path'], 'LAVI_results', 'store', a, co, ar, s)],
+        'outputs': lambda c, a, co, ar, s: [os.path.join(results_folder(c, a, co, ar), s, ACCUMULATOR_FILE)],
+    },
+    'abba': {
+        'level': 'state', 'after': ['average'], 'run': run_abba, 'params': ['foi', 'alpha_range', 'per_freq'],
+        'inputs': lambda c, a, co, ar, s: [os.path.join(results_folder(c, a, co, ar), s, ACCUMULATOR_FILE)],
+        'outputs': lambda c, a, co, ar, s: [os.path.join(results_folder(c, a, co, ar), s, 'SIGVECT.npy')],
+    },
+    'histograms': {
+        'level': 'area', 'after': ['abba'], 'run': run_histograms, 'params': ['states'],
+        'inputs': lambda c, a, co, ar: [os.path.join(results_folder(c, a, co, ar), s, 'SIGVECT.npy')
+                                        for s in c['states']],
+        'outputs': lambda c, a, co, ar: [os.path.join(results_folder(c, a, co, ar), 'histogram.csv')],
+    },
+}
+
+# The stages run when none are selected
+DEFAULT_STAGES = [stage for stage, spec in STAGES.items() if spec.get('default', True)]
+
+def stage_keys(config, stage):
+    '''Return every combination (animal, condition[, area[, state]]) a stage runs for.'''
+    keys = [()]
+    for field in LEVELS[STAGES[stage]['level']]:
+        keys = [key + (value,) for key in keys for value in config[f'{field}s']]
+    return keys
+
+def build_tasks(config, stages):
+    """
+    Return the tasks (stage, key) of the selected stages and the tasks each one waits for.
+    A stage waits for its 'after' stages on the same combination, the enclosing one (e.g. a session stage for
+    an area stage) or all the enclosed ones (e.g. every state of an area for an area stage).
+    """
+    tasks = {(stage, key): set() for stage in stages for key in stage_keys(config, stage)}
+    for stage, key in tasks:
+        for previous in STAGES[stage]['after']:
+            if previous not in stages:
+                continue
+            for previous_key in stage_keys(config, previous):
+                common = min(len(key), len(previous_key))
+                if previous_key[:common] == key[:common]:
+                    tasks[(stage, key)].add((previous, previous_key))
+    return tasks
+
+def _mtime(path):
+    '''Return the latest modification time of a file or of anything in a folder (0 if it does not exist).'''
+    if not os.path.exists(path):
+        return 0
+    latest = os.path.getmtime(path)
+    if os.path.isdir(path):
+        for folder, _, files in os.walk(path):
+            latest = max([latest, os.path.getmtime(folder)] + [os.path.getmtime(os.path.join(folder, f)) for f in files])
+    return latest
+
+def stamp_path(config, stage, key):
+    return os.path.join(config['base_path'], 'pipeline', stage, '_'.join(key) + '.json')
+
+def params_hash(config, stage, key):
+    '''Hash the config entries a stage depends on (only this session's entry for good_channels).'''
+    params = {}
+    for name in STAGES[stage]['params']:
+        value = config[name]
+        params[name] = value.get(key[0], {}).get(key[1]) if name == 'good_channels' else value
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def is_up_to_date(config, stage, key):
+    '''A stage is up to date when its outputs exist and its stamp is newer than its inputs, with the same parameters.'''
+    path = stamp_path(config, stage, key)
+    if not os.path.exists(path):
+        return False
+    with open(path) as file:
+        if json.load(file)['params'] != params_hash(config, stage, key):
+            return False
+    outputs = STAGES[stage]['outputs'](config, *key)
+    if not all(os.path.exists(output) for output in outputs):
+        return False
+    inputs = STAGES[stage]['inputs'](config, *key)
+    return all(_mtime(input_path) <= os.path.getmtime(path) for input_path in inputs)
+
+def run_task(config, stage, key, force=False, trace=False):
+    """
+    Run one stage for one combination unless it is up to date. Returns (ran, seconds, spans), where spans
+    are the instrumentation events recorded in this process when trace is set. The events of a failed stage
+    are dropped, so they are not returned with the next task of the worker.
+    """
+    if not force and is_up_to_date(config, stage, key):
+        return False, 0.0, []
+    instrumentation.enable(trace)
+    tic = time.time()
+    try:
+        with instrumentation.span(f'stage:{stage}', key='/'.join(key)):
+            STAGES[stage]['run'](config, *key)
+        path = stamp_path(config, stage, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump({'params': params_hash(config, stage, key), 'seconds': time.time() - tic}, file)
+    finally:
+        spans = instrumentation.collect()
+    return True, time.time() - tic, spans
+
+def run_pipeline(config, stages=None, n_workers=None, force=False, trace_path=None):
+    """
+    Run the selected stages (default: DEFAULT_STAGES) for the whole cohort, running the tasks whose dependencies are done
+    concurrently in a process pool. A failed task is reported and the tasks depending on it are skipped.
+    With trace_path, the spans of every task are written there as a Chrome trace and summarised per span.
+    Returns the number of tasks run, skipped as up to date, failed and blocked by a failure.
+    """
+    stages = DEFAULT_STAGES if stages is None else stages
+    tasks = build_tasks(config, stages)
+    done, failed = set(), set()
+    summary = {'run': 0, 'up_to_date': 0, 'failed': 0, 'blocked': 0}
+    running = {}
+    with ProcessPoolExecutor(n_workers or os.cpu_count(), initializer=pin_fft_workers) as pool:  # one FFT thread each
+        while tasks or running:
+            for task in [task for task, waits in tasks.items() if waits & failed]:
+                del tasks[task]
+                failed.add(task)
+                summary['blocked'] += 1
+            for task in [task for task, waits in tasks.items() if waits <= done]:
+                del tasks[task]
+                running[pool.submit(run_task, config, *task, force, trace_path is not None)] = task
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, key = running.pop(future)
+                try:
+                    ran, seconds, spans = future.result()
+                except Exception as error:
+                    print(f'{stage} {"/".join(key)} failed: {error!r}')
+                    failed.add((stage, key))
+                    summary['failed'] += 1
+                    continue
+                done.add((stage, key))
+                instrumentation.extend(spans)
+                summary['run' if ran else 'up_to_date'] += 1
+                print(f'{stage} {"/".join(key)}: ' + (f'done in {seconds:.1f} s' if ran else 'up to date'))
+    print(f'Pipeline finished: {summary}')
+    if trace_path is not None:
+        instrumentation.write_chrome_trace(trace_path)
+        instrumentation.print_summary()
+        print(f'Trace written to {trace_path}')
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the LAVI pipeline over the whole cohort.')
+    parser.add_argument('config', nargs='?', help='JSON config (default: DEFAULT_CONFIG)')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), help='stages to run (default: all but segment)')
+    parser.add_argument('--workers', type=int, help='number of worker processes (default: all cores)')
+    parser.add_argument('--force', action='store_true', help='rerun stages even when up to date')
+    parser.add_argument('--trace', help='write the timing and memory of every step to this Chrome trace JSON file')
+    args = parser.parse_args(argv)
+
+    config = dict(DEFAULT_CONFIG)
+    if args.config:
+        with open(args.config) as file:
+            config.update(json.load(file))
+    run_pipeline(config, args.stages, args.workers, args.force, args.trace)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,6 +1,9 @@
+import os
 import matplotlib.pyplot as plt
-from scipy.signal import welch
+import numpy as np
 import pickle
+from recording_store import open_session
+from psd import session_psd, fit_aperiodic
 
 # List of pickle file indices to plot
 file_indices = [116, 117, 118, 119] 
@@ -14,26 +17,37 @@ base_path = '/Users/claudiagoh/Desktop/Course directory/RP1/dataset/R14/habituat
 # Set the sampling frequency (adjust as needed)
 fs = 1000  
 
+# Session name and folder used to cache the spectra, shared with the pink-noise surrogates
+session = 'R14_habituation'
+psd_cache = os.path.join(base_path, 'psd_cache')
+
+# Use the packed session when available, so only the plotted channels are read
+store = open_session(base_path)
+
+# Load the LFP data of every file from the packed session or the pickle files
+lfp_data = []
+for file_index in file_indices:
+    if store is not None and file_index in store:
+        lfp_data.append(store.channel(file_index))
+    else:
+        with open(f'{base_path}{file_index}.pickle', 'rb') as file:
+            lfp_data.append(pickle.load(file))
+n_samples = min(len(data) for data in lfp_data)
+lfp_matrix = np.vstack([np.asarray(data[:n_samples], dtype=float) for data in lfp_data])
+
+# Welch PSD of all files in one call (read from the cache when already computed) and their aperiodic fits
+psd_values, frequencies = session_psd(lfp_matrix, fs, channels=file_indices, session=session, cache_dir=psd_cache)
+a, b = fit_aperiodic(frequencies, psd_values, (5, 40), refine=True)
+
 # Initialize the plot
 plt.figure(figsize=(10, 6))
 
-# Loop through each file, load the data, and plot
-for file_index, color in zip(file_indices, colors):
-    # Add '.pickle' extension to the file name
-    file_name = f'{file_index}.pickle'
-    
-    # Construct the full file path
-    file_path = f'{base_path}{file_name}'
-    
-    # Load the LFP data from the pickle file
-    with open(file_path, 'rb') as file:
-        lfp_data = pickle.load(file)
-    
-    # Apply Welch's method to estimate the PSD
-    frequencies, psd_values = welch(lfp_data, fs, nperseg=1024)
-    
-    # Plot the PSD with a label corresponding to the file name and assign the color
-    plt.semilogy(frequencies, psd_values, label=f'File {file_index}', color=color)
+# Plot the PSD of every file with a label corresponding to the file name and assign the color,
+# with its aperiodic fit as a dashed line
+fit_range = (frequencies >= 5) & (frequencies <= 40)
+for row, (file_index, color) in enumerate(zip(file_indices, colors)):
+    plt.semilogy(frequencies, psd_values[row], label=f'File {file_index}', color=color)
+    plt.semilogy(frequencies[fit_range], a[row] * frequencies[fit_range] ** b[row], '--', color=color)
 
 # Add plot title and labels
 plt.title("Power Spectral Density (PSD):HPCTT20")
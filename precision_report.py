@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from segmentation import load_sleep_scores, load_and_process_audio_timestamps
+from epoch_index import build_epoch_index
+from recording_store import RecordingStore
+from lavi import prepare_lavi
+from pink_surrogates import compute_pink_lavi
+from abba import abba, significance_limits
+from epoch_accumulator import EpochAccumulator
+from pipeline import LAVI_FOI
+from benchmark import measure, prepare_session
+
+'''This script checks the single-precision mode (dtype=np.float32 in prepare_lavi and compute_pink_lavi)
+against the double-precision path on reference data: the synthetic session of synthetic_lfp, or any packed
+session. For a few epochs of one brain state it computes LAVI and PINK in both precisions, averages them
+across epochs and runs ABBA on the averages, and reports:
+1. the largest and mean absolute differences of LAVI and PINK (LAVI is bounded in [0, 1])
+2. the significance calls (SIGVECT) that differ, and how far their LAVI is from the significance limit
+3. the ABBA bands that differ (borders, peak, direction, index relative to alpha or significance)
+4. the time and peak traced memory of both precisions
+The report is written as JSON, and the script exits with status 1 when a LAVI or PINK value differs by more
+than the tolerance or when a significance call changes:
+    python precision_report.py --hours 2 --output precision.json'''
+
+BAND_COLUMNS = ['Profile', 'BegI', 'EndI', 'PeakI', 'Dir', 'Rel_alpha', 'Sig']
+
+def array_differences(reference, single):
+    '''Return the largest and mean absolute differences of two arrays, and whether their NaNs are the same.'''
+    reference, single = np.asarray(reference, dtype=float), np.asarray(single, dtype=float)
+    difference = np.abs(reference - single)
+    return {'max_abs': float(np.nanmax(difference)) if np.isfinite(difference).any() else 0.0,
+            'mean_abs': float(np.nanmean(difference)) if np.isfinite(difference).any() else 0.0,
+            'same_nans': bool(np.array_equal(np.isnan(reference), np.isnan(single)))}
+
+def band_differences(reference, single):
+    '''Return the number of bands of both tables and the bands (as BAND_COLUMNS rows) found in only one of them.'''
+    rows = [set(map(tuple, table[BAND_COLUMNS].fillna(-999).to_numpy(dtype=float).tolist()))
+            for table in (reference, single)]
+    return {'bands': len(reference), 'bands_single': len(single),
+            'only_double': sorted(rows[0] - rows[1]), 'only_single': sorted(rows[1] - rows[0])}
+
+def significance_differences(LAVI, SIGVECT, SIGVECT_single, SIGLIM):
+    """
+    Return the number of significance calls and of calls that differ between the precisions, with the distance
+    of the LAVI of every differing call to the nearest significance limit.
+    """
+    changed = np.argwhere(SIGVECT != SIGVECT_single)
+    lower, upper = significance_limits(LAVI, SIGLIM)
+    margins = [float(min(abs(LAVI[ch, fi] - lower[ch, fi]), abs(LAVI[ch, fi] - upper[ch, fi]))) for ch, fi in changed]
+    return {'calls': int(np.count_nonzero(SIGVECT)), 'calls_single': int(np.count_nonzero(SIGVECT_single)),
+            'changed': len(changed), 'changed_at': changed.tolist(), 'limit_distance': margins}
+
+def precision_report(epochs, foi=LAVI_FOI, fs=1000, lag=1.5, width=5, pink_reps=20, alpha_range=(6, 8),
+                     session='precision'):
+    """
+    Compute LAVI, PINK and ABBA of the epochs in double and single precision and return the comparison.
+
+    Parameters:
+    - epochs (list): N_chan x N_time epochs.
+    - foi, fs, lag, width: As in prepare_lavi (a single lag).
+    - pink_reps (int): Number of pink surrogates per channel and epoch. Default: 20.
+    - alpha_range (tuple): As in abba. Default: (6, 8), as in the pipeline.
+    - session (str): Session name the pink-noise seeds are derived from (the same in both precisions).
+    """
+    results, timings = {}, {}
+    for dtype in (np.float64, np.float32):
+        def run():
+            accumulator = EpochAccumulator()
+            for epoch, data in enumerate(epochs):
+                LAVI = prepare_lavi(data, foi, fs, lag, width, verbose=False, dtype=dtype)
+                PINK = compute_pink_lavi(data, foi, fs, lag, width, pink_reps, session=f'{session}_{epoch}',
+                                         n_workers=1, verbose=False, dtype=dtype)
+                accumulator.add_epoch(LAVI, PINK, epoch)
+            return accumulator
+        accumulator, timings[np.dtype(dtype).name] = measure(run, len(epochs), 'epochs')
+        bands, SIGVECT = abba(accumulator.lavi_mean(), foi, alpha_range, accumulator.siglim())
+        results[np.dtype(dtype).name] = accumulator, bands, SIGVECT
+
+    (reference, bands, SIGVECT), (single, bands_single, SIGVECT_single) = results['float64'], results['float32']
+    return {'LAVI': array_differences(reference.lavi_mean(), single.lavi_mean()),
+            'PINK': array_differences(reference.pink_mean(), single.pink_mean()),
+            'significance': significance_differences(reference.lavi_mean(), SIGVECT, SIGVECT_single,
+                                                     reference.siglim()),
+            'abba': band_differences(bands, bands_single),
+            'timings': timings}
+
+def print_report(report):
+    '''Print the differences, the changed calls and bands, and the cost of both precisions.'''
+    for name in ['LAVI', 'PINK']:
+        print(f'{name}: max |difference| {report[name]["max_abs"]:.3g}, mean {report[name]["mean_abs"]:.3g}, '
+              f'{"same" if report[name]["same_nans"] else "different"} NaNs')
+    significance = report['significance']
+    print(f'Significance calls: {significance["calls"]} in double, {significance["calls_single"]} in single '
+          f'precision, {significance["changed"]} changed')
+    for (ch, fi), distance in zip(significance['changed_at'], significance['limit_distance']):
+        print(f'  channel {ch}, frequency {fi}: LAVI {distance:.3g} from the limit')
+    bands = report['abba']
+    print(f'ABBA bands: {bands["bands"]} in double, {bands["bands_single"]} in single precision, '
+          f'{len(bands["only_double"])} only in double, {len(bands["only_single"])} only in single')
+    for name, timing in report['timings'].items():
+        print(f'{name}: {timing["seconds"]:.2f} s, peak traced memory {timing["peak_traced_bytes"] / 2 ** 20:.1f} MB')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the single- and double-precision LAVI/PINK/ABBA outputs.')
+    parser.add_argument('--session', help='packed session to use (default: a synthetic session)')
+    parser.add_argument('--channels', type=int, default=16, help='channels of the synthetic session (default: 16)')
+    parser.add_argument('--hours', type=float, default=2, help='duration of the synthetic session (default: 2)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic session (default: 0)')
+    parser.add_argument('--state', default='REM', help='brain state of the epochs (default: REM)')
+    parser.add_argument('--epoch-length', type=int, default=240000, help='samples per epoch (default: 240000)')
+    parser.add_argument('--max-epochs', type=int, default=3, help='number of epochs compared (default: 3)')
+    parser.add_argument('--pink-reps', type=int, default=20, help='pink surrogates per channel (default: 20)')
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='largest allowed LAVI/PINK difference (default: 1e-4)')
+    parser.add_argument('--work-dir', default='benchmark_data', help='folder of the synthetic sessions')
+    parser.add_argument('--output', default='precision.json', help='JSON file the report is written to')
+    args = parser.parse_args(argv)
+
+    folder = args.session
+    if folder is None:
+        folder = os.path.join(args.work_dir, f'synthetic_{args.channels}ch_{args.hours:g}h_1000Hz_seed{args.seed}')
+        prepare_session(folder, args.channels, args.hours, 1000, args.seed)
+    store = RecordingStore(folder)
+    sleep_scores = load_sleep_scores(os.path.join(folder, 'sleep_score.pickle'))
+    audio_timestamps = load_and_process_audio_timestamps(os.path.join(folder, 'audio_timestamps.pickle'))
+    index = build_epoch_index(store.common_length(), sleep_scores, audio_timestamps, args.state, args.epoch_length)
+    epochs = [np.array(index.epoch(store.data, i)) for i in range(min(len(index), args.max_epochs))]
+    if not epochs:
+        print(f'No {args.state} epoch of {args.epoch_length} samples in {folder}')
+        return
+    print(f'Comparing {len(epochs)} {args.state} epochs of {len(store.channels)} channels')
+
+    report = precision_report(epochs, LAVI_FOI, store.fs, pink_reps=args.pink_reps,
+                              session=os.path.basename(os.path.normpath(folder)))
+    report['config'] = {'session': folder, 'state': args.state, 'epoch_length': args.epoch_length,
+                        'epochs': len(epochs), 'pink_reps': args.pink_reps, 'tolerance': args.tolerance}
+    report['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print_report(report)
+    print(f'Report written to {args.output}')
+
+    if max(report['LAVI']['max_abs'], report['PINK']['max_abs']) > args.tolerance \
+            or report['significance']['changed'] or report['abba']['only_double'] or report['abba']['only_single']:
+        print('The single-precision outputs differ from the double-precision outputs')
+        sys.exit(1)
+    print('Single precision gives the same significance calls and bands')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import os
+import hashlib
+import numpy as np
+from scipy.signal import welch
+
+'''This script computes Welch power spectra of many channels at once and fits their aperiodic
+(1/f) component, so that the surrogate coefficients, the aperiodic parameters and the plots
+all use the same spectra:
+1. pwelch computes the MATLAB-style Welch PSD of a whole channel x time array in one call,
+   reading long recordings (e.g. a RecordingStore memmap) in blocks of whole segments
+2. session_psd keeps every spectrum on disk per (session, channel, fs, window, data hash), so a
+   spectrum is computed once per session and never reused for other data
+3. fit_aperiodic fits a * f^b to every channel at once: a closed-form least-squares line in
+   log-log coordinates, optionally refined by a batched Levenberg-Marquardt fit in linear
+   coordinates (the objective of MATLAB's fit 'power1' and of get_AP_of_Power)'''
+
+def matlab_hanning(n):
+    '''Return MATLAB's hanning(n): the symmetric Hann window without its zero end points.'''
+    return 0.5 * (1 - np.cos(2 * np.pi * np.arange(1, n + 1) / (n + 1)))
+
+def pwelch_nfft(window_length):
+    '''Return the FFT length pwelch uses by default: max(256, 2^nextpow2(window length)).'''
+    return max(256, int(2 ** np.ceil(np.log2(window_length))))
+
+def pwelch_frequencies(window_length, fs):
+    '''Return the one-sided frequencies of pwelch for a window of window_length samples.'''
+    nfft = pwelch_nfft(window_length)
+    return np.arange(nfft // 2 + 1) * fs / nfft
+
+def pwelch(data, window, fs, channels=None, demean=False, block_size=2 ** 20):
+    """
+    Welch PSD with MATLAB pwelch defaults: 50% overlap, nfft = max(256, 2^nextpow2(window length)), no detrending.
+
+    Parameters:
+    - data (array): N_time data or N_chan x N_time data (can be a np.memmap).
+    - window (array): The window, e.g. matlab_hanning(2 * fs).
+    - fs (float): Sampling frequency.
+    - channels (array): Optional rows of data to use. Default: all rows.
+    - demean (bool): Whether to remove the mean of every channel first. Default: False.
+    - block_size (int): Approximate number of samples read at once. Default: 2^20.
+    Returns pxx (N_chan x N_freq, or N_freq for 1-D data) and the frequencies.
+    """
+    one_channel = np.ndim(data) == 1
+    data = data[None, :] if one_channel else data
+    rows = slice(None) if channels is None else np.asarray(channels)
+    n_time = data.shape[-1]
+    nperseg = window.size
+    step = nperseg - nperseg // 2
+    nfft = pwelch_nfft(nperseg)
+    pff = np.arange(nfft // 2 + 1) * fs / nfft
+    if n_time < nperseg:
+        raise ValueError(f'The window ({nperseg} samples) is longer than the data ({n_time} samples)')
+
+    mean = np.mean(data[rows], axis=-1, dtype=float, keepdims=True) if demean else 0
+    n_segments = (n_time - nperseg) // step + 1
+    segments_per_block = max(1, (block_size - nperseg) // step + 1)
+    pxx = 0
+    for first in range(0, n_segments, segments_per_block):
+        last = min(first + segments_per_block, n_segments)
+        block = np.asarray(data[rows, first * step:(last - 1) * step + nperseg], dtype=float) - mean
+        _, block_pxx = welch(block, fs, window=window, nperseg=nperseg, noverlap=nperseg - step, nfft=nfft,
+                             detrend=False, axis=-1)
+        pxx = pxx + block_pxx * (last - first)  # welch averages the segments of the block
+    pxx = pxx / n_segments
+    return (pxx[0] if one_channel else pxx), pff
+
+def pwelch2amplitude(pxx, f, w):
+    '''Translate the PSD obtained from pwelch into amplitude (Pwelch2amplitude).'''
+    fbin = f[1] - f[0]
+    CG = np.sum(w) / w.size
+    NG = np.sum(w ** 2) / w.size
+    return np.sqrt(pxx * (NG * fbin) / CG ** 2 * 2)
+
+def data_digest(x, block_size=2 ** 20):
+    '''Return the SHA-256 hash of the values, length and dtype of a 1-D array, read in blocks.'''
+    digest = hashlib.sha256(f'{x.shape[0]}_{x.dtype}'.encode())
+    for start in range(0, x.shape[0], block_size):
+        digest.update(np.ascontiguousarray(x[start:start + block_size]).tobytes())
+    return digest.hexdigest()
+
+def psd_path(cache_dir, session, channel, fs, window_length, digest):
+    '''Return the cache file of the spectrum of one channel, keyed by its data hash (digest).'''
+    return os.path.join(cache_dir, f'{session}_ch{channel}_fs{fs:g}_w{window_length}_{digest[:16]}.npy')
+
+def session_psd(data, fs, channels=None, session='', cache_dir=None, window_length=None, block_size=2 ** 20):
+    """
+    Return the demeaned pwelch spectra of the channels of a session (N_chan x N_freq) and the frequencies.
+
+    Parameters:
+    - data (array): N_chan x N_time data, e.g. RecordingStore.read() or a stacked matrix.
+    - fs (float): Sampling frequency.
+    - channels (array): Channel index of every row of data, used in the cache keys. Default: the row numbers.
+    - session (str): Session name used in the cache keys, e.g. 'r14_habituation'.
+    - cache_dir (str): Folder where the spectra are kept, keyed by a hash of every channel. Default: no caching.
+    - window_length (int): Length of the Hann window. Default: 2 sec.
+    Spectra found in cache_dir are read back; the missing channels are computed together in one pwelch call.
+    """
+    n_chan, n_time = data.shape
+    window_length = int(window_length or 2 * fs)
+    window = matlab_hanning(window_length)
+    pff = pwelch_frequencies(window_length, fs)
+    channels = np.arange(n_chan) if channels is None else np.asarray(channels)
+    pxx = np.empty((n_chan, pff.size))
+
+    paths = [psd_path(cache_dir, session, ch, fs, window_length, data_digest(data[row], block_size)) if cache_dir
+             else None for row, ch in enumerate(channels)]
+    missing = [row for row, path in enumerate(paths) if path is None or not os.path.exists(path)]
+    for row, path in enumerate(paths):
+        if row not in missing:
+            pxx[row] = np.load(path)
+    if missing:
+        pxx[missing], _ = pwelch(data, window, fs, channels=missing, demean=True, block_size=block_size)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            for row in missing:
+                np.save(paths[row], pxx[row])
+    return pxx, pff
+
+def fit_aperiodic(f, y, flim=None, refine=False, max_iterations=200, tolerance=1e-10):
+    """
+    Fit y = a * f^b to every row of y (N_chan x N_freq) over the frequencies in flim.
+    The closed-form fit is the least-squares line of log(y) against log(f). With refine=True it is used as the
+    starting point of a Levenberg-Marquardt fit of a * f^b to y itself, run for all channels at once.
+    Returns the offsets a and the slopes b (one per channel).
+    """
+    y = np.atleast_2d(y)
+    keep = np.ones(f.size, dtype=bool) if flim is None else (f >= flim[0]) & (f <= flim[-1])
+    x, y = f[keep], y[:, keep]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_x, log_y = np.log(x), np.log(y)
+        dx = log_x - log_x.mean()
+        b = (log_y - log_y.mean(axis=1, keepdims=True)) @ dx / np.sum(dx ** 2)
+        log_a = log_y.mean(axis=1) - b * log_x.mean()
+    if refine:
+        log_a, b = _refine_power_fit(log_x, y, log_a, b, max_iterations, tolerance)
+    return np.exp(log_a), b
+
+def _refine_power_fit(log_x, y, log_a, b, max_iterations, tolerance):
+    '''Batched Levenberg-Marquardt minimisation of sum((a * x^b - y)^2) over (log a, b), one 2 x 2 system per channel.'''
+    params = np.stack((log_a, b), axis=1)
+    damping = np.full(len(params), 1e-3)
+
+    def residuals(params):
+        model = np.exp(params[:, :1] + params[:, 1:] * log_x)
+        return model, model - y
+
+    model, r = residuals(params)
+    cost = np.sum(r ** 2, axis=1)
+    active = np.isfinite(cost)
+    for _ in range(max_iterations):
+        if not active.any():
+            break
+        J = np.stack((model, model * log_x), axis=2)  # chan x freq x 2
+        JTJ = np.einsum('cfi,cfj->cij', J, J)
+        gradient = np.einsum('cfi,cf->ci', J, r)
+        damped = JTJ + damping[:, None, None] * JTJ * np.eye(2)
+        with np.errstate(invalid='ignore', over='ignore'):
+            step = -np.linalg.solve(damped[active], gradient[active][..., None])[..., 0]
+            trial = params.copy()
+            trial[active] += step
+            trial_model, trial_r = residuals(trial)
+            trial_cost = np.sum(trial_r ** 2, axis=1)
+        better = active & (trial_cost < cost)
+        params[better], model[better], r[better] = trial[better], trial_model[better], trial_r[better]
+        converged = better & (cost - trial_cost <= tolerance * cost)
+        cost[better] = trial_cost[better]
+        damping = np.where(better, damping / 10, damping * 10)
+        active &= ~converged & (damping < 1e12)
+    return params[:, 0], params[:, 1]
+
+def get_ap_of_power(data, fs, flim=(5, 40), refine=True):
+    """
+    Find the offset (a) and slope (b) of the aperiodic component of the POWER of every channel, as get_AP_of_Power.
+    These values can be used to generate pink noise with get_pink_iafft_coefs_random_ap.
+    get_AP_of_Power minimises the same objective with fminsearch from [1, 1]; here all channels are fitted at once,
+    starting from the log-log line.
+    """
+    fs = round(fs)
+    window = matlab_hanning(min(np.shape(data)[-1], 2 * fs))
+    pxx, pff = pwelch(data, window, fs)
+    a, b = fit_aperiodic(pff, pxx, flim, refine=refine)
+    if np.ndim(data) == 1:
+        return a[0], b[0]
+    return a, b
@@ -0,0 +1,184 @@
+import os
+import re
+import json
+import pickle
+import numpy as np
+
+'''This script packs the channel pickles of one session (dataset/<animal>/<condition>/N.pickle)
+into a single contiguous channel x time float32 file, with a small JSON sidecar holding:
+1. channels: the file index (N in N.pickle) of every row
+2. fs, n_samples and the original length of every channel
+3. area, tetrode, leads and quality of every channel (when an assigned dataframe is given)
+Rows are as long as the longest channel; the tail of a shorter channel is NaN and is never returned by
+RecordingStore.channel() or (by default) RecordingStore.read().
+Loaders open the packed file with np.memmap, so selecting channels or time windows
+reads only the requested part of the file and never unpickles anything.'''
+
+DATA_FILE = 'session.dat'
+METADATA_FILE = 'session.json'
+
+def list_channel_files(dataset_folder):
+    '''Return the channel indices of all N.pickle files in a session folder, sorted by index.'''
+    indices = []
+    for file_name in os.listdir(dataset_folder):
+        match = re.fullmatch(r'(\d+)\.pickle', file_name)
+        if match:
+            indices.append(int(match.group(1)))
+    return sorted(indices)
+
+def load_channel_labels(dataframe_path):
+    '''Load the area, tetrode, leads and quality of every channel from an assigned dataframe, keyed by channel index.'''
+    with open(dataframe_path, 'rb') as file:
+        assigned_df = pickle.load(file)
+
+    labels = {}
+    for _, row in assigned_df.iterrows():
+        index = int(str(row['File']).split('.')[0])
+        labels[index] = {column.lower(): str(row[column])
+                         for column in ['Area', 'Tetrode', 'Leads', 'Quality'] if column in assigned_df.columns}
+    return labels
+
+def pack_session(dataset_folder, dataframe_path=None, fs=1000, output_folder=None):
+    """
+    Pack all channel pickles of a session into one channel x time float32 file and a JSON sidecar.
+    Channels are unpickled one at a time into a temporary flat file, so peak memory stays at one channel,
+    and then copied into rows as long as the longest channel. Shorter channels are padded with NaN;
+    the original lengths are kept in the sidecar.
+    Returns the path of the packed data file.
+    """
+    output_folder = output_folder or dataset_folder
+    os.makedirs(output_folder, exist_ok=True)
+    channels = list_channel_files(dataset_folder)
+    if not channels:
+        print(f'No channel pickles found in {dataset_folder}')
+        return None
+
+    data_path = os.path.join(output_folder, DATA_FILE)
+    flat_path = data_path + '.tmp'
+    lengths = []
+    with open(flat_path, 'wb') as flat_file:
+        for index in channels:
+            with open(os.path.join(dataset_folder, f'{index}.pickle'), 'rb') as file:
+                lfp_data = np.asarray(pickle.load(file), dtype=np.float32).ravel()
+            lfp_data.tofile(flat_file)
+            lengths.append(int(lfp_data.size))
+
+    flat = np.memmap(flat_path, dtype=np.float32, mode='r', shape=(sum(lengths),))
+    packed = np.memmap(data_path, dtype=np.float32, mode='w+', shape=(len(channels), max(lengths)))
+    offset = 0
+    for row, length in enumerate(lengths):
+        packed[row, :length] = flat[offset:offset + length]
+        packed[row, length:] = np.nan
+        offset += length
+    packed.flush()
+    del flat
+    os.remove(flat_path)
+    if len(set(lengths)) > 1:
+        print(f'Channels of {min(lengths)} to {max(lengths)} samples, the shorter ones are padded with NaN')
+
+    labels = load_channel_labels(dataframe_path) if dataframe_path else {}
+    metadata = {
+        'channels': channels,
+        'fs': fs,
+        'n_samples': int(packed.shape[1]),
+        'dtype': 'float32',
+        'lengths': lengths,
+        'labels': {str(index): labels.get(index, {}) for index in channels},
+    }
+    with open(os.path.join(output_folder, METADATA_FILE), 'w') as file:
+        json.dump(metadata, file, indent=1)
+    del packed
+
+    print(f'Packed {len(channels)} channels into {data_path}')
+    return data_path
+
+def has_store(folder):
+    '''Check whether a session folder contains a packed recording store.'''
+    return os.path.exists(os.path.join(folder, DATA_FILE)) and os.path.exists(os.path.join(folder, METADATA_FILE))
+
+class RecordingStore:
+    def __init__(self, folder):
+        """
+        Open a packed session read-only with np.memmap.
+
+        Parameters:
+        - folder (str): Path to the folder containing session.dat and session.json.
+        """
+        self.folder = folder
+        with open(os.path.join(folder, METADATA_FILE)) as file:
+            self.metadata = json.load(file)
+        self.channels = self.metadata['channels']
+        self.fs = self.metadata['fs']
+        self.n_samples = self.metadata['n_samples']
+        self.lengths = self.metadata.get('lengths', [self.n_samples] * len(self.channels))
+        self.data = np.memmap(os.path.join(folder, DATA_FILE), dtype=self.metadata['dtype'], mode='r',
+                              shape=(len(self.channels), self.n_samples))
+        self._rows = {index: row for row, index in enumerate(self.channels)}
+
+    def __contains__(self, channel):
+        return int(channel) in self._rows
+
+    def length(self, channel):
+        """Return the original number of samples of one channel (by file index)."""
+        return self.lengths[self._rows[int(channel)]]
+
+    def common_length(self, channels=None):
+        """Return the number of samples all the given channels (default: all) have, without NaN padding."""
+        rows = range(len(self.channels)) if channels is None else [self._rows[int(channel)] for channel in channels]
+        return min((self.lengths[row] for row in rows), default=0)
+
+    def channel(self, channel, start=0, stop=None):
+        """Return one channel (by file index) between start and stop as a memory-mapped view, without NaN padding."""
+        row = self._rows[int(channel)]
+        stop = self.lengths[row] if stop is None else min(stop, self.lengths[row])
+        return self.data[row, start:stop]
+
+    def read(self, channels=None, start=0, stop=None):
+        """
+        Return a channel x time block for the given channel file indices.
+        All channels, or a contiguous run of rows, are returned as a view; other selections
+        read only the requested rows and window. By default the block stops at the common length
+        of the channels, so it holds no NaN padding.
+        """
+        if stop is None:
+            stop = self.common_length(channels)
+        if channels is None:
+            return self.data[:, start:stop]
+        rows = np.array([self._rows[int(channel)] for channel in channels], dtype=np.int64)
+        if rows.size and np.array_equal(rows, np.arange(rows[0], rows[0] + rows.size)):
+            return self.data[rows[0]:rows[0] + rows.size, start:stop]
+        return self.data[rows, start:stop]
+
+    def labels(self, channel):
+        """Return the area, tetrode, leads and quality labels of one channel."""
+        return self.metadata['labels'].get(str(int(channel)), {})
+
+    def select(self, area=None, quality=None):
+        """Return the file indices of channels matching an area and/or quality label."""
+        selected = []
+        for channel in self.channels:
+            labels = self.labels(channel)
+            if area is not None and labels.get('area') != area:
+                continue
+            if quality is not None and labels.get('quality') != quality:
+                continue
+            selected.append(channel)
+        return selected
+
+def open_session(folder):
+    '''Open the packed recording store of a session folder, or return None if it has not been packed.'''
+    return RecordingStore(folder) if has_store(folder) else None
+
+def main():
+    base_path = '/Users/claudiagoh/Desktop/Course directory/RP1'
+    animals = ['r14']
+    conditions = ['habituation']
+
+    for animal in animals:
+        for condition in conditions:
+            dataset_folder = os.path.join(base_path, 'dataset', animal, condition)
+            dataframe_path = os.path.join(base_path, 'assigned_dataframe', f'{animal}_{condition}_assigned.pickle')
+            pack_session(dataset_folder, dataframe_path if os.path.exists(dataframe_path) else None)
+
+if __name__ == '__main__':
+    main()
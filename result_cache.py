@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import tempfile
+import argparse
+import numpy as np
+from lavi import prepare_lavi
+from pink_surrogates import compute_pink_lavi
+
+'''This script keeps a content-addressed cache of LAVI and PINK results, so reruns only compute what changed.
+Results are cached per channel, under a hash of the channel's data and of the effective configuration
+(foi, fs, lag, width, pink_reps and the random seed of the pink noise). Relabelling one channel or changing
+one epoch therefore only recomputes the channels whose data or configuration changed.
+The cache is bounded in size: the least recently used entries are evicted first. Several processes can share
+one cache folder: an entry removed by another process while it is read is treated as a miss.
+Run it from the command line to inspect or purge a cache:
+    python result_cache.py CACHE_DIR stats
+    python result_cache.py CACHE_DIR list
+    python result_cache.py CACHE_DIR purge --older-than 30
+    python result_cache.py CACHE_DIR purge --max-bytes 1000000000'''
+
+def cache_key(data, cfg):
+    '''Return the hash of an array (its values, shape and dtype) and a JSON-serialisable configuration.'''
+    data = np.ascontiguousarray(data)
+    digest = hashlib.sha256()
+    digest.update(json.dumps([data.shape, str(data.dtype)]).encode())
+    digest.update(data.tobytes())
+    digest.update(json.dumps(cfg, sort_keys=True, default=lambda value: np.asarray(value).tolist()).encode())
+    return digest.hexdigest()
+
+class ResultCache:
+    def __init__(self, folder, max_bytes=10 * 2 ** 30):
+        """
+        Content-addressed cache of result arrays, bounded in size.
+
+        Parameters:
+        - folder (str): Folder of the cache, created if needed.
+        - max_bytes (int): Maximum total size of the cached results. Default: 10 GB.
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = None  # running estimate of the total size, measured on the first put
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], f'{key}.npz')
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        """Return the arrays cached under key as a dict, or None. A hit marks the entry as recently used."""
+        path = self._path(key)
+        try:
+            os.utime(path)
+            with np.load(path) as cached:
+                arrays = {name: cached[name] for name in cached.files}
+        except FileNotFoundError:  # not cached, or evicted by another process meanwhile
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrays
+
+    def put(self, key, cfg=None, **arrays):
+        """
+        Cache arrays under key, with the configuration they were computed with. The cache is only scanned and
+        evicted when the running estimate of its size exceeds the budget.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # every writer has its own temporary files, renamed into place, so concurrent puts of a key never mix
+        descriptor, temporary_path = tempfile.mkstemp(suffix='.tmp.npz', dir=os.path.dirname(path))
+        with os.fdopen(descriptor, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(temporary_path, path)
+        descriptor, temporary_path = tempfile.mkstemp(suffix='.tmp.json', dir=os.path.dirname(path))
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump({'cfg': cfg, 'created': time.time()}, file, default=lambda value: np.asarray(value).tolist())
+        os.replace(temporary_path, path[:-len('.npz')] + '.json')
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.entries())
+        else:
+            self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        """Return (key, size in bytes, last use time) of every cached entry, least recently used first."""
+        entries = []
+        for directory in os.listdir(self.folder):
+            subfolder = os.path.join(self.folder, directory)
+            if not os.path.isdir(subfolder):
+                continue
+            for name in os.listdir(subfolder):
+                if name.endswith('.npz') and not name.endswith('.tmp.npz'):
+                    try:
+                        stat = os.stat(os.path.join(subfolder, name))
+                    except FileNotFoundError:  # removed by another process since the listing
+                        continue
+                    entries.append((name[:-len('.npz')], stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def remove(self, key):
+        """Remove one entry from the cache."""
+        for path in [self._path(key), self._path(key)[:-len('.npz')] + '.json']:
+            try:
+                os.remove(path)
+            except FileNotFoundError:  # already removed, e.g. by another process
+                pass
+
+    def evict(self, max_bytes=None, older_than=None):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes (default: the cache budget),
+        and every entry not used for more than older_than seconds. Returns the number of entries removed.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for key, size, last_used in entries:
+            if total <= max_bytes and (older_than is None or time.time() - last_used <= older_than):
+                continue
+            self.remove(key)
+            total -= size
+            removed += 1
+        self.size = total
+        return removed
+
+    def stats(self):
+        """Return the number of entries, their total size, and the hits/misses of this session."""
+        entries = self.entries()
+        return {'entries': len(entries), 'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+def cached_lavi_and_pink(data, cache, foi, fs=1000, lag=1.5, width=5, pink_reps=100, session='', channels=None,
+                         n_workers=None, verbose=True, dtype=np.float64):
+    """
+    Return the LAVI (chan x freq) and PINK (rep x freq x chan) of an epoch, as prepare_lavi and compute_pink_lavi,
+    computing only the channels whose data or configuration is not in the cache.
+
+    Parameters:
+    - data (array): N_chan x N_time epoch.
+    - cache (ResultCache): The cache.
+    - foi, fs, lag, width: As in prepare_lavi (a vector of lags adds a last lag dimension to LAVI and PINK).
+    - pink_reps, session: As in compute_pink_lavi (session and channel set the random seeds of the pink noise).
+    - channels (array): Channel index of every row of data. Default: the row numbers.
+    - dtype: Float type of the computation and of LAVI and PINK, as in prepare_lavi. Single-precision results
+      are cached under their own keys. Default: np.float64.
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=float))
+    foi = np.atleast_1d(np.asarray(foi, dtype=float))
+    channels = np.arange(data.shape[0]) if channels is None else np.asarray(channels)
+    cfg = {'foi': foi, 'fs': fs, 'lag': lag, 'width': width, 'pink_reps': pink_reps, 'session': session}
+    if np.dtype(dtype) != np.float64:
+        cfg['dtype'] = np.dtype(dtype).name  # double-precision keys are unchanged
+    LAVI = np.empty((data.shape[0], foi.size) + np.shape(lag), dtype=dtype)
+    PINK = np.empty((pink_reps, foi.size, data.shape[0]) + np.shape(lag), dtype=dtype)
+
+    keys = [cache_key(data[row], dict(cfg, channel=int(channel))) for row, channel in enumerate(channels)]
+    missing = []
+    for row, key in enumerate(keys):
+        cached = cache.get(key)
+        if cached is None:
+            missing.append(row)
+        else:
+            LAVI[row], PINK[:, :, row] = cached['LAVI'], cached['PINK']
+    if verbose:
+        print(f'{data.shape[0] - len(missing)}/{data.shape[0]} channels found in the cache')
+
+    if missing:
+        LAVI[missing] = prepare_lavi(data[missing], foi, fs, lag, width, verbose=verbose, dtype=dtype)
+        if pink_reps:  # without repetitions compute_pink_lavi returns an empty array, and PINK stays empty
+            PINK[:, :, missing] = compute_pink_lavi(data[missing], foi, fs, lag, width, pink_reps, session=session,
+                                                    channels=channels[missing], n_workers=n_workers, verbose=verbose,
+                                                    dtype=dtype)
+        for row in missing:
+            cache.put(keys[row], dict(cfg, channel=int(channels[row])), LAVI=LAVI[row], PINK=PINK[:, :, row])
+    return LAVI, PINK
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect or purge a LAVI/PINK result cache.')
+    parser.add_argument('folder', help='folder of the cache')
+    parser.add_argument('command', choices=['stats', 'list', 'purge'])
+    parser.add_argument('--older-than', type=float, help='purge entries not used for this many days')
+    parser.add_argument('--max-bytes', type=int, help='purge least recently used entries down to this size')
+    parser.add_argument('--all', action='store_true', help='purge every entry')
+    args = parser.parse_args(argv)
+
+    cache = ResultCache(args.folder)
+    if args.command == 'stats':
+        for name, value in cache.stats().items():
+            print(f'{name}: {value}')
+    elif args.command == 'list':
+        for key, size, last_used in cache.entries():
+            print(f'{key}  {size / 2 ** 20:8.2f} MB  last used {time.strftime("%Y-%m-%d %H:%M", time.localtime(last_used))}')
+    else:
+        if args.all:
+            removed = cache.evict(max_bytes=0)
+        elif args.older_than is None and args.max_bytes is None:
+            parser.error('purge needs --older-than, --max-bytes or --all')
+        else:
+            older_than = None if args.older_than is None else args.older_than * 24 * 3600
+            removed = cache.evict(max_bytes=args.max_bytes if args.max_bytes is not None else sys.maxsize,
+                                  older_than=older_than)
+        print(f'Removed {removed} entries')
+
+if __name__ == '__main__':
+    main()
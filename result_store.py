@@ -0,0 +1,186 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from scipy.io import savemat
+from instrumentation import span
+
+'''This script keeps the LAVI results of every animal/condition/area/state in one chunked on-disk store,
+instead of scattered .mat files rewritten with -append and -struct.
+1. Every group (animal/condition/area/state) is a folder; every array of the group (LAVI, PINK, SIGVECT)
+   is a raw binary file holding one chunk per epoch, and a JSON sidecar with the epoch names and the
+   shape of one chunk. Within a chunk the channel is the outermost dimension (PINK is stored
+   chan x rep x freq), so the values of one channel are contiguous in every chunk
+2. A new epoch is appended to the end of the files, so nothing already stored is rewritten; all the
+   .dat files and the bands are written before any sidecar, and a retry after an interrupted append
+   only adds the arrays whose sidecar does not list the epoch yet, and replaces the bands of the epoch
+3. Arrays are opened as memory maps and returned in the MATLAB layouts (LAVI chan x freq x epoch, PINK
+   rep x freq x chan x epoch), so reading one channel across epochs reads one contiguous span per epoch
+4. The ABBA band tables are appended to a CSV file with the epoch of every band
+Groups can be exported to .mat files for MATLAB users.'''
+
+# Epoch is the last dimension of every array, as in combine_matrices
+DIMORD = {'LAVI': 'chan_freq_epoch', 'PINK': 'rep_freq_chan_epoch', 'SIGVECT': 'chan_freq_epoch'}
+BANDS_FILE = 'bands.csv'
+
+def channel_axis(name):
+    '''Return the channel dimension of the chunks of an array (0 for arrays not in DIMORD).'''
+    return DIMORD[name].split('_').index('chan') if name in DIMORD else 0
+
+class ResultStore:
+    def __init__(self, root):
+        """
+        Chunked store of LAVI, PINK and ABBA results.
+
+        Parameters:
+        - root (str): Folder of the store, created if needed.
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def group(self, animal, condition, area, state):
+        '''Return the folder of one animal/condition/area/state group.'''
+        return os.path.join(self.root, animal, condition, area, state)
+
+    def _metadata(self, folder, name):
+        path = os.path.join(folder, f'{name}.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as file:
+            return json.load(file)
+
+    def epochs(self, animal, condition, area, state, name='LAVI'):
+        '''Return the names of the epochs stored in one array of a group.'''
+        metadata = self._metadata(self.group(animal, condition, area, state), name)
+        return [] if metadata is None else metadata['epochs']
+
+    def append(self, animal, condition, area, state, epoch, bands=None, **arrays):
+        """
+        Append the results of one epoch to a group, e.g. append('r14', 'habituation', 'HPC', 'REM', 3,
+        LAVI=LAVI, PINK=PINK, SIGVECT=SIGVECT, bands=bands). Every array must have the shape of the chunks
+        already stored under its name. bands is a band table (e.g. the output of abba), stored with its epoch.
+        """
+        folder = self.group(animal, condition, area, state)
+        os.makedirs(folder, exist_ok=True)
+        # check every array before writing any, so a rejected epoch leaves the group untouched
+        chunks, stored = {}, []
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            # single-precision results (see prepare_lavi) are stored as float32, everything else as float64
+            metadata = self._metadata(folder, name) or {'shape': list(array.shape), 'epochs': [],
+                                                        'dtype': 'float32' if array.dtype == np.float32 else 'float64',
+                                                        'chan_axis': channel_axis(name)}
+            if list(array.shape) != metadata['shape']:
+                raise ValueError(f'{name} of epoch {epoch} has shape {array.shape}, '
+                                 f'the stored epochs have shape {tuple(metadata["shape"])}')
+            if str(epoch) in metadata['epochs']:
+                stored.append(name)
+                continue
+            array = np.ascontiguousarray(np.moveaxis(array, metadata['chan_axis'], 0), dtype=metadata['dtype'])
+            chunks[name] = array, metadata
+        if stored and not chunks:
+            raise ValueError(f'Epoch {epoch} is already stored in {folder} ({", ".join(stored)})')
+        if stored:
+            print(f'Epoch {epoch} was partly stored in {folder}, adding {", ".join(chunks)}')
+
+        with span('save', epoch=str(epoch), bytes_written=sum(array.nbytes for array, _ in chunks.values())):
+            for name, (array, metadata) in chunks.items():
+                data_path = os.path.join(folder, f'{name}.dat')
+                with open(data_path, 'ab') as file:
+                    # drop any chunk left behind by an interrupted append before adding this one
+                    file.truncate(len(metadata['epochs']) * array.nbytes)
+                    file.write(array.tobytes())
+            if bands is not None:
+                self._write_bands(folder, epoch, bands)
+            # the sidecars are written last, so an epoch is listed only once all its chunks and bands are on disk
+            for name, (array, metadata) in chunks.items():
+                metadata['epochs'].append(str(epoch))
+                with open(os.path.join(folder, f'{name}.json.tmp'), 'w') as file:
+                    json.dump(metadata, file, indent=2)
+                os.replace(os.path.join(folder, f'{name}.json.tmp'), os.path.join(folder, f'{name}.json'))
+
+    def _write_bands(self, folder, epoch, bands):
+        '''Append the bands of one epoch, replacing any bands of that epoch left by an interrupted append.'''
+        bands = bands.assign(Epoch=str(epoch))
+        bands_path = os.path.join(folder, BANDS_FILE)
+        if os.path.exists(bands_path):
+            stored = pd.read_csv(bands_path, dtype={'Epoch': str})
+            if (stored['Epoch'] == str(epoch)).any():
+                bands = pd.concat([stored[stored['Epoch'] != str(epoch)], bands])
+                bands.to_csv(bands_path + '.tmp', index=False)
+                os.replace(bands_path + '.tmp', bands_path)
+                return
+        bands.to_csv(bands_path, mode='a', header=not os.path.exists(bands_path), index=False)
+
+    def read(self, animal, condition, area, state, name):
+        """
+        Return one array of a group as a read-only memory map, with the epochs as the last dimension
+        (e.g. LAVI: chan x freq x epoch, PINK: rep x freq x chan x epoch). Slicing it reads only the slice.
+        """
+        folder = self.group(animal, condition, area, state)
+        metadata = self._metadata(folder, name)
+        if metadata is None:
+            raise KeyError(f'No {name} stored in {folder}')
+        chan_axis = metadata['chan_axis']
+        chunk_shape = list(metadata['shape'])
+        chunk_shape.insert(0, chunk_shape.pop(chan_axis))
+        data = np.memmap(os.path.join(folder, f'{name}.dat'), dtype=metadata['dtype'], mode='r',
+                         shape=(len(metadata['epochs']), *chunk_shape))
+        return np.moveaxis(np.moveaxis(data, 1, 1 + chan_axis), 0, -1)
+
+    def bands(self, animal, condition, area, state, epochs=None):
+        '''Return the band table of a group, optionally only for some epochs.'''
+        bands_path = os.path.join(self.group(animal, condition, area, state), BANDS_FILE)
+        if not os.path.exists(bands_path):
+            return pd.DataFrame()
+        bands = pd.read_csv(bands_path, dtype={'Epoch': str})
+        if epochs is not None:
+            bands = bands[bands['Epoch'].isin([str(epoch) for epoch in epochs])]
+        return bands
+
+    def export_mat(self, animal, condition, area, state, output_path):
+        """Save every array of a group (as NAME_matrix), the epoch names and the band table to a .mat file."""
+        folder = self.group(animal, condition, area, state)
+        content = {}
+        for file_name in sorted(os.listdir(folder)):
+            if file_name.endswith('.json'):
+                name = file_name[:-len('.json')]
+                content[f'{name}_matrix'] = np.asarray(self.read(animal, condition, area, state, name))
+                content[f'{name}_epochs'] = np.array(self.epochs(animal, condition, area, state, name), dtype=object)
+        bands = self.bands(animal, condition, area, state)
+        if not bands.empty:
+            content['bands'] = {column: bands[column].to_numpy() for column in bands.columns}
+        savemat(output_path, content)
+
+def band_fractions(store, animal, condition, area, states, epochs=None):
+    """
+    Return the percentage of channels with a significantly high (sustained) and low (transient) LAVI at every
+    frequency, per state (N_states x N_freq each), as make_histogram_across_channels. Only the SIGVECT of the
+    requested epochs is read; the channels of all requested epochs are pooled.
+    """
+    sustained, transient = [], []
+    for state in states:
+        sigvect = store.read(animal, condition, area, state, 'SIGVECT')
+        if epochs is not None:
+            stored = store.epochs(animal, condition, area, state, 'SIGVECT')
+            sigvect = sigvect[..., [stored.index(str(epoch)) for epoch in epochs]]
+        sigvect = np.moveaxis(np.asarray(sigvect), -1, 0).reshape(-1, sigvect.shape[1])  # (epoch x chan) x freq
+        sustained.append(np.mean(sigvect > 0, axis=0) * 100)
+        transient.append(np.mean(sigvect < 0, axis=0) * 100)
+    return np.array(sustained), np.array(transient)
+
+def main():
+    base_path = '/Users/claudiagoh/Desktop/Course directory/RP1'
+    store = ResultStore(os.path.join(base_path, 'LAVI_results', 'store'))
+    animal, condition, area = 'r14', 'habituation', 'A1'
+    states = ['Wakefulness', 'NREM', 'REM']
+
+    for state in states:
+        print(f'{state}: epochs {store.epochs(animal, condition, area, state)}')
+        store.export_mat(animal, condition, area, state, os.path.join(base_path, 'LAVI_results', area,
+                                                                      f'{animal}_{condition}_{state}.mat'))
+    sustained, transient = band_fractions(store, animal, condition, area, states)
+    print(sustained, transient)
+
+if __name__ == '__main__':
+    main()
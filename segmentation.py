@@ -0,0 +1,149 @@
+import os
+import pickle
+import numpy as np
+from instrumentation import span
+
+'''This script segments LFP recordings into brain states using boolean masks.
+The sleep-score timeline and the audio stimulus windows are kept as interval
+arrays (one [start, stop) row per run), which are turned into sample masks only
+when a state is extracted. No per-sample Python objects are created:
+1. Sleep scores: one score per 5000 samples, run-length encoded into intervals
+2. Stimuli: 3000 samples excluded after every audio timestamp
+3. Brain states: Wakefulness (1, 2), NREM (3), REM (4), Unidentified (5)'''
+
+SAMPLES_PER_SCORE = 5000  # every sleep score covers 5000 samples
+STIMULUS_LENGTH = 3000  # samples excluded after every audio stimulus
+
+BRAIN_STATES = {
+    'Wakefulness': (1, 2),
+    'NREM': (3,),
+    'REM': (4,),
+    'Unidentified': (5,),
+}
+
+def load_sleep_scores(sleep_score_path):
+    '''Load sleep scores for a specified animal and condition, one score per 5000 samples.'''
+    with span('load', file=os.path.basename(sleep_score_path), bytes_read=os.path.getsize(sleep_score_path)):
+        with open(sleep_score_path, 'rb') as file:
+            data = pickle.load(file)
+
+    return np.asarray(data[-1], dtype=float)
+
+def load_and_process_audio_timestamps(file_path):
+    '''Load audio timestamps from a pickle file and convert them to a flat integer array.'''
+    with span('load', file=os.path.basename(file_path), bytes_read=os.path.getsize(file_path)):
+        with open(file_path, 'rb') as file:
+            timestamps = pickle.load(file)
+
+    sound_lists = [np.asarray(sound_list, dtype=float).ravel() for sound_list in timestamps]
+    if not sound_lists:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(sound_lists).astype(np.int64)
+
+def run_length_encode(values):
+    """
+    Split a 1-D array into runs of equal values.
+    Returns the start and stop (exclusive) index and the value of every run.
+    """
+    values = np.asarray(values)
+    if values.size == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, values[:0]
+    change = np.flatnonzero(values[1:] != values[:-1]) + 1
+    starts = np.concatenate(([0], change))
+    stops = np.concatenate((change, [values.size]))
+    return starts, stops, values[starts]
+
+def mask_to_intervals(mask):
+    '''Convert a boolean mask into an (N, 2) array of [start, stop) intervals where it is True.'''
+    mask = np.asarray(mask, dtype=bool)
+    edges = np.diff(np.concatenate(([False], mask, [False])).astype(np.int8))
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1)
+    return np.column_stack((starts, stops)).astype(np.int64)
+
+def intervals_to_mask(intervals, n_samples):
+    '''Convert [start, stop) intervals into a boolean mask of length n_samples. Intervals may overlap.'''
+    intervals = np.clip(np.asarray(intervals, dtype=np.int64).reshape(-1, 2), 0, n_samples)
+    counts = np.zeros(n_samples + 1, dtype=np.int64)
+    np.add.at(counts, intervals[:, 0], 1)
+    np.add.at(counts, intervals[:, 1], -1)
+    return np.cumsum(counts[:-1]) > 0
+
+def sleep_score_intervals(sleep_scores, samples_per_score=SAMPLES_PER_SCORE):
+    """
+    Convert the sleep-score timeline into sample intervals.
+    Returns an (N, 2) array of [start, stop) samples and the score of every interval.
+    """
+    starts, stops, scores = run_length_encode(np.asarray(sleep_scores, dtype=float))
+    intervals = np.column_stack((starts, stops)) * samples_per_score
+    return intervals.astype(np.int64), scores
+
+def stimulus_intervals(audio_timestamps, n_samples, stimulus_length=STIMULUS_LENGTH):
+    '''Return the [start, stop) sample intervals excluded after every audio stimulus.'''
+    starts = np.asarray(audio_timestamps, dtype=np.int64).ravel()
+    fits = starts + stimulus_length <= n_samples
+    for start_index in starts[~fits]:
+        print(f"Warning: Not enough data points to replace at index {start_index}.")
+    starts = starts[fits]
+    return np.column_stack((starts, starts + stimulus_length))
+
+def state_intervals(score_intervals, scores, state, n_samples=None):
+    '''Select the sleep-score intervals belonging to a brain state, optionally clipped to n_samples.'''
+    selected = score_intervals[np.isin(scores, BRAIN_STATES[state])]
+    if n_samples is not None:
+        selected = np.clip(selected, 0, n_samples)
+        selected = selected[selected[:, 1] > selected[:, 0]]
+    return selected
+
+def state_masks(n_samples, sleep_scores, audio_timestamps, states=tuple(BRAIN_STATES),
+                samples_per_score=SAMPLES_PER_SCORE, stimulus_length=STIMULUS_LENGTH):
+    """
+    Build one boolean mask per brain state, with stimulus windows excluded.
+    Returns a dictionary of masks and the mask of samples without any sleep score.
+    """
+    with span('segment', n_samples=n_samples):
+        score_intervals, scores = sleep_score_intervals(sleep_scores, samples_per_score)
+        stimulus_mask = intervals_to_mask(stimulus_intervals(audio_timestamps, n_samples, stimulus_length), n_samples)
+
+        masks = {}
+        for state in states:
+            in_state = intervals_to_mask(state_intervals(score_intervals, scores, state, n_samples), n_samples)
+            masks[state] = in_state & ~stimulus_mask
+
+        scored = intervals_to_mask(score_intervals[np.isin(scores, np.concatenate(list(BRAIN_STATES.values())))],
+                                   n_samples)
+    return masks, ~scored
+
+def state_timeline(lfp_data, mask):
+    """
+    Return the samples of a (channel x) time array on their original timeline, NaN where mask is False
+    (other states and stimulus windows), trimmed to the first and last sample of the mask, and the index of
+    the first sample kept. prepare_lavi drops the wavelet positions touching a gap, so no oscillation
+    is joined across a cut as when the samples are concatenated.
+    """
+    lfp_data = np.asarray(lfp_data, dtype=float)
+    selected = np.flatnonzero(mask)
+    if selected.size == 0:
+        return np.empty(lfp_data.shape[:-1] + (0,)), 0
+    first, last = selected[0], selected[-1] + 1
+    return np.where(mask[first:last], lfp_data[..., first:last], np.nan), int(first)
+
+def segment_brain_states(lfp_data, sleep_scores, audio_timestamps, states=tuple(BRAIN_STATES)):
+    """
+    Extract the samples of every brain state from one channel, without stimulus windows.
+    Returns a dictionary with the data, original sample indices and number of data points
+    per state, and the number of samples without a brain state.
+    """
+    lfp_data = np.asarray(lfp_data, dtype=float)
+    masks, unassigned = state_masks(len(lfp_data), sleep_scores, audio_timestamps, states)
+
+    groups = {}
+    for state, mask in masks.items():
+        original_indices = np.flatnonzero(mask)
+        groups[state] = {
+            'data': lfp_data[original_indices],
+            'original_indices': original_indices,
+            'total_data_points': original_indices.size,
+        }
+    return groups, int(np.count_nonzero(unassigned))
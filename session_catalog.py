@@ -0,0 +1,135 @@
+import os
+import json
+import pickle
+import sqlite3
+import pandas as pd
+from assign_tetrode import load_channel_map, load_condition_data, assign_condition_data, transform_dataframe
+from recording_store import METADATA_FILE
+
+'''This script builds an indexed SQLite catalog of all recorded channels in a cohort.
+Every row describes one channel of one session: animal, condition, channel index, area,
+tetrode, lead, quality, file path and number of samples. The catalog is filled from
+directory listings, channel maps and the packed-session sidecars only, so no LFP pickle
+is ever opened. Quality labels are edited in place with UPDATE statements instead of
+rewriting the assigned dataframe pickle.'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS channels (
+    animal TEXT NOT NULL,
+    condition TEXT NOT NULL,
+    channel INTEGER NOT NULL,
+    area TEXT,
+    tetrode TEXT,
+    lead INTEGER,
+    quality TEXT,
+    file TEXT,
+    path TEXT,
+    n_samples INTEGER,
+    PRIMARY KEY (animal, condition, channel)
+);
+CREATE INDEX IF NOT EXISTS channels_area_quality ON channels (animal, condition, area, quality);
+'''
+
+COLUMNS = ['animal', 'condition', 'channel', 'area', 'tetrode', 'lead', 'quality', 'file', 'path', 'n_samples']
+
+def connect(catalog_path):
+    '''Open (and create if needed) the catalog database.'''
+    connection = sqlite3.connect(catalog_path)
+    connection.executescript(SCHEMA)
+    return connection
+
+def load_sample_counts(folder_path):
+    '''Read the number of samples of every channel from the packed-session sidecar, if the session has been packed.'''
+    metadata_path = os.path.join(folder_path, METADATA_FILE)
+    if not os.path.exists(metadata_path):
+        return {}
+    with open(metadata_path) as file:
+        metadata = json.load(file)
+    return dict(zip(metadata['channels'], metadata['lengths']))
+
+def load_quality_labels(base_path, animal, condition):
+    '''Read existing quality labels from the assigned dataframe of a session, keyed by file name.'''
+    dataframe_path = os.path.join(base_path, 'assigned_dataframe', f'{animal}_{condition}_assigned.pickle')
+    if not os.path.exists(dataframe_path):
+        return {}
+    with open(dataframe_path, 'rb') as file:
+        assigned_df = pickle.load(file)
+    if 'Quality' not in assigned_df.columns:
+        return {}
+    return dict(zip(assigned_df['File'], assigned_df['Quality']))
+
+def scan_session(base_path, channel_map, animal, condition):
+    '''Build the catalog rows of one session from its directory listing and the animal's channel map.'''
+    condition_data = load_condition_data(base_path, animal, condition)
+    transformed = transform_dataframe(assign_condition_data(channel_map, condition_data, animal))
+    sample_counts = load_sample_counts(os.path.join(base_path, 'dataset', animal, condition))
+    quality = load_quality_labels(base_path, animal, condition)
+
+    rows = []
+    for _, row in transformed.iterrows():
+        channel = int(row['File'].split('.')[0])
+        n_samples = sample_counts.get(channel)
+        rows.append((animal, condition, channel, row['Area'], row['Tetrode'], int(row['Leads']),
+                     quality.get(row['File']), row['File'], condition_data[(animal, channel)],
+                     None if n_samples is None else int(n_samples)))
+    return rows
+
+def build_catalog(catalog_path, base_path, animals, conditions, channel_map_folder=None):
+    '''Scan every animal and condition of a cohort into the catalog, replacing existing rows of those sessions.'''
+    connection = connect(catalog_path)
+    with connection:
+        for animal in animals:
+            channel_map = load_channel_map(animal, channel_map_folder) if channel_map_folder else load_channel_map(animal)
+            for condition in conditions:
+                if not os.path.isdir(os.path.join(base_path, 'dataset', animal, condition)):
+                    print(f'No dataset folder for {animal} ({condition})')
+                    continue
+                rows = scan_session(base_path, channel_map, animal, condition)
+                connection.execute('DELETE FROM channels WHERE animal = ? AND condition = ?', (animal, condition))
+                connection.executemany(f'INSERT INTO channels VALUES ({", ".join("?" * len(COLUMNS))})', rows)
+                print(f'Catalogued {len(rows)} channels for {animal} ({condition})')
+    connection.close()
+
+def query_channels(catalog_path, **filters):
+    """
+    Query channels matching the given column values, e.g. animal='r14', condition='habituation',
+    area='PFC', quality='Good'. Returns a DataFrame sorted by animal, condition and channel.
+    """
+    unknown = set(filters) - set(COLUMNS)
+    if unknown:
+        raise ValueError(f'Unknown catalog columns: {sorted(unknown)}')
+    where = ' AND '.join(f'{column} = ?' for column in filters) or '1'
+    query = f'SELECT * FROM channels WHERE {where} ORDER BY animal, condition, channel'
+    connection = connect(catalog_path)
+    channels = pd.read_sql_query(query, connection, params=list(filters.values()))
+    connection.close()
+    return channels
+
+def set_quality(catalog_path, animal, condition, good_quality_indices):
+    '''Label the given channel indices of a session as Good and every other channel as Bad.'''
+    connection = connect(catalog_path)
+    with connection:
+        connection.execute('UPDATE channels SET quality = ? WHERE animal = ? AND condition = ?',
+                           ('Bad', animal, condition))
+        connection.executemany('UPDATE channels SET quality = ? WHERE animal = ? AND condition = ? AND channel = ?',
+                               [('Good', animal, condition, int(index)) for index in good_quality_indices])
+    connection.close()
+
+def to_assigned_dataframe(catalog_path, animal, condition):
+    '''Return a session in the layout of the assigned dataframe (File, Area, Tetrode, Leads, Quality), indexed by channel.'''
+    channels = query_channels(catalog_path, animal=animal, condition=condition)
+    assigned_df = channels.rename(columns={'file': 'File', 'area': 'Area', 'tetrode': 'Tetrode',
+                                           'lead': 'Leads', 'quality': 'Quality'})
+    return assigned_df.set_index('channel')[['File', 'Area', 'Tetrode', 'Leads', 'Quality']]
+
+def main():
+    base_path = '/Users/claudiagoh/Desktop/Course directory/RP1'
+    animals = ['r14', 'r16', 'r19', 'r20']
+    conditions = ['habituation', 'fear_conditioning', 'probe_testing', 'extinction_training', 'extinction_testing']
+    catalog_path = os.path.join(base_path, 'session_catalog.sqlite')
+
+    build_catalog(catalog_path, base_path, animals, conditions)
+    print(query_channels(catalog_path, animal='r14', condition='habituation', area='PFC', quality='Good'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy.io import savemat
+from pink_surrogates import PINK_FOI, get_pink_iafft_coefs_random_ap, pink_lavi
+from kernel_bank import pin_fft_workers
+
+'''This script builds the table of significance limits of General_SigLims: the min/max LAVI of pink
+noise for every (duration, sampling frequency, aperiodic slope) grid cell, so that the limits do not
+have to be computed again for every session.
+1. Every grid cell is computed by one task of a process pool and saved to its own file in the table
+   folder as soon as it finishes, so a crashed or interrupted build restarts where it stopped
+2. The surrogates of a cell are seeded from the cell and repetition indices, so a cell gives the same
+   limits whether it is computed in the first run or after a restart
+3. SiglimTable interpolates the limits of any (duration, fs, slope) from the finished table, giving the
+   SIGLIM of a new session for ABBA without generating pink noise per channel
+The parameters of the table (pmtrSIG) are saved next to the cells.'''
+
+SIGLIM_DUR = 120 * np.array([2, 3, 5, 10])  # durations in sec
+SIGLIM_FS = np.array([1000])
+SIGLIM_B = np.arange(-1.2, 0.01, 0.4)  # aperiodic slopes of the pink noise power
+PARAMETERS_FILE = 'pmtrSIG.json'
+DIMORD = 'dur_fs_b_freq_min/max'
+
+def cell_path(table_folder, di, fi, bi):
+    '''Return the file of one grid cell of the table.'''
+    return os.path.join(table_folder, 'cells', f'cell_{di}_{fi}_{bi}.npy')
+
+def load_parameters(table_folder):
+    '''Read the parameters of a table (pmtrSIG), with every grid axis as an array.'''
+    with open(os.path.join(table_folder, PARAMETERS_FILE)) as file:
+        parameters = json.load(file)
+    for key in ['DUR', 'FS', 'B', 'f']:
+        parameters[key] = np.array(parameters[key], dtype=float)
+    return parameters
+
+def save_parameters(table_folder, parameters):
+    '''Write the parameters of a new table, or check they match those of the table being resumed.'''
+    path = os.path.join(table_folder, PARAMETERS_FILE)
+    serialisable = {key: np.asarray(value).tolist() if isinstance(value, np.ndarray) else value
+                    for key, value in parameters.items()}
+    if os.path.exists(path):
+        with open(path) as file:
+            existing = json.load(file)
+        if not all(np.allclose(existing[key], serialisable[key]) if key in ['DUR', 'FS', 'B', 'f']
+                   else existing[key] == serialisable[key] for key in serialisable):
+            raise ValueError(f'{table_folder} holds a table built with other parameters')
+        return
+    with open(path, 'w') as file:
+        json.dump(serialisable, file, indent=2)
+
+def compute_cell(T, fs, b, foi, a=1, reps=20, lag=1.5, width=5, seed=(), reps_per_batch=5):
+    """
+    Compute the significance limits of one grid cell: the min and max LAVI over reps pink-noise surrogates
+    of T seconds at fs whose power is a * f^b. Returns an N_freq x 2 (min/max) array.
+    """
+    n = int(round(fs * T))
+    coefs, _ = get_pink_iafft_coefs_random_ap(n, fs, foi, a, b)
+    LAVI = np.empty((reps, foi.size))
+    for first in range(0, reps, reps_per_batch):
+        last = min(first + reps_per_batch, reps)
+        rngs = [np.random.default_rng(list(seed) + [rep]) for rep in range(first, last)]
+        LAVI[first:last] = pink_lavi(coefs, foi, fs, lag, width, rngs)
+    return np.stack((LAVI.min(axis=0), LAVI.max(axis=0)), axis=1)  # the significance levels for EACH FREQUENCY
+
+def _run_cell(table_folder, index, parameters):
+    '''Compute one grid cell and save it, writing to a temporary file first so no partial cell is ever left behind.'''
+    di, fi, bi = index
+    sig = compute_cell(parameters['DUR'][di], parameters['FS'][fi], parameters['B'][bi], parameters['f'],
+                       parameters['a'], parameters['reps'], parameters['lag'], parameters['width'], seed=index)
+    path = cell_path(table_folder, di, fi, bi)
+    temporary_path = path[:-len('.npy')] + '.tmp.npy'
+    np.save(temporary_path, sig)
+    os.replace(temporary_path, path)
+    return index
+
+def build_siglim_table(table_folder, durations=SIGLIM_DUR, fss=SIGLIM_FS, slopes=SIGLIM_B, foi=PINK_FOI, a=1,
+                       reps=20, lag=1.5, width=5, n_workers=None, verbose=True):
+    """
+    Build (or resume) a table of significance limits, as General_SigLims.
+
+    Parameters:
+    - table_folder (str): Folder where the parameters and one file per grid cell are saved.
+    - durations (array): Durations of the pink noise, in sec.
+    - fss (array): Sampling frequencies.
+    - slopes (array): Aperiodic slopes b of the pink noise power a * f^b.
+    - foi (array): Frequencies of interest. Default: 10.^(log10(0.5):0.025:log10(120)).
+    - a (float): Aperiodic offset of the pink noise power. Default: 1.
+    - reps (int): Number of surrogates per grid cell. Default: 20.
+    - lag, width: As in prepare_lavi.
+    - n_workers (int): Number of worker processes. Default: all cores. 1 runs in this process.
+    Cells already saved in table_folder are skipped. Returns SIGLIM and pmtrSIG as load_siglim_table.
+    """
+    os.makedirs(os.path.join(table_folder, 'cells'), exist_ok=True)
+    parameters = {'B': np.asarray(slopes, dtype=float), 'DUR': np.asarray(durations, dtype=float),
+                  'FS': np.asarray(fss, dtype=float), 'f': np.asarray(foi, dtype=float), 'a': a, 'reps': reps,
+                  'dimord': DIMORD, 'lag': lag, 'width': width, 'script': 'siglim_table'}
+    save_parameters(table_folder, parameters)
+
+    cells = [(di, fi, bi) for di in range(len(durations)) for fi in range(len(fss)) for bi in range(len(slopes))]
+    todo = [cell for cell in cells if not os.path.exists(cell_path(table_folder, *cell))]
+    if verbose and len(todo) < len(cells):
+        print(f'Resuming {table_folder}: {len(cells) - len(todo)}/{len(cells)} cells already done')
+    tic = time.time()
+
+    def report(done, index):
+        if verbose:
+            di, fi, bi = index
+            print(f'\rRunning T = {durations[di]}, fs = {fss[fi]}, b = {slopes[bi]:.2f} '
+                  f'({done}/{len(todo)} cells). So far it took {(time.time() - tic) / 60:.1f} minutes', end='')
+
+    n_workers = n_workers or os.cpu_count()
+    if n_workers == 1:
+        for done, cell in enumerate(todo, start=1):
+            report(done, _run_cell(table_folder, cell, parameters))
+    elif todo:
+        with ProcessPoolExecutor(n_workers, initializer=pin_fft_workers) as pool:  # one FFT thread per worker
+            futures = [pool.submit(_run_cell, table_folder, cell, parameters) for cell in todo]
+            for done, future in enumerate(as_completed(futures), start=1):
+                report(done, future.result())
+    if verbose:
+        print('.')
+    return load_siglim_table(table_folder)
+
+def load_siglim_table(table_folder):
+    '''Return SIGLIM (dur x fs x b x freq x min/max, NaN for cells not built yet) and the table parameters.'''
+    parameters = load_parameters(table_folder)
+    shape = (parameters['DUR'].size, parameters['FS'].size, parameters['B'].size, parameters['f'].size, 2)
+    SIGLIM = np.full(shape, np.nan)
+    for di, fi, bi in np.ndindex(shape[:3]):
+        path = cell_path(table_folder, di, fi, bi)
+        if os.path.exists(path):
+            SIGLIM[di, fi, bi] = np.load(path)
+    return SIGLIM, parameters
+
+def save_siglim_mat(table_folder, output_path):
+    '''Save the table as a .mat file with SIGLIM and pmtrSIG, like the output of General_SigLims.'''
+    SIGLIM, parameters = load_siglim_table(table_folder)
+    savemat(output_path, {'SIGLIM': SIGLIM, 'pmtrSIG': parameters})
+
+def _bracket(axis, value):
+    '''Return the two grid indices around value on a sorted axis and the weight of the second, clamped to the axis.'''
+    if axis.size == 1 or value <= axis[0]:
+        return 0, 0, 0.0
+    if value >= axis[-1]:
+        return axis.size - 1, axis.size - 1, 0.0
+    i1 = int(np.searchsorted(axis, value))
+    i0 = i1 - 1
+    return i0, i1, (value - axis[i0]) / (axis[i1] - axis[i0])
+
+class SiglimTable:
+    def __init__(self, table_folder):
+        """
+        Significance limits of a finished table, interpolated for any session.
+
+        Parameters:
+        - table_folder (str): Folder of a table built by build_siglim_table.
+        """
+        self.SIGLIM, self.parameters = load_siglim_table(table_folder)
+        if np.isnan(self.SIGLIM).any():
+            print(f'Warning: the table in {table_folder} is not complete.')
+        self.axes = [self.parameters['DUR'], self.parameters['FS'], self.parameters['B']]
+        order = [np.argsort(axis) for axis in self.axes]
+        self.axes = [axis[o] for axis, o in zip(self.axes, order)]
+        self.SIGLIM = self.SIGLIM[np.ix_(*order)]
+        self.foi = self.parameters['f']
+
+    def lookup(self, duration, fs, slope, foi=None):
+        """
+        Return the N_freq x 2 (min/max) significance limits for a session of the given duration (in sec),
+        sampling frequency and aperiodic slope, interpolated linearly between the grid cells (and clamped to the
+        edges of the grid). If foi is given, the limits are also interpolated to those frequencies (in log f).
+        """
+        brackets = [_bracket(axis, value) for axis, value in zip(self.axes, (duration, fs, slope))]
+        sig = np.zeros((self.foi.size, 2))
+        for corner in np.ndindex(2, 2, 2):
+            weight = 1.0
+            index = []
+            for (i0, i1, w), side in zip(brackets, corner):
+                weight *= w if side else 1 - w
+                index.append(i1 if side else i0)
+            if weight:
+                sig += weight * self.SIGLIM[tuple(index)]
+        if foi is None:
+            return sig
+        log_foi = np.log10(np.atleast_1d(foi))
+        return np.stack([np.interp(log_foi, np.log10(self.foi), sig[:, k]) for k in range(2)], axis=1)
+
+def main():
+    base_path = '/Users/claudiagoh/Desktop/Course directory/RP1'
+    table_folder = os.path.join(base_path, 'SIGLIM2')
+
+    SIGLIM, pmtrSIG = build_siglim_table(table_folder)
+    save_siglim_mat(table_folder, os.path.join(base_path, 'SIGLIM2.mat'))
+
+    table = SiglimTable(table_folder)
+    print(table.lookup(duration=480, fs=1000, slope=-0.9))
+
+if __name__ == '__main__':
+    main()
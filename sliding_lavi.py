@@ -0,0 +1,144 @@
+import os
+import numpy as np
+import pandas as pd
+from lavi import DEFAULT_FOI, gap_transform, tfr_frequencies, lag_samples, lavi_from_sums
+from segmentation import SAMPLES_PER_SCORE, BRAIN_STATES, load_sleep_scores, load_and_process_audio_timestamps, \
+    state_masks, stimulus_intervals, intervals_to_mask
+from recording_store import open_session
+from instrumentation import span
+
+'''This script computes a time-resolved LAVI: the LAVI of every channel and frequency in windows sliding
+along the whole recording, instead of cutting overlapping epochs and running prepare_lavi on each.
+1. The wavelet spectrum of the whole recording is computed once per frequency (the tfrLight spectrum of
+   gap_spectra, so excised samples can be NaN and the wavelet positions touching them are dropped)
+2. The lagged product sig0 * conj(sig1) and the two energy terms |sig0|^2 and |sig1|^2 are summed once,
+   cut at the window edges only, and cumulated, so the sums of every window are differences of two
+   cumulative sums: the cost is O(N) per frequency whatever the window length, step and number of windows
+3. The windows start on a grid of step samples (by default one sleep score, 5000 samples), so every
+   window lines up with the sleep-score timeline used in making_epochs; window_states gives the sleep
+   score and the fraction of every brain state of each window
+A window only uses the pairs of samples inside it, as an epoch does, but its wavelets see the data around
+the window, so no samples are lost at the window edges.'''
+
+def window_starts(n_samples, window, step=SAMPLES_PER_SCORE):
+    '''Return the first sample of every window of window samples, every step samples.'''
+    return np.arange(0, n_samples - window + 1, step, dtype=np.int64)
+
+def edge_cumsum(values, edges):
+    """
+    Return the cumulative sums of values (... x time) at the given edges, i.e. sum(values[..., :edge]) for
+    every edge (0 <= edge <= N_time), computed from the sums between consecutive edges.
+    """
+    n_time = values.shape[-1]
+    points = np.unique(np.concatenate(([0], edges[edges < n_time])))
+    pieces = np.add.reduceat(values, points, axis=-1) if n_time else np.zeros(values.shape[:-1] + (1,))
+    cumulative = np.concatenate((np.zeros(values.shape[:-1] + (1,), dtype=pieces.dtype),
+                                 np.cumsum(pieces, axis=-1)), axis=-1)
+    return cumulative[..., np.searchsorted(np.append(points, n_time), edges)]
+
+def window_sums(values, starts, stops):
+    '''Return the sums of values (... x time) over the [start, stop) windows, as differences of cumulative sums.'''
+    starts = np.clip(starts, 0, values.shape[-1])
+    stops = np.clip(np.maximum(stops, starts), 0, values.shape[-1])
+    edges = np.concatenate((starts, stops))
+    cumulative = edge_cumsum(values, edges)
+    return cumulative[..., starts.size:] - cumulative[..., :starts.size]
+
+def sliding_lavi(data, foi=DEFAULT_FOI, fs=1000, lag=1.5, width=5, window=240000, step=SAMPLES_PER_SCORE,
+                 valid=None, channels_per_block=1, kernel_bank=None):
+    """
+    Compute the LAVI of every channel and frequency in windows sliding along the recording.
+
+    Parameters:
+    - data (array): N_chan x N_time recording, e.g. RecordingStore.read() (a memmap is read one block of
+      channels at a time). NaNs are gaps.
+    - foi, fs, lag, width, kernel_bank: As in prepare_lavi.
+    - window (int): Number of samples in every window. Default: 240000 (the epochs of making_epochs).
+    - step (int): Number of samples between window starts. Default: 5000 (one sleep score).
+    - valid (array): Optional N_time mask of the samples to use (e.g. without stimulus windows); the others are gaps.
+    - channels_per_block (int): Number of channels transformed together. The spectrum of a block takes about
+      50 bytes per sample and channel. Default: 1.
+    Returns the N_chan x N_freq x N_window LAVI (NaN for windows without lagged pairs) and the window starts.
+    """
+    n_chan, n_time = data.shape
+    foi = np.atleast_1d(np.asarray(foi, dtype=float))
+    starts = window_starts(n_time, window, step)
+    LAVI = np.full((n_chan, foi.size, starts.size), np.nan)
+    rounded = tfr_frequencies(n_time, fs, foi)
+
+    with span('sliding_lavi', channels=n_chan, samples=n_time, frequencies=foi.size, windows=starts.size):
+        for first in range(0, n_chan, channels_per_block):
+            rows = slice(first, min(first + channels_per_block, n_chan))
+            with span('load') as s:
+                block = np.array(data[rows], dtype=float)
+                s.bytes_read = block.nbytes
+            if valid is not None:
+                block[:, ~valid] = np.nan
+
+            for fi, offset, spectrum, (gap_rows, gap_cols) in gap_transform(block, fs, rounded, width, kernel_bank):
+                lag_fi = lag_samples(fs, foi[fi], lag)
+                n_pairs = max(spectrum.shape[1] - lag_fi, 0)
+                defined = np.ones(spectrum.shape, dtype=bool)
+                defined[gap_rows, gap_cols] = False
+                pairs = defined[:, :n_pairs] & defined[:, lag_fi:lag_fi + n_pairs]
+                sig0, sig1 = spectrum[:, :n_pairs], spectrum[:, lag_fi:lag_fi + n_pairs]
+
+                # the pairs of a window start in [start, start + window - lag), in the samples of the valid range
+                pair_starts, pair_stops = starts - offset, starts + window - lag_fi - offset
+                cross = window_sums(sig0 * np.conj(sig1), pair_starts, pair_stops)
+                energy0 = window_sums(np.where(pairs, sig0.real ** 2 + sig0.imag ** 2, 0), pair_starts, pair_stops)
+                energy1 = window_sums(np.where(pairs, sig1.real ** 2 + sig1.imag ** 2, 0), pair_starts, pair_stops)
+                n_window_pairs = window_sums(pairs.astype(np.int64), pair_starts, pair_stops)
+                LAVI[rows, fi] = np.where(n_window_pairs > 0, lavi_from_sums(cross, energy0, energy1), np.nan)
+    return LAVI, starts
+
+def window_states(starts, window, n_samples, sleep_scores, audio_timestamps, samples_per_score=SAMPLES_PER_SCORE):
+    """
+    Return one row per window with its first, last + 1 and centre sample, the sleep score at its centre
+    and the fraction of its samples in every brain state (without stimulus windows), e.g. to keep the
+    windows lying fully in REM or to plot the LAVI over a sleep bout.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.minimum(starts + window, n_samples)
+    centres = starts + window // 2
+    sleep_scores = np.asarray(sleep_scores, dtype=float)
+    score_index = np.minimum(centres // samples_per_score, sleep_scores.size - 1)
+    table = {'start': starts, 'stop': stops, 'centre': centres, 'score': sleep_scores[score_index]}
+    masks, _ = state_masks(n_samples, sleep_scores, audio_timestamps, samples_per_score=samples_per_score)
+    for state, mask in masks.items():
+        table[state] = window_sums(mask.astype(np.int64), starts, stops) / (stops - starts)
+    return pd.DataFrame(table)
+
+def main():
+    base_path = '/Users/claudiagoh/Desktop/Course directory/RP1'
+    animal_id = 'r14'
+    condition = 'habituation'
+    area = 'HPC'
+    fs = 1000
+    foi = 10 ** (0.025 * np.arange(65))  # 10.^(log10(1):0.025:log10(40))
+
+    store = open_session(os.path.join(base_path, 'dataset', animal_id, condition))
+    if store is None:
+        print(f'The session of {animal_id} ({condition}) has not been packed, run recording_store first.')
+        return
+    channels = store.select(area=area, quality='Good')
+    sleep_scores = load_sleep_scores(os.path.join(base_path, 'sleep_score', f'{animal_id}_{condition}_sleep.pickle'))
+    audio_timestamps = load_and_process_audio_timestamps(
+        os.path.join(base_path, 'audio_timestamps', f'{animal_id}_{condition}_sleep.pickle'))
+
+    # the stimulus windows are excised, as in segmentation
+    n_samples = store.common_length(channels)
+    valid = ~intervals_to_mask(stimulus_intervals(audio_timestamps, n_samples), n_samples)
+    LAVI, starts = sliding_lavi(store.read(channels), foi, fs, window=240000, step=SAMPLES_PER_SCORE, valid=valid)
+    windows = window_states(starts, 240000, n_samples, sleep_scores, audio_timestamps)
+
+    output_folder = os.path.join(base_path, 'LAVI_results', area, 'sliding')
+    os.makedirs(output_folder, exist_ok=True)
+    np.savez(os.path.join(output_folder, f'{animal_id}_{condition}.npz'), LAVI=LAVI, starts=starts, foi=foi,
+             channels=np.asarray(channels), dimord='chan_freq_window')
+    windows.to_csv(os.path.join(output_folder, f'{animal_id}_{condition}_windows.csv'), index=False)
+    print(f'LAVI of {len(channels)} channels in {starts.size} windows, '
+          f'{np.count_nonzero(windows[list(BRAIN_STATES)].max(axis=1) == 1)} windows within one state')
+
+if __name__ == '__main__':
+    main()
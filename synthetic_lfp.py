@@ -0,0 +1,136 @@
+import os
+import json
+import pickle
+import numpy as np
+from recording_store import DATA_FILE, METADATA_FILE
+from segmentation import SAMPLES_PER_SCORE
+
+'''This script generates deterministic synthetic recordings, used to benchmark and test the pipeline
+without real data. Every channel is a 1/f background with:
+1. sustained oscillations that follow the sleep state (theta in REM, alpha in wakefulness)
+2. transient bursts (spindles in NREM, gamma bursts at any time)
+The sleep-score timeline is a sequence of state bouts and the stimuli are spread over the recording.
+Recordings are written in the packed-session format of recording_store (session.dat + session.json),
+with the sleep scores and audio timestamps as pickles in the layout the loaders of segmentation expect,
+so a synthetic session can be opened exactly like a real one. The same seed always gives the same session.'''
+
+# (state, frequency in Hz, relative amplitude) of the sustained oscillations
+SUSTAINED = [(4, 7.0, 0.8), (1, 10.0, 0.5), (2, 10.0, 0.5)]
+# (state or None for any state, frequency in Hz, bursts per minute, duration range in sec, relative amplitude)
+TRANSIENT = [(3, 13.0, 6, (0.5, 2.0), 1.0), (None, 40.0, 10, (0.1, 0.4), 0.6)]
+
+def pink_background(n_samples, fs, exponent, rng):
+    '''Return n_samples of noise with a power spectrum proportional to 1/f^exponent, with unit standard deviation.'''
+    f = np.fft.rfftfreq(n_samples, 1 / fs)
+    spectrum = rng.standard_normal(f.size) + 1j * rng.standard_normal(f.size)
+    spectrum[1:] *= f[1:] ** (-exponent / 2)
+    spectrum[0] = 0
+    background = np.fft.irfft(spectrum, n=n_samples)
+    return background / background.std()
+
+def sleep_score_timeline(n_scores, rng, mean_bout=60):
+    """
+    Return n_scores sleep scores (1-2: wakefulness, 3: NREM, 4: REM, 5: unidentified) made of bouts with a
+    mean length of mean_bout scores, cycling wakefulness -> NREM -> REM as in a sleep session.
+    """
+    cycle = [1, 2, 3, 3, 4, 3, 4, 2, 5]
+    scores = np.empty(n_scores, dtype=int)
+    position, step = 0, 0
+    while position < n_scores:
+        bout = max(1, int(rng.exponential(mean_bout)))
+        scores[position:position + bout] = cycle[step % len(cycle)]
+        position += bout
+        step += 1
+    return scores
+
+def stimulus_timestamps(n_samples, rng, interval=600000, jitter=60000):
+    '''Return stimulus onsets (in samples) about every interval samples, as a list of trials like the audio timestamps.'''
+    onsets = np.arange(interval, n_samples, interval)
+    onsets = onsets + rng.integers(-jitter, jitter, size=onsets.size)
+    return [[int(onset)] for onset in onsets[onsets < n_samples]]
+
+def add_burst(signal, start, length, frequency, amplitude, fs, rng):
+    '''Add a Hann-windowed oscillatory burst to signal in place.'''
+    stop = min(start + length, signal.size)
+    t = np.arange(stop - start) / fs
+    window = np.hanning(length)[:stop - start]
+    signal[start:stop] += amplitude * window * np.sin(2 * np.pi * frequency * t + rng.uniform(0, 2 * np.pi))
+
+def synthetic_channel(n_samples, fs, sample_scores, seed, channel, exponent=1.5):
+    '''Return one synthetic channel (float64) for a per-sample sleep-score timeline.'''
+    rng = np.random.default_rng([seed, channel])
+    signal = pink_background(n_samples, fs, exponent + rng.uniform(-0.3, 0.3), rng)
+    t = np.arange(n_samples) / fs
+
+    for state, frequency, amplitude in SUSTAINED:
+        in_state = sample_scores == state
+        modulation = 1 + 0.3 * np.sin(2 * np.pi * rng.uniform(0.01, 0.05) * t)
+        signal[in_state] += (amplitude * rng.uniform(0.5, 1.5) * modulation[in_state]
+                             * np.sin(2 * np.pi * frequency * t[in_state] + rng.uniform(0, 2 * np.pi)))
+
+    for state, frequency, per_minute, (shortest, longest), amplitude in TRANSIENT:
+        n_bursts = rng.poisson(per_minute * n_samples / fs / 60)
+        for start in rng.integers(0, n_samples, size=n_bursts):
+            if state is not None and sample_scores[start] != state:
+                continue
+            length = int(rng.uniform(shortest, longest) * fs)
+            add_burst(signal, start, length, frequency * rng.uniform(0.9, 1.1), amplitude, fs, rng)
+    return signal
+
+def write_synthetic_session(folder, n_channels=128, duration=2 * 3600, fs=1000, seed=0,
+                            samples_per_score=SAMPLES_PER_SCORE):
+    """
+    Write a synthetic session to folder and return the paths of its files.
+
+    Parameters:
+    - folder (str): Output folder, holding session.dat/session.json, sleep_score.pickle and audio_timestamps.pickle.
+    - n_channels (int): Number of channels. Default: 128.
+    - duration (float): Duration in sec. Default: 2 hours.
+    - fs (float): Sampling frequency. Default: 1000 Hz.
+    - seed (int): Random seed; the same seed always gives the same session.
+    Channels are generated one at a time and written to the memory-mapped file, so memory stays at a few channels.
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n_samples = int(duration * fs)
+    n_scores = int(np.ceil(n_samples / samples_per_score))
+    scores = sleep_score_timeline(n_scores, rng)
+    timestamps = stimulus_timestamps(n_samples, rng)
+    sample_scores = np.repeat(scores, samples_per_score)[:n_samples]
+
+    data_path = os.path.join(folder, DATA_FILE)
+    packed = np.memmap(data_path, dtype=np.float32, mode='w+', shape=(n_channels, n_samples))
+    for channel in range(n_channels):
+        packed[channel] = synthetic_channel(n_samples, fs, sample_scores, seed, channel)
+    packed.flush()
+    del packed
+
+    metadata = {
+        'channels': list(range(n_channels)),
+        'fs': fs,
+        'n_samples': n_samples,
+        'dtype': 'float32',
+        'lengths': [n_samples] * n_channels,
+        'labels': {str(channel): {'area': 'SYN', 'tetrode': f'TT{channel // 4 + 1}', 'leads': str(channel % 4 + 1),
+                                  'quality': 'Good'} for channel in range(n_channels)},
+        'synthetic': {'seed': seed, 'duration': duration},
+    }
+    with open(os.path.join(folder, METADATA_FILE), 'w') as file:
+        json.dump(metadata, file, indent=1)
+
+    paths = {'data': data_path,
+             'sleep_score': os.path.join(folder, 'sleep_score.pickle'),
+             'audio_timestamps': os.path.join(folder, 'audio_timestamps.pickle')}
+    with open(paths['sleep_score'], 'wb') as file:
+        pickle.dump([np.arange(n_scores), scores], file)
+    with open(paths['audio_timestamps'], 'wb') as file:
+        pickle.dump(timestamps, file)
+    return paths
+
+def main():
+    base_path = '/Users/claudiagoh/Desktop/Course directory/RP1'
+    paths = write_synthetic_session(os.path.join(base_path, 'synthetic', 'seed0'), n_channels=128, duration=2 * 3600)
+    print(f'Synthetic session written to {paths["data"]}')
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
-import pickle
 import matplotlib.pyplot as plt
+from recording_store import open_session
+from lod_pyramid import build_session_pyramids
 
-'''This script load and visualise the LFP channel recordings continuously'''
+'''This script load and visualise the LFP channel recordings continuously. Every redraw reads only the level of the
+channel pyramids (lod_pyramid.py) that fits the window and the axes width, so any zoom stays interactive.'''
 
 class InteractiveVisualizer:
     def __init__(self, base_path, file_indices, colors, window_size=2000000000):
@@ -9,7 +11,7 @@ class InteractiveVisualizer:
         Initialize the interactive visualizer.
 
         Parameters:
-        - base_path (str): Path to the directory containing the pickle files.
+        - base_path (str): Path to the directory containing the pickle files or the packed session.
         - file_indices (list): List of file indices to visualize.
         - colors (list): List of colors for each dataset.
         - window_size (int): Number of data points to display at a time.
@@ -32,45 +34,33 @@ class InteractiveVisualizer:
         # Connect the key press event
         self.fig.canvas.mpl_connect('key_press_event', self.on_key_press)
 
-    def load_data(self, file_path):
-        """Load data from a pickle file."""
-        try:
-            with open(file_path, 'rb') as file:
-                data = pickle.load(file)
-            return data
-        except EOFError:
-            print(f"Error: The file {file_path} is empty or corrupted.")
-            return None
-        except FileNotFoundError:
-            print(f"Error: The file {file_path} was not found.")
-            return None
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
-            return None
-
     def load_all_data(self):
-        """Load data from all specified files."""
+        """
+        Build (once) the min/max pyramids of the specified channels next to the data and open them. Channels of a
+        packed session keep their memory-mapped row for the raw samples; pickled channels use the float32 copy
+        saved with their pyramid, so the pickles are only read the first time.
+        """
+        store = open_session(self.base_path)
+        self.pyramid = build_session_pyramids(self.base_path, self.file_indices)
         for i, file_index in enumerate(self.file_indices):
-            file_name = f"{file_index}.pickle"
-            file_path = self.base_path + file_name
-            data = self.load_data(file_path)
-            if data is not None:
-                print(f"Loaded data from {file_path}, type: {type(data)}, length: {len(data)}")
-                self.data_list.append((data, file_name, self.colors[i % len(self.colors)]))
+            if file_index not in self.pyramid:
+                continue
+            raw = store.channel(file_index) if store is not None and file_index in store else None
+            print(f"Opened the pyramid of channel {file_index}, length: {self.pyramid.n_samples(file_index)}")
+            self.data_list.append((file_index, raw, f"{file_index}.pickle", self.colors[i % len(self.colors)]))
 
     def update_plot(self):
-        """Update the plot with the current window of data."""
+        """Update the plot with the current window of data, read from the pyramid level that fits the axes width."""
         self.ax.clear()  # Clear the current plot
-        start = self.current_start
+        start = max(self.current_start, 0)  # Prevent negative indexing
         end = start + self.window_size
+        pixels = int(self.ax.bbox.width)
         print(f"Displaying data window: {start} to {end}")
-        for data, label, color in self.data_list:
-            if start < 0:  # Prevent negative indexing
-                start = 0
-                end = self.window_size
-            if start >= len(data):  # Skip if start index exceeds data length
+        for file_index, raw, label, color in self.data_list:
+            if start >= self.pyramid.n_samples(file_index):  # Skip if start index exceeds data length
                 continue
-            self.ax.plot(data[start:end], label=label, color=color, alpha=0.7)
+            x, y, bucket = self.pyramid.window(file_index, start, end, pixels, raw)
+            self.ax.plot(x, y, label=label, color=color, alpha=0.7, linewidth=0.8 if bucket > 1 else None)
         self.ax.set_title(self.tetrode)
         self.ax.set_xlabel('Time (ms)')
         self.ax.set_ylabel('LFP amplitude (µV)')
@@ -90,6 +80,14 @@ class InteractiveVisualizer:
                 self.current_start = 0
             print(f"Pressed 'a': Moving to the previous window")
             self.update_plot()
+        elif event.key == 'i':  # Zoom in on the start of the window
+            self.window_size = max(self.window_size // 2, 100)
+            print(f"Pressed 'i': Window of {self.window_size} samples")
+            self.update_plot()
+        elif event.key == 'o':  # Zoom out
+            self.window_size *= 2
+            print(f"Pressed 'o': Window of {self.window_size} samples")
+            self.update_plot()
 
 
 # Usage